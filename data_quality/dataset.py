@@ -0,0 +1,226 @@
+import os
+import shutil
+from typing import Iterator, List, Optional
+
+import pandas as pd
+
+# Columns written as dictionary encoded (categorical) columns in the dataset
+CATEGORICAL_COLUMNS = [
+    "protocole_long",
+    "plante_famille",
+    "plante_genre",
+    "plante_espece",
+    "plante_sc",
+    "plante_fr",
+    "plante_precision",
+    "plante_caractere",
+    "habitat",
+    "grande_culture",
+    "nebulosite",
+    "temperature",
+    "vent",
+    "fleur_ombre",
+    "insecte_ordre",
+    "insecte_super_famille",
+    "insecte_famille",
+    "insecte_sous_famille",
+    "insecte_genre",
+    "insecte_espece",
+    "insecte_sc",
+    "insecte_fr",
+    "insecte_denominationPlusPrecise",
+    "insecte_abondance",
+    "insecte_vu_sur_fleur",
+    "departement",
+    "code_commune",
+    "nom_commune",
+    "geocodage",
+]
+
+PARTITION_COL = "collection_year"
+
+
+def _pyarrow():
+    """
+    Import pyarrow, which is only needed for the Parquet datasets.
+    """
+    try:
+        import pyarrow
+        import pyarrow.dataset
+    except ImportError as error:
+        raise ImportError(
+            "Parquet datasets require pyarrow (pip install pyarrow), "
+            "use format='csv' otherwise"
+        ) from error
+    return pyarrow
+
+
+def add_partition_col(
+    df: "pd.DataFrame", date_col: str = "collection_date"
+) -> "pd.DataFrame":
+    """
+    Add the year of the collections, used to partition the dataset.
+
+    Args:
+        df (pandas.DataFrame): The SPIPOLL data.
+        date_col (str, optional): The date column. Defaults to "collection_date".
+
+    Returns:
+        pandas.DataFrame: The data with the column "collection_year".
+    """
+    dates = pd.to_datetime(df[date_col], format="ISO8601", errors="coerce")
+    df[PARTITION_COL] = dates.dt.year.astype("Int32")
+    return df
+
+
+def write_dataset(
+    df: "pd.DataFrame",
+    path: str,
+    format: str = "parquet",
+    row_group_size: int = 100_000,
+) -> None:
+    """
+    Write the SPIPOLL data as a Parquet dataset partitioned by year, or as a CSV file.
+
+    The Parquet dataset is a directory with one collection_year=<year> sub-directory
+    per year, the taxon, plant and habitat columns are dictionary encoded and each
+    row group stores the min/max statistics of its columns, so that read_dataset
+    only reads the required columns, years and row groups.
+
+    Args:
+        df (pandas.DataFrame): The SPIPOLL data, see add_partition_col.
+        path (str): The dataset directory, or the CSV file.
+        format (str, optional): "parquet" or "csv". Defaults to "parquet".
+        row_group_size (int, optional): The maximum number of rows of the row groups.
+    """
+    if format == "csv":
+        df.to_csv(path, index=False)
+        return
+    if format != "parquet":
+        raise ValueError(f"Unknown format {format}, use 'parquet' or 'csv'")
+
+    pa = _pyarrow()
+    categorical = {
+        col: "category"
+        for col in CATEGORICAL_COLUMNS
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype)
+    }
+    table = pa.Table.from_pandas(df.astype(categorical), preserve_index=False)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    pa.dataset.write_dataset(
+        table,
+        path,
+        format="parquet",
+        partitioning=[PARTITION_COL],
+        partitioning_flavor="hive",
+        max_rows_per_group=row_group_size,
+        min_rows_per_group=min(row_group_size, 10_000),
+    )
+
+
+def read_dataset(
+    path: str,
+    columns: Optional[List[str]] = None,
+    years: Optional[List[int]] = None,
+    filters: Optional[list] = None,
+) -> "pd.DataFrame":
+    """
+    Read the SPIPOLL data written by write_dataset, in either format.
+
+    With a Parquet dataset, only the given columns are read, the years outside of
+    years are skipped with their partition directories, and the filters are pushed
+    down to the row group statistics. A CSV file without the "collection_year"
+    column (written before the datasets) gets it from "collection_date".
+
+    Args:
+        path (str): The dataset directory, or a CSV file. When path does not exist
+            but path + ".csv" does, e.g. "data/temporary_data/spipoll" written with
+            format="csv", the CSV file is read.
+        columns (List[str], optional): The columns to read. Defaults to None (all).
+        years (List[int], optional): The years to read. Defaults to None (all).
+        filters (list, optional): Other filters, in the pandas.read_parquet format,
+            e.g. [("latitude", ">", 45.0)]. Defaults to None.
+
+    Returns:
+        pandas.DataFrame: The data.
+    """
+    filters = list(filters or [])
+    if years is not None:
+        filters.append((PARTITION_COL, "in", list(years)))
+
+    if not os.path.exists(path) and os.path.exists(path + ".csv"):
+        path += ".csv"
+    if path.endswith(".csv"):
+        names = set(columns or []) | {col for col, _, _ in filters}
+        if PARTITION_COL in names:
+            names.add("collection_date")
+        df = pd.read_csv(path, usecols=lambda col: columns is None or col in names)
+        if PARTITION_COL in names and PARTITION_COL not in df.columns:
+            df = add_partition_col(df)
+        for col, op, value in filters:
+            df = df[_compare(df[col], op, value)]
+        return df if columns is None else df[columns]
+
+    return pd.read_parquet(
+        path, columns=columns, filters=filters or None, partitioning=_partitioning()
+    )
+
+
+def iter_dataset(
+    path: str, batch_size: int, columns: Optional[List[str]] = None
+) -> Iterator["pd.DataFrame"]:
+    """
+    Stream the SPIPOLL data written by write_dataset by batches of rows, in either
+    format (see read_dataset for the CSV fallback).
+
+    Args:
+        path (str): The dataset directory, or a CSV file.
+        batch_size (int): The maximum number of rows of the batches.
+        columns (List[str], optional): The columns to read. Defaults to None (all).
+
+    Yields:
+        pandas.DataFrame: The batches.
+    """
+    if not os.path.exists(path) and os.path.exists(path + ".csv"):
+        path += ".csv"
+    if path.endswith(".csv"):
+        yield from pd.read_csv(path, usecols=columns, chunksize=batch_size)
+        return
+
+    pa = _pyarrow()
+    dataset = pa.dataset.dataset(path, format="parquet", partitioning=_partitioning())
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_size):
+        yield batch.to_pandas()
+
+
+def _partitioning():
+    """
+    Returns the partitioning of the Parquet datasets. The partition directories are
+    typed explicitly, the discovered type (dictionary<int32>) cannot be converted
+    back to the Int32 column.
+    """
+    pa = _pyarrow()
+    return pa.dataset.partitioning(
+        pa.schema([(PARTITION_COL, pa.int32())]), flavor="hive"
+    )
+
+
+def _compare(values: "pd.Series", op: str, value) -> "pd.Series":
+    """
+    Evaluate a read_parquet filter on a column.
+    """
+    if op == "in":
+        return values.isin(value)
+    if op == "not in":
+        return ~values.isin(value)
+    operators = {
+        "==": values.__eq__,
+        "=": values.__eq__,
+        "!=": values.__ne__,
+        "<": values.__lt__,
+        "<=": values.__le__,
+        ">": values.__gt__,
+        ">=": values.__ge__,
+    }
+    return operators[op](value)
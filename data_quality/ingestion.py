@@ -0,0 +1,141 @@
+import time
+from typing import Dict, List, Optional
+
+import pandas as pd
+from joblib import Parallel, delayed
+from pandas.api.types import union_categoricals
+
+from data_quality.profiling import peak_memory_mb
+
+# dtype of the columns of the SPIPOLL exports, the columns with few distinct values
+# are read as categories. The other columns are inferred.
+SPIPOLL_DTYPES = {
+    "collection_id": "int64",
+    "code_postal": "str",
+    "protocole_long": "category",
+    "plante_famille": "category",
+    "plante_genre": "category",
+    "plante_espece": "category",
+    "plante_sc": "category",
+    "plante_fr": "category",
+    "plante_precision": "category",
+    "plante_caractere": "category",
+    "habitat": "category",
+    "grande_culture": "category",
+    "nebulosite": "category",
+    "temperature": "category",
+    "vent": "category",
+    "fleur_ombre": "category",
+    "insecte_ordre": "category",
+    "insecte_super_famille": "category",
+    "insecte_famille": "category",
+    "insecte_sous_famille": "category",
+    "insecte_genre": "category",
+    "insecte_espece": "category",
+    "insecte_sc": "category",
+    "insecte_fr": "category",
+    "insecte_denominationPlusPrecise": "category",
+    "insecte_abondance": "category",
+    "insecte_vu_sur_fleur": "category",
+}
+
+
+def read_export(
+    path: str,
+    unused_vars: List[str],
+    dtypes: Dict[str, str] = SPIPOLL_DTYPES,
+    chunksize: int = 100_000,
+) -> List["pd.DataFrame"]:
+    """
+    Read a tab-separated SPIPOLL export by chunks, without the unused columns, and
+    parse the column "coordonnees_GPS" into float "latitude" and "longitude"
+    columns in each chunk, missing when the coordinates are missing or malformed.
+
+    Args:
+        path (str): The export file.
+        unused_vars (List[str]): The columns that are not read.
+        dtypes (Dict[str, str], optional): The dtype of the columns.
+        chunksize (int, optional): The number of rows of the chunks.
+
+    Returns:
+        List[pandas.DataFrame]: The chunks.
+    """
+    chunks = []
+    reader = pd.read_csv(
+        path,
+        sep="\t",
+        usecols=lambda col: col not in unused_vars,
+        dtype=dtypes,
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        # Missing or malformed coordinates give missing values, even when no row
+        # of the chunk has a well formed "latitude, longitude" pair
+        coordinates = (
+            chunk.pop("coordonnees_GPS")
+            .astype("string")
+            .str.extract(r"^\s*([^,]+),\s*(.+)$")
+        )
+        chunk["latitude"] = pd.to_numeric(coordinates[0], errors="coerce").astype(float)
+        chunk["longitude"] = pd.to_numeric(coordinates[1], errors="coerce").astype(
+            float
+        )
+        chunks.append(chunk)
+    return chunks
+
+
+def concat_chunks(chunks: List["pd.DataFrame"]) -> "pd.DataFrame":
+    """
+    Assemble chunks in a single concatenation. The categories of the categorical
+    columns are unified first, pandas would otherwise fall back to objects.
+
+    Args:
+        chunks (List[pandas.DataFrame]): The chunks, with the same columns.
+
+    Returns:
+        pandas.DataFrame: The concatenated chunks.
+    """
+    categorical = [
+        col
+        for col, dtype in chunks[0].dtypes.items()
+        if isinstance(dtype, pd.CategoricalDtype)
+    ]
+    for col in categorical:
+        categories = union_categoricals([chunk[col] for chunk in chunks]).categories
+        for chunk in chunks:
+            chunk[col] = chunk[col].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_spipoll_exports(
+    paths: List[str],
+    unused_vars: List[str],
+    chunksize: int = 100_000,
+    n_jobs: Optional[int] = None,
+) -> "pd.DataFrame":
+    """
+    Read the SPIPOLL exports concurrently, see read_export, and print the wall time
+    and the peak memory of the ingestion.
+
+    Args:
+        paths (List[str]): The export files.
+        unused_vars (List[str]): The columns that are not read.
+        chunksize (int, optional): The number of rows of the chunks.
+        n_jobs (int, optional): The number of files read at once. Defaults to one
+            thread per file.
+
+    Returns:
+        pandas.DataFrame: The rows of all the exports.
+    """
+    start = time.perf_counter()
+    # Threads, the parser releases the GIL and the chunks are not pickled
+    chunks = Parallel(n_jobs=n_jobs or len(paths), prefer="threads")(
+        delayed(read_export)(path, unused_vars, chunksize=chunksize) for path in paths
+    )
+    df_spipoll = concat_chunks([chunk for file_chunks in chunks for chunk in file_chunks])
+
+    print(f"Read {len(df_spipoll)} rows in {time.perf_counter() - start:.1f} s")
+    peak = peak_memory_mb()
+    if peak is not None:
+        print(f"Peak memory: {peak:.0f} MB")
+    return df_spipoll
@@ -1,3 +1,7 @@
+# Run from the root of the project:
+#     python -m data_quality.plant_treatment.plant_main
+import os
+
 import pandas as pd
 import nltk
 from nltk import ngrams
@@ -5,13 +9,19 @@ from nltk.corpus import stopwords
 from collections import Counter
 from tqdm import tqdm
 
-# Import spipoll.csv as a pandas dataframe
-spipoll = pd.read_csv("././data/spipoll.csv",low_memory=False)
-
-# Extract relevant columns from the spipoll dataframe
-plantes = spipoll[['collection_id', 'plante_sc', 'plante_fr',
+from data_quality.dataset import read_dataset
+
+# Import the relevant columns of the spipoll data written by run_data_quality.py,
+# the Parquet dataset data/temporary_data/spipoll or data/temporary_data/spipoll.csv
+# (only these columns are read). Without them, i.e. before run_data_quality.py,
+# data/spipoll.csv is read as before.
+path = "data/temporary_data/spipoll"
+if not (os.path.exists(path) or os.path.exists(path + ".csv")):
+    path = "data/spipoll.csv"
+plantes = read_dataset(path, columns=[
+       'collection_id', 'plante_sc', 'plante_fr',
        'plante_precision', 'plante_inconnue', 'plante_caractere',
-       'photo_fleur', 'photo_plante', 'photo_feuille']]
+       'photo_fleur', 'photo_plante', 'photo_feuille'])
 
 #--------------------------------------------------------------
 # shrinking the data in two phases
@@ -0,0 +1,125 @@
+import json
+
+import numpy as np
+
+# States of the cells of the grid index
+OUTSIDE, INSIDE, BOUNDARY = 0, 1, 2
+
+
+def _shapely():
+    """
+    Import shapely (>= 2.0), which is only needed for the boundary classification.
+    """
+    try:
+        import shapely
+    except ImportError as error:
+        raise ImportError(
+            "The boundary classification requires shapely >= 2.0 "
+            "(installed with geopandas)"
+        ) from error
+    return shapely
+
+
+class FranceBoundary:
+    """
+    Point-in-polygon classifier for the boundary of Metropolitan France.
+
+    The polygon is prepared, and a regular grid covering it is used as spatial
+    index: the cells entirely inside or outside of the polygon are classified once,
+    so only the points falling in the cells crossed by the boundary are tested
+    exactly against the polygon, with vectorized shapely calls.
+    """
+
+    def __init__(self, geometry, cell_size: float = 0.05) -> None:
+        """
+        Initializes the classifier.
+
+        Args:
+            geometry (shapely geometry): The (multi)polygon, in longitude/latitude.
+            cell_size (float, optional): The size of the cells of the grid index in
+            degrees. Defaults to 0.05.
+        """
+        shapely = _shapely()
+        self.geometry = geometry
+        self.cell_size = cell_size
+        shapely.prepare(self.geometry)
+
+        min_x, min_y, max_x, max_y = self.geometry.bounds
+        self.origin = (min_x, min_y)
+        self.shape = (
+            int(np.ceil((max_y - min_y) / cell_size)) or 1,
+            int(np.ceil((max_x - min_x) / cell_size)) or 1,
+        )
+        cell_y, cell_x = np.indices(self.shape).reshape(2, -1)
+        boxes = shapely.box(
+            min_x + cell_x * cell_size,
+            min_y + cell_y * cell_size,
+            min_x + (cell_x + 1) * cell_size,
+            min_y + (cell_y + 1) * cell_size,
+        )
+        self.cells = np.full(len(boxes), BOUNDARY, dtype=np.uint8)
+        self.cells[shapely.contains_properly(self.geometry, boxes)] = INSIDE
+        self.cells[shapely.disjoint(self.geometry, boxes)] = OUTSIDE
+        self.cells = self.cells.reshape(self.shape)
+
+    @classmethod
+    def from_file(cls, path: str, cell_size: float = 0.05) -> "FranceBoundary":
+        """
+        Load the polygon of a GeoJSON file, the union of its features, e.g. the
+        metropolitan départements or the contour of Metropolitan France.
+
+        Args:
+            path (str): The GeoJSON file, in longitude/latitude (WGS84).
+            cell_size (float, optional): The size of the cells of the grid index.
+
+        Returns:
+            FranceBoundary: The classifier.
+        """
+        shapely = _shapely()
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)
+        if data["type"] == "FeatureCollection":
+            geometries = [feature["geometry"] for feature in data["features"]]
+        elif data["type"] == "Feature":
+            geometries = [data["geometry"]]
+        else:
+            geometries = [data]
+        geometry = shapely.union_all(
+            [shapely.geometry.shape(geometry) for geometry in geometries]
+        )
+        return cls(geometry, cell_size=cell_size)
+
+    def contains(self, latitude, longitude) -> "np.ndarray":
+        """
+        Returns whether each point is inside the polygon.
+
+        Args:
+            latitude (array-like): The latitudes.
+            longitude (array-like): The longitudes.
+
+        Returns:
+            np.ndarray: The boolean flags, False for missing coordinates.
+        """
+        shapely = _shapely()
+        latitude = np.asarray(latitude, dtype=float)
+        longitude = np.asarray(longitude, dtype=float)
+        with np.errstate(invalid="ignore"):
+            cell_y = np.floor((latitude - self.origin[1]) / self.cell_size)
+            cell_x = np.floor((longitude - self.origin[0]) / self.cell_size)
+        in_grid = (
+            (cell_y >= 0)
+            & (cell_y < self.shape[0])
+            & (cell_x >= 0)
+            & (cell_x < self.shape[1])
+        )
+        states = np.full(len(latitude), OUTSIDE, dtype=np.uint8)
+        states[in_grid] = self.cells[
+            cell_y[in_grid].astype(np.int64), cell_x[in_grid].astype(np.int64)
+        ]
+
+        inside = states == INSIDE
+        boundary = np.flatnonzero(states == BOUNDARY)
+        inside[boundary] = shapely.contains_xy(
+            self.geometry, longitude[boundary], latitude[boundary]
+        )
+        return inside
@@ -1,6 +1,14 @@
+import numpy as np
 import pandas as pd
 from typing import Tuple
 
+# Northern-most, southern-most, western-most and eastern-most points of
+# Metropolitan France
+LATITUDE_NORD = 51.065
+LATITUDE_SUD = 42.19
+LONGITUDE_OUEST = -5.15
+LONGITUDE_EST = 9.325
+
 
 def postal_code_filter(
     df_spipoll: "pd.DataFrame", df_poste: "pd.DataFrame", save=False
@@ -24,21 +32,7 @@ def postal_code_filter(
         df_filter_metropole and df_filter_hors_metropole
         which have to be used to filter df_spipoll.
     """
-    df_filter = df_spipoll[
-        ["collection_id", "longitude", "latitude", "code_postal"]
-    ].copy()
-
-    # Get rid of the postal codes of overseas territories
-    df_poste = df_poste[["Code_postal"]].astype(str)
-    df_poste = df_poste[~df_poste["Code_postal"].str.startswith(("97", "98"))]
-
-    # Add a new column 'France metropolitaine' to df_spipoll with the data
-    # that are in df_poste
-    df_filter["France metropolitaine"] = df_filter["code_postal"].isin(
-        df_poste["Code_postal"]
-    )
-    # Keep only the first row for each collection_id
-    df_filter = df_filter.drop_duplicates(subset="collection_id", keep="first")
+    df_filter = _postal_code_flag(df_spipoll, df_poste)
 
     # Split df_filter into 2 dataframes whether the data are in metropolitan
     # France or not
@@ -56,13 +50,143 @@ def postal_code_filter(
     return df_filter_metropole, df_filter_hors_metropole
 
 
+def bbox_flag(latitude, longitude) -> "np.ndarray":
+    """
+    Returns whether each point is within the bounding box of Metropolitan France.
+
+    Args:
+        latitude (array-like): The latitudes.
+        longitude (array-like): The longitudes.
+
+    Returns:
+        np.ndarray: The boolean flags, False for missing coordinates.
+    """
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+    return (
+        (latitude > LATITUDE_SUD)
+        & (latitude < LATITUDE_NORD)
+        & (longitude > LONGITUDE_OUEST)
+        & (longitude < LONGITUDE_EST)
+    )
+
+
+def metropole_flag(df_filter: "pd.DataFrame", boundary=None) -> "np.ndarray":
+    """
+    Classify collections as in Metropolitan France or not, in one vectorized pass.
+
+    The coordinates decide when they are known, the postal code flag computed by
+    postal_code_filter otherwise.
+
+    Args:
+        df_filter (pandas.DataFrame): The collections, with columns "latitude",
+        "longitude" and "France metropolitaine".
+        boundary (FranceBoundary, optional): The exact boundary of Metropolitan
+        France, see boundary.FranceBoundary. Defaults to None (bounding box).
+
+    Returns:
+        np.ndarray: The boolean flags.
+    """
+    has_coordinates = (
+        df_filter["latitude"].notna() & df_filter["longitude"].notna()
+    ).to_numpy()
+    contains = bbox_flag if boundary is None else boundary.contains
+    return np.where(
+        has_coordinates,
+        contains(df_filter["latitude"], df_filter["longitude"]),
+        df_filter["France metropolitaine"].to_numpy(dtype=bool),
+    )
+
+
+def classify_collections(
+    df_spipoll: "pd.DataFrame", df_poste: "pd.DataFrame", save=False, boundary=None
+) -> "pd.DataFrame":
+    """
+    Classify the collections as in Metropolitan France or not, from their postal
+    code and coordinates, see metropole_flag.
+
+    Args:
+        df_spipoll (pandas.DataFrame): The input dataframe which must contain
+        columns "collection_id", "longitude", "latitude" and "code_postal".
+        df_poste (pandas.DataFrame): The input dataframe which must contain
+        columns with postal codes of metropolitan France.
+        save (bool): If True, the collections in and outside of Metropolitan
+        France are saved in the folder data/temporary_data.
+        boundary (FranceBoundary, optional): The exact boundary of Metropolitan
+        France, see metropole_flag. Defaults to None (bounding box).
+
+    Returns:
+        pandas.DataFrame: One row per collection, with the columns
+        "collection_id", "longitude", "latitude", "code_postal",
+        "France metropolitaine" (postal code flag) and "metropole".
+    """
+    df_filter = _postal_code_flag(df_spipoll, df_poste)
+    df_filter["metropole"] = metropole_flag(df_filter, boundary)
+
+    if save:
+        columns = ["longitude", "latitude", "collection_id"]
+        df_filter.loc[df_filter["metropole"], columns].to_csv(
+            "data/temporary_data/spipoll_metropole.csv", index=False
+        )
+        df_filter.loc[~df_filter["metropole"], columns].to_csv(
+            "data/temporary_data/spipoll_hors_metropole.csv", index=False
+        )
+    return df_filter
+
+
+def normalize_postal_codes(codes: "pd.Series") -> "pd.Series":
+    """
+    Normalise postal codes, the same way for the SPIPOLL data and the postal code
+    list: strings without spaces, and numeric codes of 1 to 4 digits (French codes
+    read as integers, e.g. 1000 for 01000) padded with zeros to 5 digits.
+
+    The 4 digit codes of the neighbouring countries (e.g. 1000 for Brussels) are
+    padded too, their coordinates are then the only way to tell them apart.
+
+    Args:
+        codes (pandas.Series): The postal codes, as strings or numbers.
+
+    Returns:
+        pandas.Series: The normalised codes, missing values stay missing.
+    """
+    codes = codes.astype("string").str.strip().str.replace(r"\.0$", "", regex=True)
+    short = codes.str.fullmatch(r"\d{1,4}").fillna(False).astype(bool)
+    return codes.mask(short, codes.str.zfill(5))
+
+
+def _postal_code_flag(
+    df_spipoll: "pd.DataFrame", df_poste: "pd.DataFrame"
+) -> "pd.DataFrame":
+    """
+    Returns the first row of each collection, with the column
+    "France metropolitaine" telling whether its postal code is a postal code of
+    Metropolitan France.
+    """
+    # Keep only the first row for each collection_id
+    df_filter = df_spipoll[
+        ["collection_id", "longitude", "latitude", "code_postal"]
+    ].drop_duplicates(subset="collection_id", keep="first")
+
+    # Get rid of the postal codes of overseas territories
+    codes = normalize_postal_codes(df_poste["Code_postal"]).dropna()
+    codes = codes[~codes.str.startswith(("97", "98"))].unique()
+
+    df_filter["France metropolitaine"] = (
+        normalize_postal_codes(df_filter["code_postal"]).isin(codes).to_numpy()
+    )
+    return df_filter
+
+
 def geo_filter(
-    df_spipoll_metropole, df_spipoll_hors_metropole, save=False
+    df_spipoll_metropole, df_spipoll_hors_metropole, save=False, boundary=None
 ) -> Tuple["pd.DataFrame", "pd.DataFrame"]:
     """
     Filters the given dataframes based on geographic coordinates to include
     only the data within Metropolitan France.
 
+    The rows are moved between the two dataframes according to metropole_flag,
+    prefer classify_collections which returns the flag instead.
+
     Args:
         df_spipoll_metropole (DataFrame): DataFrame containing data within
         Metropolitan France.
@@ -70,97 +194,27 @@ def geo_filter(
         outside of Metropolitan France.
         save (bool, optional): Flag indicating whether to save the filtered
         dataframes to CSV files. Defaults to False.
+        boundary (FranceBoundary, optional): The exact boundary of Metropolitan
+        France, see metropole_flag. Defaults to None (bounding box).
 
     Returns:
         Tuple[DataFrame, DataFrame]: A tuple containing the filtered DataFrame
         for Metropolitan France and the filtered DataFrame for outside of
         Metropolitan France.
     """
-    # Northern-most, southern-most, western-most and eastern-most points of
-    # Metropolitan France
-    latitude_nord = 51.065
-    latitude_sud = 42.19
-    longitude_ouest = -5.15
-    longitude_est = 9.325
-
-    # Select the columns "collection_id", "longitude" and "latitude" from
-    # df_spipoll_metropole and df_spipoll_hors_metropole
-    df_spipoll_metropole = df_spipoll_metropole[
-        ["longitude", "latitude", "collection_id"]
-    ].copy()
-    df_spipoll_hors_metropole = df_spipoll_hors_metropole[
-        ["longitude", "latitude", "collection_id"]
-    ].copy()
-
-    # Rows from df_spipoll_metropole that are outside of Metropolitan France :
-    # false positives
-    within_latitude_France_df = df_spipoll_metropole[
-        (df_spipoll_metropole["latitude"] > latitude_sud)
-        & (df_spipoll_metropole["latitude"] < latitude_nord)
-    ]
-    within_longitude_France_df = df_spipoll_metropole[
-        (df_spipoll_metropole["longitude"] > longitude_ouest)
-        & (df_spipoll_metropole["longitude"] < longitude_est)
-    ]
-
-    # Identify the rows in df_spipoll_metropole that are both in
-    # within_latitude_France_df and within_longitude_France_df
-    df_spipoll_hors_metropole.reset_index(drop=True, inplace=True)
-    within_France_df = within_latitude_France_df[
-        within_latitude_France_df["collection_id"].isin(
-            within_longitude_France_df["collection_id"]
-        )
-    ]
-
-    # Add to df_spipoll_hors_metropole the rows that are in
-    # df_spipoll_metropole but not in within_France_df
-    df_spipoll_hors_metropole = pd.concat(
+    columns = ["longitude", "latitude", "collection_id"]
+    df_filter = pd.concat(
         [
-            df_spipoll_hors_metropole,
-            df_spipoll_metropole[~df_spipoll_metropole.isin(within_France_df)].dropna(),
-        ]
+            df_spipoll_metropole[columns].assign(**{"France metropolitaine": True}),
+            df_spipoll_hors_metropole[columns].assign(
+                **{"France metropolitaine": False}
+            ),
+        ],
+        ignore_index=True,
     )
-
-    # Remove from df_spipoll_metropole the rows that are not in
-    # within_France_df
-    df_spipoll_metropole = df_spipoll_metropole[
-        df_spipoll_metropole.isin(within_France_df)
-    ].dropna()
-
-    # Rows from df_spipoll_hors_metropole that are inside of Metropolitan
-    # France : false negatives
-    within_latitude_France_df = df_spipoll_hors_metropole[
-        (df_spipoll_hors_metropole["latitude"] > latitude_sud)
-        & (df_spipoll_hors_metropole["latitude"] < latitude_nord)
-    ]
-    within_longitude_France_df = df_spipoll_hors_metropole[
-        (df_spipoll_hors_metropole["longitude"] > longitude_ouest)
-        & (df_spipoll_hors_metropole["longitude"] < longitude_est)
-    ]
-
-    # Identify the rows in df_spipoll_hors_metropole that are both in
-    # within_latitude_France_df and within_longitude_France_df
-    within_France_df = within_latitude_France_df[
-        within_latitude_France_df["collection_id"].isin(
-            within_longitude_France_df["collection_id"]
-        )
-    ]
-
-    # Add to df_spipoll_metropole the rows that are in within_France_df
-    df_spipoll_metropole = pd.concat(
-        [
-            df_spipoll_metropole,
-            df_spipoll_hors_metropole[
-                df_spipoll_hors_metropole.isin(within_France_df)
-            ].dropna(),
-        ]
-    )
-
-    # Remove from df_spipoll_hors_metropole the rows that are in
-    # within_France_df
-    df_spipoll_hors_metropole = df_spipoll_hors_metropole[
-        ~df_spipoll_hors_metropole.isin(within_France_df)
-    ].dropna()
+    flag = metropole_flag(df_filter, boundary)
+    df_spipoll_metropole = df_filter.loc[flag, columns]
+    df_spipoll_hors_metropole = df_filter.loc[~flag, columns]
     if save:
         df_spipoll_metropole.to_csv(
             "data/temporary_data/spipoll_metropole.csv", index=False
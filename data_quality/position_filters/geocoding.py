@@ -0,0 +1,208 @@
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+
+from .filters import normalize_postal_codes
+
+# Mean radius of the Earth, used to convert haversine angles to kilometres
+EARTH_RADIUS_KM = 6371.0088
+
+
+def postal_code_index(df_poste: "pd.DataFrame") -> "pd.DataFrame":
+    """
+    Index the postal codes of datagouv_codespostaux.csv, one row per postal code.
+
+    A postal code may serve several communes, counted by "n_communes": the commune
+    is then ambiguous and left missing. The département is the prefix of the INSEE
+    code of the communes (3 characters overseas, for the codes starting with 97 or
+    98, 2A/2B in Corsica), missing if they are in several départements.
+
+    Args:
+        df_poste (pandas.DataFrame): The postal codes, with columns
+        "#Code_commune_INSEE", "Nom_de_la_commune" and "Code_postal".
+
+    Returns:
+        pandas.DataFrame: Indexed by the postal code, with the columns
+        "departement", "code_commune", "nom_commune" and "n_communes".
+    """
+    communes = pd.DataFrame(
+        {
+            "code_postal": normalize_postal_codes(df_poste["Code_postal"]),
+            "code_commune": df_poste["#Code_commune_INSEE"].astype(str).str.zfill(5),
+            "nom_commune": df_poste["Nom_de_la_commune"].astype(str),
+        }
+    ).dropna(subset="code_postal").sort_values(["code_postal", "code_commune"])
+    communes["departement"] = communes["code_commune"].str[:2].where(
+        ~communes["code_commune"].str.startswith(("97", "98")),
+        communes["code_commune"].str[:3],
+    )
+    grouped = communes.groupby("code_postal", sort=True)
+    index = grouped[["departement", "code_commune", "nom_commune"]].first()
+    index["n_communes"] = grouped["code_commune"].nunique()
+    ambiguous = index["n_communes"] > 1
+    index.loc[ambiguous, ["code_commune", "nom_commune"]] = None
+    index.loc[grouped["departement"].nunique() > 1, "departement"] = None
+    return index
+
+
+def postal_code_centroids(
+    df_filter: "pd.DataFrame",
+    index: "pd.DataFrame",
+    max_distance_km: float = 30.0,
+    min_count: int = 1,
+    min_share: float = 0.5,
+) -> "pd.DataFrame":
+    """
+    Estimate the centroid of each postal code from the collections.
+
+    A first centroid is the median of the coordinates of the collections of the
+    postal code. The centroid is then the median of the collections within
+    max_distance_km of this first estimate only, and the postal codes whose
+    collections mostly lie further away (less than min_share of them within the
+    distance, e.g. a code entered at random) get no centroid.
+
+    The centroids only rely on the collections: a postal code entered wrongly but
+    consistently, at the same wrong place, gets a wrong centroid which validates
+    these collections. Pass reference centroids (e.g. of the communes of the
+    postal code) to reverse_geocode when they are available.
+
+    Args:
+        df_filter (pandas.DataFrame): The collections, with columns "code_postal",
+        "latitude" and "longitude".
+        index (pandas.DataFrame): The known postal codes, see postal_code_index.
+        max_distance_km (float, optional): The distance beyond which a collection
+        is not used for the centroid of its postal code. Defaults to 30.
+        min_count (int, optional): The minimum number of collections used for a
+        centroid. Defaults to 1.
+        min_share (float, optional): The minimum share of the collections of a
+        postal code used for its centroid. Defaults to 0.5.
+
+    Returns:
+        pandas.DataFrame: Indexed by the postal code, with the columns "latitude",
+        "longitude" and "count" (the number of collections used).
+    """
+    codes = normalize_postal_codes(df_filter["code_postal"])
+    known = (
+        codes.isin(index.index).to_numpy()
+        & df_filter["latitude"].notna().to_numpy()
+        & df_filter["longitude"].notna().to_numpy()
+    )
+    collections = pd.DataFrame(
+        {
+            "code_postal": codes[known].to_numpy(dtype=object),
+            "latitude": df_filter["latitude"].to_numpy(dtype=float)[known],
+            "longitude": df_filter["longitude"].to_numpy(dtype=float)[known],
+        }
+    )
+    grouped = collections.groupby("code_postal")
+    first = grouped[["latitude", "longitude"]].transform("median")
+    close = (
+        _haversine_km(
+            collections["latitude"],
+            collections["longitude"],
+            first["latitude"],
+            first["longitude"],
+        )
+        <= max_distance_km
+    ).to_numpy()
+
+    centroids = (
+        collections[close].groupby("code_postal")[["latitude", "longitude"]].median()
+    )
+    centroids["count"] = collections[close].groupby("code_postal").size()
+    share = centroids["count"] / grouped.size().reindex(centroids.index)
+    return centroids[(centroids["count"] >= min_count) & (share >= min_share)]
+
+
+def reverse_geocode(
+    df_filter: "pd.DataFrame",
+    df_poste: "pd.DataFrame",
+    centroids: "pd.DataFrame" = None,
+    max_distance_km: float = 30.0,
+) -> "pd.DataFrame":
+    """
+    Attach the département and the commune of each collection.
+
+    The postal code is looked up in the index of the postal codes. When it is
+    missing, unknown, without centroid, or its centroid is more than max_distance_km
+    away from the coordinates of the collection, the collection gets the postal code
+    of the nearest centroid instead, found with a haversine BallTree.
+
+    Args:
+        df_filter (pandas.DataFrame): The collections, with columns "code_postal",
+        "latitude" and "longitude", see classify_collections.
+        df_poste (pandas.DataFrame): The postal codes, see postal_code_index.
+        centroids (pandas.DataFrame, optional): The centroids of the postal codes,
+        indexed by postal code with columns "latitude" and "longitude". Defaults
+        to None (estimated from the collections, see postal_code_centroids and its
+        limitations).
+        max_distance_km (float, optional): The distance beyond which the postal
+        code is considered inconsistent with the coordinates. Defaults to 30.
+
+    Returns:
+        pandas.DataFrame: df_filter with the columns "departement",
+        "code_commune", "nom_commune", "n_communes" (the number of communes of
+        the postal code, the commune is missing when there are several) and
+        "geocodage" ("code_postal", "centroide", or missing when the collection
+        could not be located).
+    """
+    index = postal_code_index(df_poste)
+    if centroids is None:
+        centroids = postal_code_centroids(df_filter, index, max_distance_km)
+    # Centroids aligned on the rows of the index, NaN for the postal codes without
+    centroids = centroids.reindex(index.index)[["latitude", "longitude"]].to_numpy(
+        dtype=float
+    )
+
+    # Position of the postal code of each collection in the index, -1 if unknown
+    positions = index.index.get_indexer(
+        normalize_postal_codes(df_filter["code_postal"]).to_numpy(dtype=object)
+    )
+    latitude = df_filter["latitude"].to_numpy(dtype=float)
+    longitude = df_filter["longitude"].to_numpy(dtype=float)
+    has_coordinates = ~(np.isnan(latitude) | np.isnan(longitude))
+
+    # Distance between each collection and the centroid of its postal code
+    own = np.where((positions >= 0)[:, None], centroids[positions], np.nan)
+    distance = _haversine_km(latitude, longitude, own[:, 0], own[:, 1])
+    # The postal codes without centroid (e.g. entered at random) are not trusted
+    with np.errstate(invalid="ignore"):
+        inconsistent = has_coordinates & ~(distance <= max_distance_km)
+
+    method = np.where(positions >= 0, "code_postal", None).astype(object)
+    to_locate = np.flatnonzero(has_coordinates & ((positions < 0) | inconsistent))
+    with_centroid = np.flatnonzero(~np.isnan(centroids[:, 0]))
+    if len(to_locate) and len(with_centroid):
+        tree = BallTree(np.radians(centroids[with_centroid]), metric="haversine")
+        nearest = tree.query(
+            np.radians(np.column_stack([latitude, longitude])[to_locate]),
+            return_distance=False,
+        )[:, 0]
+        positions[to_locate] = with_centroid[nearest]
+        method[to_locate] = "centroide"
+
+    df_filter = df_filter.copy()
+    for col in ["departement", "code_commune", "nom_commune"]:
+        values = index[col].to_numpy(dtype=object)
+        df_filter[col] = np.where(positions >= 0, values[positions], None)
+    df_filter["n_communes"] = pd.Series(
+        index["n_communes"].to_numpy()[positions], index=df_filter.index, dtype="Int64"
+    ).mask(positions < 0)
+    df_filter["geocodage"] = method
+    return df_filter
+
+
+def _haversine_km(latitude_1, longitude_1, latitude_2, longitude_2) -> "np.ndarray":
+    """
+    Returns the great-circle distances in kilometres, NaN if a point is missing.
+    """
+    latitude_1, longitude_1, latitude_2, longitude_2 = map(
+        np.radians, (latitude_1, longitude_1, latitude_2, longitude_2)
+    )
+    a = (
+        np.sin((latitude_2 - latitude_1) / 2) ** 2
+        + np.cos(latitude_1)
+        * np.cos(latitude_2)
+        * np.sin((longitude_2 - longitude_1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
@@ -1,7 +1,12 @@
 import pandas as pd
-from position_filters.filters import postal_code_filter, geo_filter
+from data_quality.dataset import add_partition_col, write_dataset
+from data_quality.ingestion import read_spipoll_exports
+from data_quality.position_filters.boundary import FranceBoundary
+from data_quality.position_filters.filters import classify_collections
+from data_quality.position_filters.geocoding import reverse_geocode
 
 import os
+import warnings
 
 """
 Main script to:
@@ -9,6 +14,9 @@ Main script to:
 2. Select relevant data based for metropolitan France
 3. Apply quality processes on plants and insects data to add missing relevant 
 data
+
+Run from the root of the project:
+    python -m data_quality.run_data_quality
 """
 
 #####################################################################
@@ -30,47 +38,39 @@ unused_vars = [
     "date_update_bdd",
 ]
 
+raw_files = [
+    "data/raw_data/spipoll_1_200k_202311130947.txt",
+    "data/raw_data/spipoll_200k_400k_202311130949.txt",
+    "data/raw_data/spipoll_400k_200k_202311130959.txt",
+    "data/raw_data/spipoll_600k_75k_202311131020.txt",
+]
+
 # If save is True, the filtered dataframes will be saved
 # in the folder 'data/temporary_data'
 save = True
 
-if __name__ == "__main__":
-    # If this script is directly executed, then the working directory is
-    # the root of the project, it's for debug purpose.
-    if os.getcwd().endswith("data_quality"):
-        os.chdir("../")
+# The data are written as data/temporary_data/spipoll.csv, read by the notebooks,
+# or with "parquet" as a Parquet dataset partitioned by year in
+# data/temporary_data/spipoll (requires pyarrow, read it with dataset.read_dataset)
+output_format = "csv"
+
+# GeoJSON polygon of Metropolitan France, in WGS84, e.g. metropole.geojson of
+# https://github.com/gregoiredavid/france-geojson or the metropolitan
+# départements of IGN ADMIN EXPRESS (see the README). If the file is missing,
+# the collections are classified with the bounding box of Metropolitan France,
+# which also keeps the observations of the neighbouring countries.
+boundary_file = "data/governmental_data/metropole.geojson"
 
 #####################################################################
 # 1. Agregate data from the SPIPOLL project
 #####################################################################
 
-# Read the txt data of the 4 files in the folder 'data'
+# Read the txt data of the 4 files in the folder 'data', concurrently and by
+# chunks, without the unused variables. The column "coordonnees_GPS" is
+# separated into 2 columns "latitude" and "longitude" in each chunk.
 print("\n - Reading the txt files... \n")
-df1 = pd.read_csv("data/raw_data/spipoll_1_200k_202311130947.txt", sep="\t")
-df2 = pd.read_csv("data/raw_data/spipoll_200k_400k_202311130949.txt", sep="\t")
-df_spipoll = pd.concat([df1, df2])
-del df1, df2
-
-df3 = pd.read_csv("data/raw_data/spipoll_400k_200k_202311130959.txt", sep="\t")
-df_spipoll = pd.concat([df_spipoll, df3])
-del df3
-
-df4 = pd.read_csv("data/raw_data/spipoll_600k_75k_202311131020.txt", sep="\t")
-df_spipoll = pd.concat([df_spipoll, df4])
-del df4
-
-# Separate the column "coordonnees_GPS" into 2 columns "latitude" and
-# "longitude"
-df_spipoll[["latitude", "longitude"]] = (
-    df_spipoll["coordonnees_GPS"].str.split(", ", expand=True).astype(float)
-)
-df_spipoll = df_spipoll.drop(columns=["coordonnees_GPS"])
-
-# Remove variables that will never be used in the project
-df_spipoll = df_spipoll.drop(columns=unused_vars)
-
-if save:
-    df_spipoll.to_csv("data/temporary_data/spipoll.csv", index=False)
+df_spipoll = read_spipoll_exports(raw_files, unused_vars)
+df_spipoll = add_partition_col(df_spipoll)
 
 #####################################################################
 # 2. Select relevant data based for metropolitan France
@@ -79,22 +79,42 @@ if save:
 # Apply filters to get which data are in metropolitan France and which are not
 print("\n - Applying filters...\n")
 df_poste = pd.read_csv("data/governmental_data/datagouv_codespostaux.csv",
-                       sep=";")
-metropole_collections, non_metropole_collections = postal_code_filter(
-    df_spipoll, df_poste
-)
-metropole_collections, non_metropole_collections = geo_filter(
-    metropole_collections, non_metropole_collections, save=save
-)
-
-# Once the data are filtered, we can remove the rows
+                       sep=";", dtype={"Code_postal": str,
+                                       "#Code_commune_INSEE": str})
+if os.path.exists(boundary_file):
+    boundary = FranceBoundary.from_file(boundary_file)
+else:
+    boundary = None
+    warnings.warn(
+        f"{boundary_file} not found, the collections are classified with the "
+        "bounding box of Metropolitan France instead of its boundary (see the "
+        "README to get the file)"
+    )
+collections = classify_collections(df_spipoll, df_poste, save=save,
+                                   boundary=boundary)
+
+# Once the collections are classified, we can remove the rows
 # that are not in metropolitan France
-rows_to_remove = df_spipoll["collection_id"].isin(
-    non_metropole_collections["collection_id"]
+metropole_ids = collections.loc[collections["metropole"], "collection_id"]
+df_spipoll = df_spipoll[df_spipoll["collection_id"].isin(metropole_ids)]
+
+# Attach the département and the commune of each collection, from its postal
+# code or, when it is missing or inconsistent, from the nearest postal code
+print("\n - Reverse geocoding...\n")
+geocoded = reverse_geocode(collections[collections["metropole"]], df_poste)
+df_spipoll = df_spipoll.merge(
+    geocoded[["collection_id", "departement", "code_commune", "nom_commune",
+              "n_communes", "geocodage"]],
+    on="collection_id",
+    how="left",
 )
-df_spipoll = df_spipoll[~rows_to_remove]
 
-df_spipoll.to_csv("data/temporary_data/spipoll.csv", index=False)
+write_dataset(
+    df_spipoll,
+    "data/temporary_data/spipoll"
+    + (".csv" if output_format == "csv" else ""),
+    format=output_format,
+)
 
 #####################################################################
 # 3. Apply quality processes on plants and insects data to add missing
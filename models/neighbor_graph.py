@@ -0,0 +1,252 @@
+"""
+neighbor_graph.py
+
+Compressed sparse row (CSR) neighbor graph between locations. The graph can be
+saved to disk and memory-mapped back, so that the neighbor search is done once and
+shared between metric runs, model retrains and clustering notebooks.
+"""
+
+import hashlib
+import os
+from typing import Callable, List, Optional, Union
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.neighbors import BallTree, KDTree
+
+
+class NeighborGraph:
+    """
+    Neighbors of each node stored as CSR arrays: the neighbors of node i are
+    indices[indptr[i]:indptr[i + 1]], at the distances stored at the same positions.
+    """
+
+    def __init__(
+        self,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        distances: Optional[np.ndarray] = None,
+    ) -> None:
+        """
+        Initializes a NeighborGraph object.
+
+        Args:
+            indptr (np.ndarray): Start of the neighbors of each node, followed by the total size.
+            indices (np.ndarray): Neighbor nodes, node by node.
+            distances (np.ndarray, optional): Distance to each neighbor. Defaults to None.
+        """
+        self.indptr = indptr
+        self.indices = indices
+        self.distances = distances
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    def neighbors(self, node: int) -> np.ndarray:
+        """
+        Returns the neighbors of a node.
+
+        Args:
+            node (int): The node.
+
+        Returns:
+            np.ndarray: The neighbor nodes.
+        """
+        return self.indices[self.indptr[node] : self.indptr[node + 1]]
+
+    def slice(self, start: int, end: int) -> "NeighborGraph":
+        """
+        Returns the graph restricted to the neighbors of the nodes start to end - 1.
+
+        The neighbor indices are not renumbered, only indptr is rebased.
+
+        Args:
+            start (int): The first node.
+            end (int): The node after the last node.
+
+        Returns:
+            NeighborGraph: The sliced graph.
+        """
+        first, last = self.indptr[start], self.indptr[end]
+        return NeighborGraph(
+            np.asarray(self.indptr[start : end + 1]) - first,
+            self.indices[first:last],
+            None if self.distances is None else self.distances[first:last],
+        )
+
+    def to_csr_matrix(self) -> "csr_matrix":
+        """
+        Returns the graph as a scipy sparse matrix of distances, which can be used
+        with the estimators accepting a precomputed sparse neighbors graph, such as
+        DBSCAN(metric="precomputed").
+
+        Returns:
+            csr_matrix: The sparse distance matrix.
+        """
+        if self.distances is None:
+            raise ValueError("The graph was built without distances")
+        n_nodes = max(len(self), int(self.indices.max()) + 1 if len(self.indices) else 0)
+        return csr_matrix(
+            (self.distances, self.indices, self.indptr), shape=(len(self), n_nodes)
+        )
+
+    def save(self, path: str) -> None:
+        """
+        Save the arrays of the graph as .npy files in a directory.
+
+        Args:
+            path (str): The directory, created if needed.
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "indices.npy"), self.indices)
+        if self.distances is not None:
+            np.save(os.path.join(path, "distances.npy"), self.distances)
+        # Saved last, so that an existing indptr means the graph is complete
+        np.save(os.path.join(path, "indptr.npy"), self.indptr)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: Optional[str] = "r") -> "NeighborGraph":
+        """
+        Load a graph saved with save, memory-mapping its arrays by default.
+
+        Args:
+            path (str): The directory of the graph.
+            mmap_mode (str, optional): The numpy memory-map mode. Defaults to "r".
+
+        Returns:
+            NeighborGraph: The loaded graph.
+        """
+        distances_path = os.path.join(path, "distances.npy")
+        return cls(
+            np.load(os.path.join(path, "indptr.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, "indices.npy"), mmap_mode=mmap_mode),
+            np.load(distances_path, mmap_mode=mmap_mode)
+            if os.path.exists(distances_path)
+            else None,
+        )
+
+
+def query_neighbor_graph(
+    tree: Union[KDTree, BallTree],
+    queries: np.ndarray,
+    radius: float,
+    candidates: Optional[np.ndarray] = None,
+    return_distance: bool = False,
+) -> "NeighborGraph":
+    """
+    Build the graph linking each query to the indexed points within the radius.
+
+    Args:
+        tree (KDTree or BallTree): The spatial index.
+        queries (np.ndarray): Coordinates of the queries.
+        radius (float): The radius of the neighborhoods, included.
+        candidates (np.ndarray, optional): Node of each indexed point, when the tree
+            only indexes a subset of the nodes. Defaults to None.
+        return_distance (bool, optional): Whether to store the distances. Defaults to False.
+
+    Returns:
+        NeighborGraph: The neighbors of each query.
+    """
+    if return_distance:
+        neighborhoods, distances = tree.query_radius(
+            queries, r=radius, return_distance=True
+        )
+        distances = np.concatenate(distances) if len(queries) else np.zeros(0)
+    else:
+        neighborhoods = tree.query_radius(queries, r=radius)
+        distances = None
+    sizes = np.array([len(indices) for indices in neighborhoods], dtype=np.int64)
+    indptr = np.concatenate([[0], np.cumsum(sizes)])
+    indices = np.concatenate(neighborhoods) if len(queries) else np.zeros(0, int)
+    if candidates is not None:
+        indices = candidates[indices]
+    return NeighborGraph(_compact_indptr(indptr), indices.astype(np.int32), distances)
+
+
+def concatenate_graphs(graphs: List["NeighborGraph"]) -> "NeighborGraph":
+    """
+    Stack the nodes of several graphs.
+
+    Args:
+        graphs (List[NeighborGraph]): The graphs, in node order.
+
+    Returns:
+        NeighborGraph: The stacked graph.
+    """
+    sizes = np.concatenate([np.diff(graph.indptr) for graph in graphs])
+    indptr = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+    distances = None
+    if all(graph.distances is not None for graph in graphs):
+        distances = np.concatenate([graph.distances for graph in graphs])
+    return NeighborGraph(
+        _compact_indptr(indptr),
+        np.concatenate([graph.indices for graph in graphs]).astype(np.int32),
+        distances,
+    )
+
+
+def filter_graph(
+    graph: "NeighborGraph", owners: np.ndarray, keep: np.ndarray
+) -> "NeighborGraph":
+    """
+    Remove edges from a graph.
+
+    Args:
+        graph (NeighborGraph): The graph.
+        owners (np.ndarray): The node of each edge.
+        keep (np.ndarray): Boolean mask of the edges to keep.
+
+    Returns:
+        NeighborGraph: The filtered graph.
+    """
+    sizes = np.bincount(owners[keep], minlength=len(graph))
+    return NeighborGraph(
+        _compact_indptr(np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])),
+        graph.indices[keep],
+        None if graph.distances is None else graph.distances[keep],
+    )
+
+
+def graph_key(coordinates: np.ndarray, **params) -> str:
+    """
+    Returns a hash identifying the graph of the given coordinates and parameters.
+
+    Args:
+        coordinates (np.ndarray): The coordinates of the nodes.
+        **params: The parameters of the neighbor search, e.g. the radius.
+
+    Returns:
+        str: The hexadecimal hash.
+    """
+    digest = hashlib.sha1(np.ascontiguousarray(coordinates).tobytes())
+    digest.update(repr(sorted(params.items())).encode())
+    return digest.hexdigest()
+
+
+def cached_neighbor_graph(
+    cache_dir: str, key: str, build: Callable[[], "NeighborGraph"]
+) -> "NeighborGraph":
+    """
+    Load the graph stored under the key in the cache directory, or build and store it.
+
+    Args:
+        cache_dir (str): The cache directory.
+        key (str): The key of the graph, see graph_key.
+        build (Callable[[], NeighborGraph]): Builds the graph when it is not cached.
+
+    Returns:
+        NeighborGraph: The memory-mapped graph.
+    """
+    path = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(path, "indptr.npy")):
+        build().save(path)
+    return NeighborGraph.load(path)
+
+
+def _compact_indptr(indptr: np.ndarray) -> np.ndarray:
+    """
+    Store indptr as int32 unless the graph has too many edges.
+    """
+    if indptr[-1] <= np.iinfo(np.int32).max:
+        return indptr.astype(np.int32)
+    return indptr.astype(np.int64)
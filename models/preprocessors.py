@@ -4,16 +4,34 @@ preprocessors.py
 TODO: Add description
 """
 
-from typing import Dict, List
+import glob
+import os
+import tempfile
+from typing import Dict, List, Optional, Union
 
 import numpy as np
 import pandas as pd
-from sklearn.base import BaseEstimator, TransformerMixin
+from joblib import Parallel, delayed
+from scipy.sparse import csr_matrix, hstack
+from sklearn.base import BaseEstimator, TransformerMixin, clone
 from sklearn.model_selection import train_test_split
+from sklearn.neighbors import BallTree, KDTree
 from tqdm import tqdm
 
+from models.neighbor_graph import (NeighborGraph, cached_neighbor_graph,
+                                   concatenate_graphs, filter_graph,
+                                   graph_key, query_neighbor_graph)
+from models.sketches import SketchGrid, hash_values, hll_precision
+
 tqdm.pandas()
 
+# Mean radius of the Earth, used to convert kilometres to haversine angles
+EARTH_RADIUS_KM = 6371.0088
+NANOSECONDS_PER_MINUTE = 60 * 10**9
+NANOSECONDS_PER_DAY = 24 * 60 * NANOSECONDS_PER_MINUTE
+# Julian day of the Unix epoch, 1970-01-01 00:00
+JULIAN_DAY_EPOCH = 2440587.5
+
 
 class MetricsCalculatorNaive(BaseEstimator, TransformerMixin):
     """
@@ -142,6 +160,1384 @@ class MetricsCalculatorNaive(BaseEstimator, TransformerMixin):
         return metrics
 
 
+class MetricsCalculator(BaseEstimator, TransformerMixin):
+    """
+    Calculates the same metrics as MetricsCalculatorNaive using a spatial index.
+
+    The coordinates are stored in a KD-tree using the Chebyshev distance, so that a
+    radius query returns exactly the points of the square box used by the naive
+    approach. Rows sharing the same coordinates (e.g. the insects of a collection)
+    have the same neighborhood, so the queries are only run once per location and
+    the results are broadcast back to the rows.
+
+    The locations are queried by chunks, which can be processed in parallel. The
+    large read-only arrays (tree, integer codes) are memory-mapped by joblib and
+    shared between the workers, and the chunks are gathered back in order. The
+    chunks are split so that they do not expand more than max_neighbors neighbor
+    rows at once, which bounds the memory of a worker in dense areas.
+
+    Several distances can be given at once: each chunk is queried with the largest
+    one and the smaller neighborhoods are filtered from its results.
+
+    With metric="haversine", the neighborhoods are disks on the Earth whose radius
+    is the distance in kilometres, and the coordinates are stored in a ball-tree.
+
+    With a time window, only the observations close in time are neighbors. The rows
+    are partitioned into time buckets and each bucket gets its own spatial index,
+    built over the buckets it can reach.
+
+    The neighbors are searched between distinct locations and stored as a CSR
+    neighbor graph, which can be persisted in graph_cache and reused by later runs
+    on the same locations (see neighbor_graph.py).
+
+    With keep_state, the distinct codes of each neighborhood are kept so that new
+    observations can be added with update, which only visits the neighborhoods
+    containing a new observation.
+
+    For files which do not fit in memory, transform_tiled computes the metrics tile
+    by tile, each tile being loaded with a halo as wide as the distance.
+
+    With approximate=True, the neighborhoods are approximated by the grid cells
+    covering them. Each cell holds its number of observations and HyperLogLog
+    sketches of its insects and collections, merged at query time, so that the
+    cost of a query does not depend on the number of observations around it (see
+    sketches.py).
+    """
+
+    def __init__(
+        self,
+        distance: Union[float, List[float]],
+        insect_col: str = "insecte_fr",
+        collection_id_col: str = "collection_id",
+        compute_unique_insects: bool = True,
+        compute_density: bool = True,
+        compute_weighted_specific_richness: bool = True,
+        clear_intermediate_steps: bool = True,
+        n_jobs: Optional[int] = None,
+        chunk_size: int = 1000,
+        max_neighbors: int = 1_000_000,
+        metric: str = "box",
+        time_col: str = "collection_heure_debut",
+        time_window: Optional[Union[float, str]] = None,
+        graph_cache: Optional[str] = None,
+        keep_state: bool = False,
+        approximate: bool = False,
+        sketch_error: float = 0.02,
+        cell_size: Optional[float] = None,
+    ) -> None:
+        """
+        Initializes a MetricsCalculator object.
+
+        Args:
+            distance (float or List[float]): The distance value. With a list of distances,
+                the metrics of each distance are computed in a single neighbor search and
+                the columns are suffixed by the distance, e.g. "density_d0.5".
+            insect_col (str, optional): The column name for the insect. Defaults to "insecte_fr".
+            collection_id_col (str, optional): The column name for the collection ID. Defaults to "collection_id".
+            compute_unique_insects (bool, optional): Whether to calculate unique insects. Defaults to True.
+            compute_density (bool, optional): Whether to calculate density. Defaults to True.
+            compute_weighted_specific_richness (bool, optional): Whether to compute collection ID density. Defaults to True.
+            clear_intermediate_steps (bool, optional): Whether to clear the intermediate columns. Defaults to True.
+            n_jobs (int, optional): The number of processes used to query the chunks, -1 means all the cores. Defaults to None (one process).
+            chunk_size (int, optional): The maximum number of locations queried per chunk. Defaults to 1000.
+            max_neighbors (int, optional): The maximum number of neighbor rows expanded at once
+                in a chunk, the chunks of dense areas are split accordingly (a single location
+                with more neighbors is processed alone). Defaults to 1000000.
+            metric (str, optional): "box" for a square of half-side distance in degrees, or
+                "haversine" for a disk of radius distance in kilometres. Defaults to "box".
+            time_col (str, optional): The column name for the observation time. Defaults to "collection_heure_debut".
+            time_window (float or str, optional): Maximum time difference in days between neighbors, or
+                "year" to only keep the observations of the same year. Defaults to None (no time window).
+            graph_cache (str, optional): Directory where the neighbor graphs are stored and reused. Defaults to None (no cache).
+            keep_state (bool, optional): Whether to keep the distinct codes of each neighborhood, which
+                allows to add new observations with update. Defaults to False.
+            approximate (bool, optional): Whether to estimate the metrics from grid cell sketches
+                instead of exact neighborhoods. Defaults to False.
+            sketch_error (float, optional): Relative standard error of the distinct counts of the
+                sketches in approximate mode. Defaults to 0.02.
+            cell_size (float, optional): Size of the grid cells in degrees in approximate mode.
+                Defaults to None (a quarter of the smallest distance).
+        """
+        self.distance = distance
+        self.insect_col = insect_col
+        self.collection_id_col = collection_id_col
+        self.compute_unique_insects = compute_unique_insects
+        self.compute_density = compute_density
+        self.compute_weighted_specific_richness = compute_weighted_specific_richness
+        self.clear_intermediate_steps = clear_intermediate_steps
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.max_neighbors = max_neighbors
+        self.metric = metric
+        self.time_col = time_col
+        self.time_window = time_window
+        self.graph_cache = graph_cache
+        self.keep_state = keep_state
+        self.approximate = approximate
+        self.sketch_error = sketch_error
+        self.cell_size = cell_size
+
+    def fit(self, X: pd.DataFrame, y=None) -> "MetricsCalculator":
+        """Fit the transformer. This is a placeholder method as this transformer doesn't need to be fitted.
+
+        Args:
+            X (DataFrame): The input data.
+            y (Series, optional): The target data. Defaults to None.
+
+        Returns:
+            self
+        """
+        return self
+
+    def transform(self, X: pd.DataFrame) -> "pd.DataFrame":
+        """
+        Transforms the input data by calculating metrics.
+
+        With keep_state, the neighborhood state needed by update is stored in the
+        state_ attribute.
+
+        Args:
+            X (pandas.DataFrame): The input data.
+
+        Returns:
+            pandas.DataFrame: The transformed data with calculated metrics.
+        """
+        self._check_time_window()
+        if self.approximate:
+            return self._transform_approximate(X)
+        print("Calculating metrics:\n--------------------\n")
+        locations, inverse = self._locations(X)
+        row_order, row_ptr = group_rows(inverse, len(locations))
+
+        # Factorize the columns once, missing values are coded -1 and ignored
+        # like in pandas nunique
+        insect_codes, insect_categories = pd.factorize(X[self.insect_col])
+        collection_codes, collection_categories = pd.factorize(
+            X[self.collection_id_col]
+        )
+
+        if self.graph_cache is None:
+            chunks = [
+                delayed(self._process_chunk)(
+                    *task[1:],
+                    row_order,
+                    row_ptr,
+                    insect_codes,
+                    collection_codes,
+                    return_codes=self.keep_state,
+                )
+                for task in tqdm(list(self._query_tasks(locations)))
+            ]
+        else:
+            graph = self.neighbor_graph(X, locations=locations)
+            bounds = size_chunks(
+                np.diff(graph.indptr), self.chunk_size, self.max_neighbors
+            )
+            chunks = [
+                delayed(self._calculate_chunk)(
+                    graph.slice(start, end),
+                    row_order,
+                    row_ptr,
+                    insect_codes,
+                    collection_codes,
+                    return_codes=self.keep_state,
+                )
+                for start, end in tqdm(list(zip(bounds[:-1], bounds[1:])))
+            ]
+        chunks_metrics = Parallel(n_jobs=self.n_jobs)(chunks)
+        if self.keep_state:
+            chunks_metrics, chunks_codes = zip(*chunks_metrics)
+        metrics = {
+            key: np.concatenate([chunk[key] for chunk in chunks_metrics])
+            for key in self._metric_names()
+        }
+        if self.keep_state:
+            self.state_ = {
+                "locations": locations,
+                "insect_categories": pd.Index(insect_categories),
+                "collection_categories": pd.Index(collection_categories),
+                "counts": {
+                    key: values
+                    for key, values in metrics.items()
+                    if not key.startswith("weighted_specific_richness")
+                },
+                "codes": {
+                    key: np.concatenate([chunk[key] for chunk in chunks_codes])
+                    for key in chunks_codes[0]
+                },
+            }
+
+        return self._assign_metrics(X, metrics, inverse)
+
+    def _transform_approximate(self, X: pd.DataFrame) -> "pd.DataFrame":
+        """
+        Transforms the input data by estimating the metrics from grid cell sketches.
+
+        Args:
+            X (pandas.DataFrame): The input data.
+
+        Returns:
+            pandas.DataFrame: The transformed data with estimated metrics.
+        """
+        if self.time_window is not None:
+            raise ValueError("The approximate mode does not support time windows")
+        print("Estimating metrics:\n--------------------\n")
+        coordinates = X[["latitude", "longitude"]].to_numpy(dtype=float)
+        locations, inverse = np.unique(coordinates, axis=0, return_inverse=True)
+        distances = self._distances()
+
+        cell_size = self.cell_size
+        if cell_size is None:
+            cell_size = np.min(self._halo(0.0, min(distances.values()))[0]) / 4
+        precision = hll_precision(self.sketch_error)
+        grids = {}
+        for name, col in [
+            ("specific_richness", self.insect_col),
+            ("collection_id_density", self.collection_id_col),
+        ]:
+            grids[name] = SketchGrid(cell_size, precision).fit(
+                coordinates[:, 0],
+                coordinates[:, 1],
+                hash_values(X[col]),
+                valid=X[col].notna().to_numpy(),
+            )
+
+        # Each grid is queried once per distance, for all the locations
+        metrics = {}
+        latitude, longitude = locations[:, 0], locations[:, 1]
+        for suffix, distance in tqdm(list(distances.items())):
+            halo_latitude, halo_longitude = self._halo(latitude, distance)
+            estimates = {}
+            for name, grid in grids.items():
+                counts, estimates[name] = grid.query(
+                    latitude, longitude, halo_latitude, halo_longitude
+                )
+            estimates["density"] = counts
+            estimates["weighted_specific_richness"] = (
+                estimates["specific_richness"] / estimates["collection_id_density"]
+            )
+            for name in self._base_metric_names():
+                metrics[name + suffix] = estimates[name]
+        return self._assign_metrics(X, metrics, inverse.ravel())
+
+    def update(self, X: pd.DataFrame, X_new: pd.DataFrame) -> "pd.DataFrame":
+        """
+        Add new observations to data already transformed with keep_state, and update
+        the metrics without recomputing the neighborhoods from scratch.
+
+        Only the neighbors of the new locations are searched. The locations which
+        did not exist get their metrics computed, the existing locations within
+        the radius of a new location get the new rows added to their state
+        (density, and distinct codes of their neighborhood), and the others are
+        left untouched.
+
+        Args:
+            X (pandas.DataFrame): The data given to the last transform or update.
+            X_new (pandas.DataFrame): The new observations.
+
+        Returns:
+            pandas.DataFrame: The concatenated data with updated metrics.
+        """
+        if not hasattr(self, "state_"):
+            raise ValueError("transform must be called with keep_state=True first")
+        self._check_time_window()
+        if len(X_new) == 0:
+            # Nothing to update, the state is unchanged. The empty batch gets the
+            # columns and dtypes of X, so that the metrics are not upcast
+            X_new = X_new.reindex(columns=X.columns.union(X_new.columns, sort=False))
+            return pd.concat([X, X_new.astype(X.dtypes.to_dict())])
+        print("Updating metrics:\n--------------------\n")
+        state = self.state_
+        data = pd.concat([X, X_new])
+        locations, inverse = self._locations(data)
+        n_old = len(state["locations"])
+
+        # Positions of the previous locations among the current ones
+        matched = np.unique(
+            np.concatenate([locations, state["locations"]]), axis=0, return_inverse=True
+        )[1].ravel()
+        old_positions = matched[len(locations) :]
+        is_old = np.zeros(len(locations), dtype=bool)
+        is_old[old_positions] = True
+
+        insect_codes, insect_categories = encode(
+            data[self.insect_col], state["insect_categories"]
+        )
+        collection_codes, collection_categories = encode(
+            data[self.collection_id_col], state["collection_categories"]
+        )
+
+        # The neighborhoods are symmetric: the locations whose neighborhood
+        # contains a new row are the neighbors of the new locations
+        new_rows = np.arange(len(X), len(data))
+        new_locations = np.unique(inverse[new_rows])
+        graph = concatenate_graphs(
+            [
+                self._query_chunk(*task[1:], return_distance=True)
+                for task in tqdm(list(self._query_tasks(locations, new_locations)))
+            ]
+        )
+        affected = np.unique(graph.indices)
+        created = affected[~is_old[affected]]
+        updated = affected[is_old[affected]]
+
+        # Locations which did not exist: full computation
+        row_order, row_ptr = group_rows(inverse, len(locations))
+        created_chunks = [
+            self._process_chunk(
+                *task[1:],
+                row_order,
+                row_ptr,
+                insect_codes,
+                collection_codes,
+                return_codes=True,
+            )
+            for task in self._query_tasks(locations, created)
+        ]
+
+        # Existing locations: the new rows are added to their state
+        edge_sources = np.repeat(new_locations, np.diff(graph.indptr))
+        edge_targets = np.asarray(graph.indices)
+        edge_distances = np.asarray(graph.distances)
+        keep = is_old[edge_targets]
+        order = np.argsort(edge_targets[keep], kind="stable")
+        edge_sources = edge_sources[keep][order]
+        edge_owners = np.searchsorted(updated, edge_targets[keep][order])
+        edge_distances = edge_distances[keep][order]
+        new_row_order, new_row_ptr = group_rows(
+            inverse[new_rows], len(locations)
+        )
+        rows, repeats = expand_groups(edge_sources, new_rows[new_row_order], new_row_ptr)
+        owners = np.repeat(edge_owners, repeats)
+        distances = np.repeat(edge_distances, repeats)
+
+        # Previous state, indexed by the current locations
+        counts = {}
+        codes = {}
+        for key, values in state["counts"].items():
+            counts[key] = np.zeros(len(locations), dtype=np.int64)
+            counts[key][old_positions] = values
+        for key, values in state["codes"].items():
+            code_owners = old_positions[np.repeat(np.arange(n_old), state["counts"][key])]
+            codes[key] = (code_owners, values)
+
+        for suffix, radius in self._radii().items():
+            keep = distances <= radius
+            suffix_owners, suffix_rows = owners[keep], rows[keep]
+            if "density" + suffix in counts:
+                counts["density" + suffix][updated] += np.bincount(
+                    suffix_owners, minlength=len(updated)
+                )
+            for name, column_codes in [
+                ("specific_richness", insect_codes),
+                ("collection_id_density", collection_codes),
+            ]:
+                key = name + suffix
+                if key not in codes:
+                    continue
+                code_owners, values = codes[key]
+                previous = np.isin(code_owners, updated)
+                # Union of the previous distinct codes and of the new codes
+                merged_owners = np.concatenate(
+                    [np.searchsorted(updated, code_owners[previous]), suffix_owners]
+                )
+                merged_codes = np.concatenate(
+                    [values[previous], column_codes[suffix_rows]]
+                )
+                counts[key][updated], updated_codes = distinct_pairs(
+                    merged_owners, merged_codes, len(updated)
+                )
+                created_codes = [chunk[1][key] for chunk in created_chunks]
+                counts[key][created] = np.concatenate(
+                    [chunk[0][key] for chunk in created_chunks] or [np.zeros(0, int)]
+                )
+                codes[key] = (
+                    np.concatenate(
+                        [
+                            code_owners[~previous],
+                            np.repeat(updated, counts[key][updated]),
+                            np.repeat(created, counts[key][created]),
+                        ]
+                    ),
+                    np.concatenate(
+                        [values[~previous], updated_codes] + created_codes
+                    ),
+                )
+            if "density" + suffix in counts:
+                counts["density" + suffix][created] = np.concatenate(
+                    [chunk[0]["density" + suffix] for chunk in created_chunks]
+                    or [np.zeros(0, int)]
+                )
+
+        # Codes stored location after location
+        for key, (code_owners, values) in codes.items():
+            codes[key] = values[np.argsort(code_owners, kind="stable")]
+
+        self.state_ = {
+            "locations": locations,
+            "insect_categories": insect_categories,
+            "collection_categories": collection_categories,
+            "counts": counts,
+            "codes": codes,
+        }
+        metrics = {}
+        for key in self._metric_names():
+            if key.startswith("weighted_specific_richness"):
+                suffix = key[len("weighted_specific_richness") :]
+                metrics[key] = (
+                    counts["specific_richness" + suffix]
+                    / counts["collection_id_density" + suffix]
+                )
+            else:
+                metrics[key] = counts[key]
+        return self._assign_metrics(data, metrics, inverse)
+
+    def transform_tiled(
+        self,
+        input_path: str,
+        output_path: str,
+        tile_size: float = 1.0,
+        chunksize: int = 100_000,
+        tmp_dir: Optional[str] = None,
+        **read_csv_kwargs,
+    ) -> None:
+        """
+        Calculate the metrics of a CSV file too large to fit in memory, tile by tile.
+
+        The file is read by chunks and its rows are split into square tiles of
+        tile_size degrees, each tile also receiving the rows of a halo as wide as
+        the largest distance around it. Each tile is then loaded and transformed
+        alone, and the metrics of its own rows are written in a memory-mapped array.
+        Finally the file is read again by chunks and written with the metrics, in
+        the same order. Peak memory thus depends on the tile size and the chunk
+        size, and the metrics are the ones of transform on the whole file.
+
+        Args:
+            input_path (str): The input CSV file.
+            output_path (str): The output CSV file.
+            tile_size (float, optional): The size of the tiles in degrees. Defaults to 1.0.
+            chunksize (int, optional): The number of rows read at once. Defaults to 100_000.
+            tmp_dir (str, optional): Directory of the temporary tile files. Defaults to None (system default).
+            **read_csv_kwargs: Additional arguments of pandas.read_csv.
+        """
+        self._check_time_window()
+        calculator = clone(self).set_params(
+            clear_intermediate_steps=False, keep_state=False, graph_cache=None
+        )
+        metric_names = self._metric_names()
+        columns = ["latitude", "longitude", self.insect_col, self.collection_id_col]
+        if self.time_window is not None:
+            columns.append(self.time_col)
+
+        with tempfile.TemporaryDirectory(dir=tmp_dir) as tiles_dir:
+            print("Splitting in tiles:\n--------------------\n")
+            n_rows = 0
+            reader = pd.read_csv(
+                input_path, usecols=columns, chunksize=chunksize, **read_csv_kwargs
+            )
+            for chunk in tqdm(reader):
+                chunk["row"] = np.arange(n_rows, n_rows + len(chunk))
+                n_rows += len(chunk)
+                self._write_tiles(chunk, tile_size, tiles_dir)
+
+            print("Calculating metrics by tile:\n--------------------\n")
+            metrics = np.lib.format.open_memmap(
+                os.path.join(tiles_dir, "metrics.npy"),
+                mode="w+",
+                shape=(n_rows, len(metric_names)),
+            )
+            for tile_file in tqdm(sorted(glob.glob(os.path.join(tiles_dir, "tile_*.csv")))):
+                tile = pd.read_csv(tile_file, **read_csv_kwargs)
+                tile = calculator.transform(tile)
+                tile = tile[tile["core"]]
+                metrics[tile["row"].to_numpy()] = tile[metric_names].to_numpy(dtype=float)
+            metrics.flush()
+
+            print("Writing metrics:\n--------------------\n")
+            start = 0
+            reader = pd.read_csv(input_path, chunksize=chunksize, **read_csv_kwargs)
+            for chunk in tqdm(reader):
+                values = metrics[start : start + len(chunk)]
+                for i, key in enumerate(metric_names):
+                    chunk[key] = (
+                        values[:, i]
+                        if key.startswith("weighted_specific_richness")
+                        else values[:, i].astype(np.int64)
+                    )
+                chunk = self._drop_intermediate_steps(chunk)
+                chunk.to_csv(
+                    output_path,
+                    mode="w" if start == 0 else "a",
+                    header=start == 0,
+                    index=False,
+                )
+                start += len(chunk)
+            del metrics
+
+    def _write_tiles(self, chunk: pd.DataFrame, tile_size: float, tiles_dir: str) -> None:
+        """
+        Append the rows of a chunk to the files of their tile and of the tiles whose
+        halo they are in, with a core column telling whether the tile is their own.
+
+        Args:
+            chunk (pandas.DataFrame): The rows, with a row column.
+            tile_size (float): The size of the tiles in degrees.
+            tiles_dir (str): The directory of the tile files.
+        """
+        latitude = chunk["latitude"].to_numpy(dtype=float)
+        longitude = chunk["longitude"].to_numpy(dtype=float)
+        halo_latitude, halo_longitude = self._halo(latitude, float(np.max(self.distance)))
+
+        first_y = np.floor((latitude - halo_latitude) / tile_size).astype(int)
+        last_y = np.floor((latitude + halo_latitude) / tile_size).astype(int)
+        first_x = np.floor((longitude - halo_longitude) / tile_size).astype(int)
+        last_x = np.floor((longitude + halo_longitude) / tile_size).astype(int)
+        own_y = np.floor(latitude / tile_size).astype(int)
+        own_x = np.floor(longitude / tile_size).astype(int)
+
+        for dy in range(int((last_y - first_y).max()) + 1):
+            for dx in range(int((last_x - first_x).max()) + 1):
+                tile_y, tile_x = first_y + dy, first_x + dx
+                mask = (tile_y <= last_y) & (tile_x <= last_x)
+                part = chunk[mask].assign(
+                    core=(tile_y == own_y)[mask] & (tile_x == own_x)[mask]
+                )
+                for (y, x), rows in part.groupby([tile_y[mask], tile_x[mask]]):
+                    tile_file = os.path.join(tiles_dir, f"tile_{y}_{x}.csv")
+                    rows.to_csv(
+                        tile_file,
+                        mode="a",
+                        header=not os.path.exists(tile_file),
+                        index=False,
+                    )
+
+    def _halo(self, latitude: np.ndarray, distance: float):
+        """
+        Returns the largest latitude and longitude differences in degrees between a
+        point and its neighbors.
+
+        Args:
+            latitude (np.ndarray): The latitudes of the points.
+            distance (float): The distance, in degrees or kilometres for haversine.
+
+        Returns:
+            Tuple[float or np.ndarray, float or np.ndarray]: The latitude and longitude differences.
+        """
+        if self.metric != "haversine":
+            return distance, distance
+        angle = distance / EARTH_RADIUS_KM
+        halo_latitude = np.degrees(angle)
+        ratio = np.sin(angle) / np.cos(np.radians(latitude))
+        halo_longitude = np.where(
+            (ratio < 1) & (np.abs(latitude) + halo_latitude < 90),
+            np.degrees(np.arcsin(np.clip(ratio, 0, 1))),
+            180.0,
+        )
+        return halo_latitude, halo_longitude
+
+    def _assign_metrics(
+        self, X: pd.DataFrame, metrics: Dict[str, np.ndarray], inverse: np.ndarray
+    ) -> "pd.DataFrame":
+        """
+        Add the metrics of the locations to the rows, and drop the intermediate
+        columns if required.
+
+        Args:
+            X (pandas.DataFrame): The input data.
+            metrics (dict): The metrics of each location.
+            inverse (np.ndarray): The location of each row.
+
+        Returns:
+            pandas.DataFrame: The data with the metrics.
+        """
+        for key, values in metrics.items():
+            X[key] = values[inverse]
+        return self._drop_intermediate_steps(X)
+
+    def _drop_intermediate_steps(self, X: pd.DataFrame) -> "pd.DataFrame":
+        """
+        Drop the intermediate metric columns if clear_intermediate_steps is set.
+
+        Args:
+            X (pandas.DataFrame): The data with the metrics.
+
+        Returns:
+            pandas.DataFrame: The data without the intermediate columns.
+        """
+        if self.clear_intermediate_steps:
+            columns_to_drop = [
+                name + suffix
+                for suffix in self._radii()
+                for name in ["specific_richness", "density", "collection_id_density"]
+            ]
+            columns_to_drop = [col for col in columns_to_drop if col in X.columns]
+            X = X.drop(columns=columns_to_drop)
+        return X
+
+    def neighbor_graph(
+        self, X: pd.DataFrame, locations: Optional[np.ndarray] = None
+    ) -> "NeighborGraph":
+        """
+        Returns the neighbor graph between the distinct locations of the data, for
+        the largest distance and with the distances to the neighbors.
+
+        When graph_cache is set, the graph is stored in this directory under a hash
+        of the locations and of the search parameters, and memory-mapped back, so
+        that later runs on the same data skip the neighbor search.
+
+        Args:
+            X (pandas.DataFrame): The input data.
+            locations (np.ndarray, optional): The locations of the data, as returned
+                by _locations. Defaults to None (computed from X).
+
+        Returns:
+            NeighborGraph: The neighbors of each location.
+        """
+        if locations is None:
+            locations = self._locations(X)[0]
+
+        def build() -> "NeighborGraph":
+            graphs = Parallel(n_jobs=self.n_jobs)(
+                delayed(self._query_chunk)(*task[1:], return_distance=True)
+                for task in tqdm(list(self._query_tasks(locations)))
+            )
+            return concatenate_graphs(graphs)
+
+        if self.graph_cache is None:
+            return build()
+        key = graph_key(
+            locations,
+            radius=float(max(self._radii().values())),
+            metric=self.metric,
+            time_window=self.time_window,
+        )
+        return cached_neighbor_graph(self.graph_cache, key, build)
+
+    def _locations(self, X: pd.DataFrame):
+        """
+        Returns the distinct locations of the data and the location of each row.
+
+        Without time window, a location is a pair of coordinates (in radians for
+        haversine). With a time window, a location is (time bucket, time,
+        coordinates) so that the locations of a bucket are contiguous.
+
+        Args:
+            X (pandas.DataFrame): The input data.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The locations and the location of each row.
+        """
+        coordinates = X[["latitude", "longitude"]].to_numpy(dtype=float)
+        if self.metric == "haversine":
+            coordinates = np.radians(coordinates)
+        elif self.metric != "box":
+            raise ValueError(f"Unknown metric: {self.metric}")
+        if self.time_window is not None:
+            times, buckets = self._time_buckets(X)
+            coordinates = np.column_stack([buckets, times, coordinates])
+        locations, inverse = np.unique(coordinates, axis=0, return_inverse=True)
+        return locations, inverse.ravel()
+
+    def _build_tree(self, coordinates: np.ndarray) -> Union[KDTree, BallTree]:
+        """
+        Build the spatial index of the given coordinates for the chosen metric.
+
+        Args:
+            coordinates (np.ndarray): Latitudes and longitudes, in radians for haversine.
+
+        Returns:
+            KDTree or BallTree: The spatial index.
+        """
+        if self.metric == "haversine":
+            return BallTree(coordinates, metric="haversine")
+        return KDTree(coordinates, metric="chebyshev")
+
+    def _query_tasks(
+        self, locations: np.ndarray, positions: Optional[np.ndarray] = None
+    ):
+        """
+        Yield the chunks of locations to query, in location order.
+
+        Without time window, all the locations are indexed in a single tree. With
+        a time window, the locations are processed bucket by bucket and one tree is
+        built over the locations of the buckets reachable from each bucket, so that
+        a query only visits the locations that are close in time.
+
+        The chunks have at most chunk_size locations, and are split further so that
+        their neighborhoods, counted beforehand with the tree, hold at most
+        max_neighbors locations.
+
+        Each task holds the positions of its locations followed by the arguments
+        of _query_chunk.
+
+        Args:
+            locations (np.ndarray): The locations, see _locations.
+            positions (np.ndarray, optional): The sorted positions of the locations to
+                query. Defaults to None (all the locations).
+        """
+        if positions is None:
+            positions = np.arange(len(locations))
+        radius = max(self._radii().values())
+
+        def split(tree, positions, queries):
+            # Chunks of chunk_size locations, split by the size of their neighborhoods
+            for start in range(0, len(positions), self.chunk_size):
+                chunk = slice(start, start + self.chunk_size)
+                sizes = tree.query_radius(queries[chunk], r=radius, count_only=True)
+                bounds = size_chunks(sizes, self.chunk_size, self.max_neighbors) + start
+                for first, last in zip(bounds[:-1], bounds[1:]):
+                    yield positions[first:last]
+
+        if self.time_window is None:
+            tree = self._build_tree(locations)
+            for chunk in split(tree, positions, locations[positions]):
+                yield chunk, tree, locations[chunk]
+            return
+
+        buckets = locations[:, 0]
+        reach = 0 if self.time_window == "year" else 1
+        for bucket in np.unique(buckets[positions]):
+            first = np.searchsorted(buckets, bucket - reach, side="left")
+            last = np.searchsorted(buckets, bucket + reach, side="right")
+            candidates = np.arange(first, last)
+            tree = self._build_tree(locations[candidates, 2:])
+            bucket_positions = positions[buckets[positions] == bucket]
+            for chunk in split(tree, bucket_positions, locations[bucket_positions, 2:]):
+                yield (
+                    chunk,
+                    tree,
+                    locations[chunk, 2:],
+                    candidates,
+                    locations[chunk, 1],
+                    locations[candidates, 1],
+                )
+
+    def _time_buckets(self, X: pd.DataFrame):
+        """
+        Compute the time of each row and the time bucket used to index it.
+
+        With a number of days, the time is in seconds (exact for second-resolution
+        timestamps) and the buckets are as wide as the window, so the neighbors of
+        a row lie in its bucket or the adjacent ones. With "year", the time is the
+        year and the buckets are the years.
+
+        Args:
+            X (pandas.DataFrame): The input data.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The times and the buckets of the rows.
+        """
+        dates = as_datetime(X[self.time_col])
+        if dates.isna().any():
+            raise ValueError(f"Missing values in {self.time_col}")
+        if self.time_window == "year":
+            times = dates.dt.year.to_numpy(dtype=float)
+            return times, times
+        seconds = dates.to_numpy(dtype="datetime64[s]").astype(np.int64).astype(float)
+        return seconds, np.floor(seconds / self._time_window_seconds())
+
+    def _check_time_window(self) -> None:
+        """
+        Raises a ValueError if time_window is not None, "year" or a positive number.
+        """
+        if self.time_window is None or (
+            isinstance(self.time_window, str) and self.time_window == "year"
+        ):
+            return
+        if (
+            isinstance(self.time_window, (int, float, np.integer, np.floating))
+            and not isinstance(self.time_window, bool)
+            and self.time_window > 0
+        ):
+            return
+        raise ValueError(
+            f"time_window must be None, 'year' or a positive number of days, "
+            f"got {self.time_window!r}"
+        )
+
+    def _time_window_seconds(self) -> float:
+        """
+        Returns the time window in seconds.
+        """
+        return self.time_window * 86400.0
+
+    def _radii(self) -> Dict[str, float]:
+        """
+        Returns the radius of the index query for each distance, keyed by the suffix
+        of its metric columns, see _distances.
+
+        In box mode, the naive approach keeps strictly closer points while the
+        KD-tree keeps points up to the radius included, so the radius is the float
+        just below the distance. In haversine mode, the radius is an angle in radians.
+
+        Returns:
+            dict: The radius of each column suffix.
+        """
+        if self.metric == "haversine":
+            return {
+                suffix: distance / EARTH_RADIUS_KM
+                for suffix, distance in self._distances().items()
+            }
+        return {
+            suffix: np.nextafter(distance, 0)
+            for suffix, distance in self._distances().items()
+        }
+
+    def _distances(self) -> Dict[str, float]:
+        """
+        Returns the distances from the largest to the smallest, keyed by the suffix
+        of their metric columns. A single distance gives unsuffixed columns.
+
+        Returns:
+            dict: The distance of each column suffix.
+        """
+        if np.ndim(self.distance) == 0:
+            return {"": self.distance}
+        return {
+            f"_d{distance:g}": distance for distance in sorted(self.distance, reverse=True)
+        }
+
+    def _metric_names(self) -> List[str]:
+        """
+        Returns the names of the metric columns, with the suffix of each distance.
+
+        Returns:
+            List[str]: The metric column names.
+        """
+        return [
+            name + suffix
+            for suffix in self._radii()
+            for name in self._base_metric_names()
+        ]
+
+    def _base_metric_names(self) -> List[str]:
+        """
+        Returns the names of the metrics to calculate, in the naive approach order.
+
+        Returns:
+            List[str]: The metric names.
+        """
+        names = []
+        if self.compute_unique_insects or self.compute_weighted_specific_richness:
+            names.append("specific_richness")
+        if self.compute_density:
+            names.append("density")
+        if self.compute_weighted_specific_richness:
+            names += ["collection_id_density", "weighted_specific_richness"]
+        return names
+
+    def _query_chunk(
+        self,
+        tree: Union[KDTree, BallTree],
+        queries: np.ndarray,
+        candidates: Optional[np.ndarray] = None,
+        query_times: Optional[np.ndarray] = None,
+        times: Optional[np.ndarray] = None,
+        return_distance: bool = False,
+    ) -> "NeighborGraph":
+        """
+        Query the neighbor locations of a chunk of locations.
+
+        The index is queried with the largest radius, and the distances are kept
+        when several distances are computed so that the smaller neighborhoods can
+        be filtered from the results.
+
+        Args:
+            tree (KDTree or BallTree): The spatial index of the candidate locations.
+            queries (np.ndarray): Coordinates of the locations of the chunk.
+            candidates (np.ndarray, optional): Location of each indexed point. Defaults to None (all).
+            query_times (np.ndarray, optional): Times of the locations of the chunk.
+            times (np.ndarray, optional): Times of the candidate locations.
+            return_distance (bool, optional): Whether to always keep the distances. Defaults to False.
+
+        Returns:
+            NeighborGraph: The neighbors of each location of the chunk.
+        """
+        radii = self._radii()
+        graph = query_neighbor_graph(
+            tree,
+            queries,
+            max(radii.values()),
+            candidates=candidates,
+            return_distance=return_distance or len(radii) > 1,
+        )
+        if times is not None and self.time_window != "year":
+            # The candidates are a contiguous range of locations
+            owners = np.repeat(np.arange(len(queries)), np.diff(graph.indptr))
+            neighbor_times = times[graph.indices - candidates[0]]
+            keep = (
+                np.abs(neighbor_times - query_times[owners])
+                <= self._time_window_seconds()
+            )
+            graph = filter_graph(graph, owners, keep)
+        return graph
+
+    def _process_chunk(self, *args, return_codes: bool = False):
+        """
+        Query the neighbor locations of a chunk of locations and calculate their
+        metrics. The arguments are the ones of _query_chunk followed by the ones of
+        _calculate_chunk after the graph.
+
+        Returns:
+            dict: The calculated metrics, one value per location, see _calculate_chunk.
+        """
+        *query_args, row_order, row_ptr, insect_codes, collection_codes = args
+        graph = self._query_chunk(*query_args)
+        return self._calculate_chunk(
+            graph,
+            row_order,
+            row_ptr,
+            insect_codes,
+            collection_codes,
+            return_codes=return_codes,
+        )
+
+    def _calculate_chunk(
+        self,
+        graph: "NeighborGraph",
+        row_order: np.ndarray,
+        row_ptr: np.ndarray,
+        insect_codes: np.ndarray,
+        collection_codes: np.ndarray,
+        return_codes: bool = False,
+    ):
+        """
+        Calculate the metrics of a chunk of locations from their neighbor locations.
+
+        The neighbor locations are expanded into the rows observed at these
+        locations, then the metrics are calculated for each distance. The locations
+        are processed by batches expanding at most max_neighbors rows.
+
+        Args:
+            graph (NeighborGraph): The neighbor locations of the chunk.
+            row_order (np.ndarray): The rows sorted by location.
+            row_ptr (np.ndarray): Start of the rows of each location in row_order.
+            insect_codes (np.ndarray): Integer codes of the insect column.
+            collection_codes (np.ndarray): Integer codes of the collection ID column.
+            return_codes (bool, optional): Whether to also return the distinct codes. Defaults to False.
+
+        Returns:
+            dict: The calculated metrics, one value per location. With return_codes, also
+            the distinct codes of the neighborhoods of each distinct count.
+        """
+        indptr = np.asarray(graph.indptr)
+        neighbors = np.asarray(graph.indices)
+        # Number of neighbor rows of each location
+        rows_ptr = np.concatenate(
+            [[0], np.cumsum(row_ptr[neighbors + 1] - row_ptr[neighbors])]
+        )
+        bounds = size_chunks(
+            rows_ptr[indptr[1:]] - rows_ptr[indptr[:-1]], len(graph), self.max_neighbors
+        )
+        results = [
+            self._calculate_batch(
+                graph.slice(start, end),
+                row_order,
+                row_ptr,
+                insect_codes,
+                collection_codes,
+                return_codes=return_codes,
+            )
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        if len(results) <= 1:
+            return (
+                results[0]
+                if results
+                else self._calculate_batch(
+                    graph,
+                    row_order,
+                    row_ptr,
+                    insect_codes,
+                    collection_codes,
+                    return_codes=return_codes,
+                )
+            )
+        batches_metrics, batches_codes = (
+            zip(*results) if return_codes else (results, [{}])
+        )
+        metrics = {
+            key: np.concatenate([batch[key] for batch in batches_metrics])
+            for key in batches_metrics[0]
+        }
+        if return_codes:
+            codes = {
+                key: np.concatenate([batch[key] for batch in batches_codes])
+                for key in batches_codes[0]
+            }
+            return metrics, codes
+        return metrics
+
+    def _calculate_batch(
+        self,
+        graph: "NeighborGraph",
+        row_order: np.ndarray,
+        row_ptr: np.ndarray,
+        insect_codes: np.ndarray,
+        collection_codes: np.ndarray,
+        return_codes: bool = False,
+    ):
+        """
+        Calculate the metrics of a batch of locations, see _calculate_chunk.
+        """
+        radii = self._radii()
+        n_locations = len(graph)
+        neighbors = np.asarray(graph.indices)
+        owners = np.repeat(np.arange(n_locations), np.diff(graph.indptr))
+        rows, repeats = expand_groups(neighbors, row_order, row_ptr)
+        owners = np.repeat(owners, repeats)
+        if len(radii) > 1:
+            distances = np.repeat(np.asarray(graph.distances), repeats)
+
+        metrics = {}
+        codes = {}
+        for suffix, radius in radii.items():
+            if len(radii) > 1:
+                keep = distances <= radius
+                owners, rows, distances = owners[keep], rows[keep], distances[keep]
+            result = self._calculate_metrics(
+                owners,
+                rows,
+                n_locations,
+                insect_codes,
+                collection_codes,
+                return_codes=return_codes,
+            )
+            chunk_metrics, chunk_codes = result if return_codes else (result, {})
+            metrics.update({key + suffix: value for key, value in chunk_metrics.items()})
+            codes.update({key + suffix: value for key, value in chunk_codes.items()})
+        if return_codes:
+            return metrics, codes
+        return metrics
+
+    def _calculate_metrics(
+        self,
+        owners: np.ndarray,
+        indices: np.ndarray,
+        n_neighborhoods: int,
+        insect_codes: np.ndarray,
+        collection_codes: np.ndarray,
+        return_codes: bool = False,
+    ):
+        """
+        Calculate metrics for a batch of neighborhoods.
+
+        Args:
+            owners (np.ndarray): The neighborhood of each neighbor, sorted.
+            indices (np.ndarray): Positions of the neighbors in the data.
+            n_neighborhoods (int): The number of neighborhoods.
+            insect_codes (np.ndarray): Integer codes of the insect column.
+            collection_codes (np.ndarray): Integer codes of the collection ID column.
+            return_codes (bool, optional): Whether to also return the distinct codes. Defaults to False.
+
+        Returns:
+            dict: The calculated metrics, one value per neighborhood. With return_codes,
+            also the distinct codes of the neighborhoods of each distinct count.
+        """
+        metrics = {}
+        codes = {}
+
+        def distinct(key: str, values: np.ndarray) -> None:
+            result = count_distinct(
+                owners, values, n_neighborhoods, return_codes=return_codes
+            )
+            if return_codes:
+                metrics[key], codes[key] = result
+            else:
+                metrics[key] = result
+
+        if self.compute_unique_insects or self.compute_weighted_specific_richness:
+            distinct("specific_richness", insect_codes[indices])
+
+        if self.compute_density:
+            metrics["density"] = np.bincount(owners, minlength=n_neighborhoods)
+
+        if self.compute_weighted_specific_richness:
+            distinct("collection_id_density", collection_codes[indices])
+            metrics["weighted_specific_richness"] = (
+                metrics["specific_richness"] / metrics["collection_id_density"]
+            )
+
+        if return_codes:
+            return metrics, codes
+        return metrics
+
+
+def group_rows(groups: np.ndarray, n_groups: int):
+    """
+    Sort the rows by group.
+
+    Args:
+        groups (np.ndarray): The group of each row, between 0 and n_groups - 1.
+        n_groups (int): The number of groups.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The rows sorted by group, and the start of the
+        rows of each group in this order followed by the number of rows.
+    """
+    row_order = np.argsort(groups, kind="stable")
+    row_ptr = np.concatenate([[0], np.cumsum(np.bincount(groups, minlength=n_groups))])
+    return row_order, row_ptr
+
+
+def size_chunks(sizes: np.ndarray, max_count: int, max_size: int) -> np.ndarray:
+    """
+    Split consecutive items into chunks of at most max_count items whose sizes sum
+    to at most max_size. An item larger than max_size is alone in its chunk.
+
+    Args:
+        sizes (np.ndarray): The size of each item.
+        max_count (int): The maximum number of items of a chunk.
+        max_size (int): The maximum total size of a chunk.
+
+    Returns:
+        np.ndarray: The start of each chunk, followed by the number of items.
+    """
+    ends = np.cumsum(sizes)
+    bounds = [0]
+    while bounds[-1] < len(ends):
+        start = bounds[-1]
+        offset = ends[start - 1] if start else 0
+        stop = np.searchsorted(ends, offset + max_size, side="right")
+        bounds.append(min(max(stop, start + 1), start + max_count))
+    return np.array(bounds)
+
+
+def expand_groups(groups: np.ndarray, row_order: np.ndarray, row_ptr: np.ndarray):
+    """
+    Replace each group by its rows.
+
+    Args:
+        groups (np.ndarray): The groups to expand.
+        row_order (np.ndarray): The rows sorted by group, see group_rows.
+        row_ptr (np.ndarray): Start of the rows of each group, see group_rows.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The rows of the groups, group after group, and
+        the number of rows of each group.
+    """
+    starts = row_ptr[groups]
+    repeats = row_ptr[groups + 1] - starts
+    offsets = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    return row_order[np.repeat(starts, repeats) + offsets], repeats
+
+
+def count_distinct(
+    owners: np.ndarray,
+    codes: np.ndarray,
+    n_groups: int,
+    max_cells: int = 2**24,
+    return_codes: bool = False,
+):
+    """
+    Count the distinct non-negative codes of each group.
+
+    The codes of each group are scattered into a boolean presence table of shape
+    (groups, codes) which is then summed row-wise. The groups are processed in
+    batches so that the table never has more than max_cells cells.
+
+    Args:
+        owners (np.ndarray): The group of each code, sorted, between 0 and n_groups - 1.
+        codes (np.ndarray): Integer codes, negative codes are ignored.
+        n_groups (int): The number of groups.
+        max_cells (int, optional): The maximum size of the presence table. Defaults to 2**24.
+        return_codes (bool, optional): Whether to also return the distinct codes. Defaults to False.
+
+    Returns:
+        np.ndarray: The number of distinct codes of each group. With return_codes, also
+        the distinct codes of each group, group after group, in increasing order.
+    """
+    counts = np.zeros(n_groups, dtype=np.int64)
+    distinct = []
+    valid = codes >= 0
+    if valid.any():
+        owners, codes = owners[valid], codes[valid]
+        n_codes = int(codes.max()) + 1
+        batch_size = max(1, max_cells // n_codes)
+        bounds = np.searchsorted(owners, np.arange(0, n_groups + batch_size, batch_size))
+        for batch, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            first_group = batch * batch_size
+            if start == end or first_group >= n_groups:
+                continue
+            n_batch_groups = min(batch_size, n_groups - first_group)
+            seen = np.zeros((n_batch_groups, n_codes), dtype=bool)
+            seen[owners[start:end] - first_group, codes[start:end]] = True
+            counts[first_group : first_group + n_batch_groups] = seen.sum(axis=1)
+            if return_codes:
+                distinct.append(np.nonzero(seen)[1])
+    if return_codes:
+        distinct = np.concatenate(distinct) if distinct else np.zeros(0, dtype=np.int64)
+        return counts, distinct
+    return counts
+
+
+def distinct_pairs(owners: np.ndarray, codes: np.ndarray, n_groups: int):
+    """
+    Count the distinct non-negative codes of each group by sorting (group, code)
+    pairs, which is cheaper than count_distinct when there are few codes per group
+    compared to the number of possible codes.
+
+    Args:
+        owners (np.ndarray): The group of each code, between 0 and n_groups - 1.
+        codes (np.ndarray): Integer codes, negative codes are ignored.
+        n_groups (int): The number of groups.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The number of distinct codes of each group, and
+        the distinct codes of each group, group after group, in increasing order.
+    """
+    valid = codes >= 0
+    n_codes = int(codes[valid].max()) + 1 if valid.any() else 1
+    pairs = np.sort(owners[valid].astype(np.int64) * n_codes + codes[valid])
+    first = np.ones(len(pairs), dtype=bool)
+    first[1:] = pairs[1:] != pairs[:-1]
+    pairs = pairs[first]
+    return np.bincount(pairs // n_codes, minlength=n_groups), pairs % n_codes
+
+
+def encode(values: pd.Series, categories: pd.Index):
+    """
+    Encode values as integer codes of a vocabulary, appending the unseen values to it.
+
+    Args:
+        values (pd.Series): The values, missing values are coded -1.
+        categories (pd.Index): The known values, the code of a value is its position.
+
+    Returns:
+        Tuple[np.ndarray, pd.Index]: The codes and the extended vocabulary.
+    """
+    codes, uniques = pd.factorize(values)
+    positions = categories.get_indexer(uniques)
+    unseen = positions == -1
+    positions[unseen] = np.arange(len(categories), len(categories) + unseen.sum())
+    categories = categories.append(pd.Index(uniques[unseen]))
+    return np.where(codes >= 0, positions[codes], -1), categories
+
+
+class TreeKNNImputer(BaseEstimator, TransformerMixin):
+    """
+    Nearest neighbors imputation backed by KD-trees, a scalable alternative to
+    KNNImputer, whose brute force distances are quadratic in the number of rows.
+
+    As with KNNImputer, the donors of a feature are the training rows where it is
+    observed, the distances are nan-euclidean (computed on the features observed
+    in both rows, scaled by their number), the missing value is the mean of the
+    k nearest donors, or the mean of the feature when no donor shares an observed
+    feature with the row, and the features without any observed value during fit
+    are dropped.
+
+    The donors are grouped by missing pattern, and the rows sharing the same missing
+    pattern are imputed together: a KD-tree is built for each group of donors on the
+    features observed in both patterns, queried by chunks, and the k nearest donors
+    of each feature are selected among the groups where it is observed. The cost is
+    O(n log n) per pair of missing patterns and the memory is bounded by the chunk
+    size.
+    """
+
+    def __init__(self, n_neighbors: int = 5, chunk_size: int = 10_000) -> None:
+        """
+        Initialize the TreeKNNImputer transformer.
+
+        Args:
+            n_neighbors (int, optional): The number of donors averaged. Defaults to 5.
+            chunk_size (int, optional): The number of rows queried at once. Defaults to 10000.
+
+        Returns:
+            None
+        """
+        self.n_neighbors = n_neighbors
+        self.chunk_size = chunk_size
+
+    def fit(self, X, y=None) -> "TreeKNNImputer":
+        """
+        Store the donors grouped by missing pattern, and the mean of each feature for
+        the rows without any donor.
+
+        Args:
+            X (array-like): The numeric features, with NaN for the missing values.
+            y: Ignored.
+
+        Returns:
+            self (TreeKNNImputer): The fitted transformer.
+        """
+        X = np.asarray(X, dtype=float)
+        missing = np.isnan(X)
+        self.n_features_in_ = X.shape[1]
+        self.valid_features_ = ~missing.all(axis=0)
+        self.fit_X_ = X
+        self.patterns_, pattern_of_rows = np.unique(
+            missing, axis=0, return_inverse=True
+        )
+        self.pattern_rows_ = [
+            np.flatnonzero(pattern_of_rows.ravel() == index)
+            for index in range(len(self.patterns_))
+        ]
+        with np.errstate(invalid="ignore"):
+            self.means_ = np.nanmean(X, axis=0)
+        return self
+
+    def transform(self, X) -> np.ndarray:
+        """
+        Impute the missing values.
+
+        Args:
+            X (array-like): The numeric features, with NaN for the missing values.
+
+        Returns:
+            np.ndarray: The imputed features, without the features dropped in fit.
+        """
+        X = np.array(X, dtype=float)
+        missing = np.isnan(X) & self.valid_features_
+        incomplete = np.flatnonzero(missing.any(axis=1))
+        if len(incomplete) == 0:
+            return X[:, self.valid_features_]
+
+        patterns, pattern_of_rows = np.unique(
+            np.isnan(X[incomplete]), axis=0, return_inverse=True
+        )
+        for pattern_index, pattern in enumerate(patterns):
+            rows = incomplete[pattern_of_rows.ravel() == pattern_index]
+            targets = np.flatnonzero(pattern & self.valid_features_)
+            # Donor groups sharing observed features with the rows, and the
+            # features they observe among those to impute
+            groups = []
+            for donor_pattern, donor_rows in zip(self.patterns_, self.pattern_rows_):
+                common = ~pattern & ~donor_pattern
+                if common.any() and (~donor_pattern[targets]).any():
+                    tree = KDTree(self.fit_X_[np.ix_(donor_rows, common)])
+                    groups.append((tree, donor_rows, common, ~donor_pattern))
+            for start in range(0, len(rows), self.chunk_size):
+                chunk = rows[start : start + self.chunk_size]
+                self._impute_chunk(X, chunk, targets, groups)
+        return X[:, self.valid_features_]
+
+    def _impute_chunk(self, X: np.ndarray, chunk: np.ndarray, targets, groups):
+        """
+        Impute the target features of a chunk of rows sharing a missing pattern, in
+        place, from the k nearest donors of each group, see transform.
+        """
+        distances, donors = [], []
+        for tree, donor_rows, common, _ in groups:
+            group_distances, neighbors = tree.query(
+                X[np.ix_(chunk, common)], k=min(self.n_neighbors, len(donor_rows))
+            )
+            # Nan-euclidean distances, up to a factor common to all the groups
+            distances.append(group_distances / np.sqrt(common.sum()))
+            donors.append(donor_rows[neighbors])
+        for target in targets:
+            observing = [i for i, group in enumerate(groups) if group[3][target]]
+            if not observing:
+                X[chunk, target] = self.means_[target]
+                continue
+            target_distances = np.hstack([distances[i] for i in observing])
+            target_donors = np.hstack([donors[i] for i in observing])
+            k = min(self.n_neighbors, target_distances.shape[1])
+            nearest = np.argsort(target_distances, axis=1, kind="stable")[:, :k]
+            X[chunk, target] = self.fit_X_[
+                np.take_along_axis(target_donors, nearest, axis=1), target
+            ].mean(axis=1)
+
+
 class HourToCos(BaseEstimator, TransformerMixin):
     def __init__(self, hour_col: str) -> None:
         """
@@ -180,10 +1576,10 @@ class HourToCos(BaseEstimator, TransformerMixin):
         """
 
         new_col = self.hour_col + "_cos"
-        X[new_col] = pd.to_datetime(X[self.hour_col])
-        X[new_col] = X[new_col].dt.hour + X[new_col].dt.minute / 60
-        X[new_col] = X[new_col] * 2 * np.pi / 24
-        X[new_col] = X[new_col].apply(np.cos)
+        minutes, missing = _minutes_of_day(as_datetime(X[self.hour_col]))
+        hour_cos = np.cos(minutes * (2 * np.pi / (24 * 60)))
+        hour_cos[missing] = np.nan
+        X[new_col] = hour_cos
         return X
 
 
@@ -224,12 +1620,51 @@ class DateToJulian(BaseEstimator, TransformerMixin):
             pd.DataFrame: The transformed data with an additional column containing the Julian days.
         """
         new_col = self.date_col + "_julian"
-        X[new_col] = pd.to_datetime(X[self.date_col], format="ISO8601").apply(
-            lambda x: x.to_julian_date()
-        )
+        nanoseconds, missing = _wall_time_ns(as_datetime(X[self.date_col]))
+        julian = JULIAN_DAY_EPOCH + nanoseconds / NANOSECONDS_PER_DAY
+        julian[missing] = np.nan
+        X[new_col] = julian
         return X
 
 
+def as_datetime(values: pd.Series) -> "pd.Series":
+    """
+    Parse a column of ISO 8601 dates, a column already parsed is returned as is.
+
+    Parsing the time column once (e.g. data[col] = as_datetime(data[col])) lets the
+    temporal filters and transformers below share it instead of parsing the strings
+    again.
+
+    Args:
+        values (pd.Series): The dates, as strings or datetimes.
+
+    Returns:
+        pd.Series: The datetimes.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return pd.to_datetime(values, format="ISO8601")
+
+
+def _wall_time_ns(dates: pd.Series):
+    """
+    Returns the local wall time of datetimes as int64 nanoseconds since the epoch,
+    and the mask of the missing dates (whose value is meaningless).
+    """
+    if isinstance(dates.dtype, pd.DatetimeTZDtype):
+        dates = dates.dt.tz_localize(None)
+    values = dates.to_numpy(dtype="datetime64[ns]")
+    return values.view(np.int64), np.isnat(values)
+
+
+def _minutes_of_day(dates: pd.Series):
+    """
+    Returns the minute of the day of datetimes (0 to 1439), and the missing mask.
+    """
+    nanoseconds, missing = _wall_time_ns(dates)
+    return (nanoseconds // NANOSECONDS_PER_MINUTE) % (24 * 60), missing
+
+
 def split_in_dummies(
     df: pd.DataFrame,
     column_name: str,
@@ -243,6 +1678,170 @@ def split_in_dummies(
     return df, list(df_dummies.columns)
 
 
+class MultiLabelEncoder(BaseEstimator, TransformerMixin):
+    """
+    Sparse dummy encoding of multi-valued columns, e.g. "prairie,jardin" in the
+    habitat column. Each column is encoded as one binary feature per label seen
+    during fit, and the output is a scipy CSR matrix, so the columns are never
+    densified like with split_in_dummies.
+    """
+
+    def __init__(
+        self, sep: str = ",", handle_unknown: str = "ignore", dtype=np.float64
+    ) -> None:
+        """
+        Initialize the MultiLabelEncoder transformer.
+
+        Args:
+            sep (str, optional): The separator of the labels. Defaults to ",".
+            handle_unknown (str, optional): "ignore" to drop the labels unseen during
+                fit, "error" to raise a ValueError. Defaults to "ignore".
+            dtype (optional): The dtype of the output. Defaults to np.float64.
+
+        Returns:
+            None
+        """
+        self.sep = sep
+        self.handle_unknown = handle_unknown
+        self.dtype = dtype
+
+    def fit(self, X: pd.DataFrame, y=None) -> "MultiLabelEncoder":
+        """
+        Learn the sorted labels of each column.
+
+        Args:
+            X (pd.DataFrame): The multi-valued columns, missing values have no label.
+            y: Ignored.
+
+        Returns:
+            self (MultiLabelEncoder): The fitted transformer.
+        """
+        if self.handle_unknown not in ("ignore", "error"):
+            raise ValueError(
+                f"handle_unknown should be 'ignore' or 'error', got {self.handle_unknown}"
+            )
+        X = pd.DataFrame(X)
+        self.feature_names_in_ = np.asarray(X.columns, dtype=object)
+        self.n_features_in_ = X.shape[1]
+        self.categories_ = []
+        for col in X.columns:
+            labels = {
+                label
+                for value in X[col].dropna().unique()
+                for label in str(value).split(self.sep)
+                if label
+            }
+            self.categories_.append(np.array(sorted(labels), dtype=object))
+        return self
+
+    def transform(self, X: pd.DataFrame) -> "csr_matrix":
+        """
+        Encode the columns.
+
+        Args:
+            X (pd.DataFrame): The multi-valued columns.
+
+        Returns:
+            csr_matrix: The binary features, the labels of the first column first.
+        """
+        X = pd.DataFrame(X)
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(
+                f"X has {X.shape[1]} columns, "
+                f"MultiLabelEncoder expects {self.n_features_in_}"
+            )
+        blocks = [
+            self._encode(X.iloc[:, i], categories)
+            for i, categories in enumerate(self.categories_)
+        ]
+        return hstack(blocks, format="csr", dtype=self.dtype)
+
+    def get_feature_names_out(self, input_features=None) -> np.ndarray:
+        """
+        Returns the feature names, "<column>_<label>".
+
+        Args:
+            input_features (array-like of str, optional): The column names. Defaults
+                to the names seen during fit.
+
+        Returns:
+            np.ndarray: The feature names.
+        """
+        if input_features is None:
+            input_features = self.feature_names_in_
+        return np.array(
+            [
+                f"{col}_{label}"
+                for col, categories in zip(input_features, self.categories_)
+                for label in categories
+            ],
+            dtype=object,
+        )
+
+    def _encode(self, values: pd.Series, categories: np.ndarray) -> "csr_matrix":
+        """
+        Encode one column. The distinct values are split once, then their rows are
+        gathered for each row of the column.
+
+        Args:
+            values (pd.Series): The column.
+            categories (np.ndarray): The labels of the column.
+
+        Returns:
+            csr_matrix: The binary features of the column.
+        """
+        codes, uniques = pd.factorize(values)
+        split = [
+            [label for label in str(value).split(self.sep) if label] for value in uniques
+        ]
+        labels = [label for value_labels in split for label in value_labels]
+        columns = pd.Index(categories).get_indexer(labels)
+        unknown = columns == -1
+        if unknown.any() and self.handle_unknown == "error":
+            unknown_labels = sorted(set(np.asarray(labels, dtype=object)[unknown]))
+            raise ValueError(f"Found unknown labels {unknown_labels} in {values.name}")
+
+        owners = np.repeat(
+            np.arange(len(uniques)), [len(value_labels) for value_labels in split]
+        )
+        # The last row of the table is empty, it encodes the missing values
+        table = csr_matrix(
+            (
+                np.ones(np.count_nonzero(~unknown)),
+                (owners[~unknown], columns[~unknown]),
+            ),
+            shape=(len(uniques) + 1, len(categories)),
+        )
+        # Repeated labels in a value are summed, they are still one label
+        table.data[:] = 1
+        return table[np.where(codes >= 0, codes, len(uniques))]
+
+
+def temporal_mask(
+    dates: pd.Series,
+    hours: Optional[List[int]] = None,
+    months: Optional[List[int]] = None,
+) -> np.ndarray:
+    """
+    Boolean mask of the dates in the given hours and months.
+
+    Args:
+        dates (pd.Series): The dates, see as_datetime.
+        hours (List[int], optional): The hours to select. Defaults to None (all).
+        months (List[int], optional): The months to select. Defaults to None (all).
+
+    Returns:
+        np.ndarray: The mask, missing dates are not selected.
+    """
+    minutes, missing = _minutes_of_day(dates)
+    mask = ~missing
+    if hours is not None:
+        mask &= np.isin(minutes // 60, hours)
+    if months is not None:
+        mask &= dates.dt.month.isin(months).to_numpy()
+    return mask
+
+
 def get_df_by_hours(
     df: pd.DataFrame,
     time_col: str,
@@ -259,9 +1858,7 @@ def get_df_by_hours(
     Returns:
         pandas.DataFrame: The selected dataframe.
     """
-    X = df[time_col].copy()
-    X = pd.to_datetime(X, format="ISO8601")
-    return df[X.dt.hour.isin(hours)]
+    return df[temporal_mask(as_datetime(df[time_col]), hours=hours)]
 
 
 def get_df_by_months(
@@ -278,9 +1875,7 @@ def get_df_by_months(
     Returns:
         pandas.DataFrame: The selected dataframe.
     """
-    X = df[time_col].copy()
-    X = pd.to_datetime(X, format="ISO8601")
-    return df[X.dt.month.isin(months)]
+    return df[temporal_mask(as_datetime(df[time_col]), months=months)]
 
 
 def random_sample_mask(
@@ -305,16 +1900,54 @@ def random_sample_mask(
     Returns:
         pandas.DataFrame: The filtered DataFrame based on the random sample mask
     """
-    rng = np.random.default_rng(random_state)
-    mask = (df[column_name] > min_threshold) & (df[column_name] < max_threshold)
-    sample_indices = rng.choice(
-        df[mask].index,
-        size=int(np.count_nonzero(mask) * sample_percentage),
-        replace=False,
+    keep = undersample_indices(
+        df[column_name],
+        [min_threshold],
+        [max_threshold],
+        [sample_percentage],
+        random_state=random_state,
     )
-    mask[sample_indices] = False
-    df_filtered = df[~mask]
-    return df_filtered
+    return df.iloc[keep]
+
+
+def undersample_indices(
+    y,
+    min_thresholds: List[float],
+    max_thresholds: List[float],
+    sample_percentages: List[float],
+    random_state: int = 0,
+) -> np.ndarray:
+    """
+    Randomly under-sample the rows whose target is in threshold bands.
+
+    The band memberships are computed in one pass over y, then for each band in
+    order, sample_percentage of its remaining rows are kept, drawn with a single
+    seeded generator. The rows outside of the bands are all kept.
+
+    Args:
+        y (array-like): The target values.
+        min_thresholds (List[float]): The (excluded) lower bound of each band.
+        max_thresholds (List[float]): The (excluded) upper bound of each band.
+        sample_percentages (List[float]): The fraction of the rows kept in each band.
+        random_state (int, optional): The seed for the random number generator.
+
+    Returns:
+        np.ndarray: The sorted positions of the kept rows.
+    """
+    y = np.asarray(y, dtype=float)
+    in_bands = (y[:, None] > np.asarray(min_thresholds, dtype=float)) & (
+        y[:, None] < np.asarray(max_thresholds, dtype=float)
+    )
+    rng = np.random.default_rng(random_state)
+    keep = np.ones(len(y), dtype=bool)
+    for band, sample_percentage in enumerate(sample_percentages):
+        positions = np.flatnonzero(in_bands[:, band] & keep)
+        sampled = rng.choice(
+            positions, size=int(len(positions) * sample_percentage), replace=False
+        )
+        keep[positions] = False
+        keep[sampled] = True
+    return np.flatnonzero(keep)
 
 
 class TrainTestUnderSampler:
@@ -347,37 +1980,166 @@ class TrainTestUnderSampler:
         self.sample_percentages = sample_percentages
         self.random_state = random_state
 
+    def split_indices(self, y):
+        """
+        Split the rows into training and testing sets, and under-sample the training
+        set, without copying the data.
+
+        Args:
+            y (array-like): The target values.
+
+        Returns:
+            tuple: The positions of the training and testing rows (train, test).
+        """
+        train, test = train_test_split(
+            np.arange(len(y)), test_size=0.2, random_state=self.random_state
+        )
+        keep = undersample_indices(
+            np.asarray(y)[train],
+            self.min_thresholds,
+            self.max_thresholds,
+            self.sample_percentages,
+            random_state=self.random_state,
+        )
+        return train[keep], test
+
     def preprocess(self, X, y):
         """
         Split the data into training and testing sets.
-        Apply random sample mask with different thresholds and sample percentages.
+        Apply random under-sampling with different thresholds and sample percentages
+        to the training set, see split_indices.
         Returns the preprocessed training and testing data.
 
         Args:
-            X (array-like): The input features.
-            y (array-like): The target values.
+            X (pd.DataFrame): The input features.
+            y (pd.Series): The target values.
         Returns:
             tuple: Preprocessed training and testing data (X_train, X_test, y_train, y_test).
         """
-        # Split the data into training and testing sets
-        X_train, X_test, y_train, y_test = train_test_split(
-            X, y, test_size=0.2, random_state=self.random_state
-        )
+        train, test = self.split_indices(y)
+        return X.iloc[train], X.iloc[test], y.iloc[train], y.iloc[test]
 
-        # Apply random sample mask with different thresholds and sample percentages
-        for min_thresh, max_thresh, sample_percentage in zip(
-            self.min_thresholds, self.max_thresholds, self.sample_percentages
-        ):
-            X_temp = pd.concat([X_train, y_train], axis=1)
-            X_temp = random_sample_mask(
-                X_temp,
-                self.column_name,
-                min_thresh,
-                max_thresh,
-                sample_percentage,
-                random_state=self.random_state,
-            )
-            X_train = X_temp.drop(columns=[self.column_name], axis=1)
-            y_train = X_temp[self.column_name]
 
-        return X_train, X_test, y_train, y_test
+def spatial_blocks(
+    latitude: np.ndarray, longitude: np.ndarray, block_size: float
+) -> np.ndarray:
+    """
+    Returns the square grid cell of each point, as integer codes.
+
+    Args:
+        latitude (np.ndarray): The latitudes.
+        longitude (np.ndarray): The longitudes.
+        block_size (float): The size of the cells in degrees.
+
+    Returns:
+        np.ndarray: The block of each point.
+    """
+    cells = np.floor(
+        np.column_stack([latitude, longitude]).astype(float) / block_size
+    ).astype(np.int64)
+    _, blocks = np.unique(cells, axis=0, return_inverse=True)
+    return blocks.ravel()
+
+
+class SpatialBlockSplitter:
+    """
+    SpatialBlockSplitter is a cross-validator assigning whole spatial blocks to the
+    folds, so that neighboring points, which share targets through the radius
+    metrics, are never split between training and testing sets. The under-sampling
+    bands of TrainTestUnderSampler are applied inside the training folds only.
+
+    It follows the scikit-learn cross-validator API and can be given as cv to
+    cross_validate, GridSearchCV or CustomPipeline.cross_validate.
+    """
+
+    def __init__(
+        self,
+        n_splits: int = 5,
+        block_size: float = 0.5,
+        latitude_col: str = "latitude",
+        longitude_col: str = "longitude",
+        min_thresholds: Optional[List[float]] = None,
+        max_thresholds: Optional[List[float]] = None,
+        sample_percentages: Optional[List[float]] = None,
+        random_state: int = 1,
+    ) -> None:
+        """
+        Initializes the instance.
+
+        Args:
+            n_splits (int, optional): The number of folds. Default is 5.
+            block_size (float, optional): The size of the grid cells in degrees. Default is 0.5.
+            latitude_col (str, optional): The latitude column of X. Default is "latitude".
+            longitude_col (str, optional): The longitude column of X. Default is "longitude".
+            min_thresholds (List[float], optional): The lower bounds of the under-sampling bands.
+            max_thresholds (List[float], optional): The upper bounds of the under-sampling bands.
+            sample_percentages (List[float], optional): The fraction of the rows kept in each band.
+            random_state (int, optional): The random state for reproducibility. Default is 1.
+        """
+        self.n_splits = n_splits
+        self.block_size = block_size
+        self.latitude_col = latitude_col
+        self.longitude_col = longitude_col
+        self.min_thresholds = min_thresholds
+        self.max_thresholds = max_thresholds
+        self.sample_percentages = sample_percentages
+        self.random_state = random_state
+
+    def get_n_splits(self, X=None, y=None, groups=None) -> int:
+        return self.n_splits
+
+    def split(self, X, y=None, groups=None):
+        """
+        Generate the positions of the training and testing rows of each fold.
+
+        The blocks are the grid cells of the coordinates of X, or the given groups
+        (e.g. cluster labels). They are assigned, largest first, to the fold with the
+        fewest rows, ties between blocks of the same size being broken at random.
+
+        Args:
+            X (pd.DataFrame): The input features, with the coordinates unless groups is given.
+            y (array-like, optional): The target values, required by the under-sampling.
+            groups (array-like, optional): The block of each row. Defaults to the grid cells.
+
+        Yields:
+            tuple: The positions of the training and testing rows (train, test).
+        """
+        if groups is None:
+            groups = spatial_blocks(
+                X[self.latitude_col].to_numpy(),
+                X[self.longitude_col].to_numpy(),
+                self.block_size,
+            )
+        blocks, uniques = pd.factorize(np.asarray(groups))
+        n_blocks = len(uniques)
+        if n_blocks < self.n_splits:
+            raise ValueError(
+                f"Cannot split {n_blocks} blocks in {self.n_splits} folds, "
+                "decrease block_size or n_splits"
+            )
+        sizes = np.bincount(blocks, minlength=n_blocks)
+        rng = np.random.default_rng(self.random_state)
+        order = rng.permutation(n_blocks)
+        order = order[np.argsort(-sizes[order], kind="stable")]
+
+        block_folds = np.empty(n_blocks, dtype=np.int64)
+        fold_sizes = np.zeros(self.n_splits, dtype=np.int64)
+        for block in order:
+            fold = np.argmin(fold_sizes)
+            block_folds[block] = fold
+            fold_sizes[fold] += sizes[block]
+
+        folds = block_folds[blocks]
+        for fold in range(self.n_splits):
+            train = np.flatnonzero(folds != fold)
+            if self.sample_percentages is not None:
+                train = train[
+                    undersample_indices(
+                        np.asarray(y)[train],
+                        self.min_thresholds,
+                        self.max_thresholds,
+                        self.sample_percentages,
+                        random_state=self.random_state,
+                    )
+                ]
+            yield train, np.flatnonzero(folds == fold)
@@ -0,0 +1,304 @@
+"""
+sketches.py
+
+HyperLogLog distinct count sketches stored on a regular latitude/longitude grid.
+The sketch of an area is the merge (element-wise maximum) of the sketches of the
+cells covering it, so the cost of a query depends on the number of non-zero
+registers of these cells, at most 2**p per cell, not on the number of observations
+in the area.
+"""
+
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# Number of hash bits used for the rank, after the precision bits
+RANK_BITS = 32
+
+
+def hll_precision(error: float) -> int:
+    """
+    Returns the precision (number of index bits) of the sketches whose relative
+    standard error is at most the given error, the error being 1.04 / sqrt(2**p).
+
+    Args:
+        error (float): The relative standard error, e.g. 0.02 for 2%.
+
+    Returns:
+        int: The precision, between 4 and 16.
+    """
+    return int(np.clip(np.ceil(2 * np.log2(1.04 / error)), 4, 16))
+
+
+def hash_values(values: pd.Series) -> np.ndarray:
+    """
+    Hash values to 64 bits, the same values always giving the same hashes, so that
+    sketches of different data can be merged.
+
+    Args:
+        values (pd.Series): The values, missing values get a hash but should be dropped.
+
+    Returns:
+        np.ndarray: The uint64 hashes.
+    """
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+
+def hll_estimate_sparse(
+    sketch_ids: np.ndarray, ranks: np.ndarray, n_sketches: int, m: int
+) -> np.ndarray:
+    """
+    Estimate the number of distinct values of sketches given by their non-zero
+    registers, with the HyperLogLog estimate, or linear counting for the small
+    cardinalities.
+
+    Args:
+        sketch_ids (np.ndarray): The sketch of each non-zero register, at most one
+            per register index of a sketch.
+        ranks (np.ndarray): The value of each non-zero register.
+        n_sketches (int): The number of sketches.
+        m (int): The number of registers of the sketches.
+
+    Returns:
+        np.ndarray: The estimated number of distinct values of each sketch.
+    """
+    non_zero = np.bincount(sketch_ids, minlength=n_sketches)
+    zeros = m - non_zero
+    total = zeros + np.bincount(
+        sketch_ids, weights=np.exp2(-ranks.astype(float)), minlength=n_sketches
+    )
+    alpha = 0.7213 / (1 + 1.079 / m)
+    raw = alpha * m**2 / total
+    with np.errstate(divide="ignore"):
+        linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * m) & (zeros > 0), linear, raw)
+
+
+class SketchGrid:
+    """
+    Regular grid of cells, each one holding the number of observations in the cell
+    and a HyperLogLog sketch of the distinct values observed in the cell.
+
+    Only the occupied cells are stored, and only the non-zero registers of their
+    sketches (the sparse representation of HyperLogLog), so the memory does not depend
+    on the extent of the grid (e.g. with overseas observations) and merging a box
+    costs the number of non-zero registers of its cells.
+    """
+
+    def __init__(
+        self, cell_size: float, precision: int, max_entries: int = 2**22
+    ) -> None:
+        """
+        Initializes a SketchGrid object.
+
+        Args:
+            cell_size (float): The size of the cells in degrees.
+            precision (int): The precision of the sketches, see hll_precision.
+            max_entries (int, optional): The number of non-zero registers merged at
+                once in query, which bounds its memory. Defaults to 2**22.
+        """
+        self.cell_size = cell_size
+        self.precision = precision
+        self.max_entries = max_entries
+
+    def fit(
+        self,
+        latitude: np.ndarray,
+        longitude: np.ndarray,
+        hashes: np.ndarray,
+        valid: Optional[np.ndarray] = None,
+    ) -> "SketchGrid":
+        """
+        Add the observations to the cells.
+
+        Args:
+            latitude (np.ndarray): The latitudes of the observations.
+            longitude (np.ndarray): The longitudes of the observations.
+            hashes (np.ndarray): The uint64 hashes of the values, see hash_values.
+            valid (np.ndarray, optional): Boolean mask of the observations whose value
+                is not missing. The other ones are only counted. Defaults to None (all).
+
+        Returns:
+            self
+        """
+        cell_y = np.floor(latitude / self.cell_size).astype(np.int64)
+        cell_x = np.floor(longitude / self.cell_size).astype(np.int64)
+        self.origin_ = (cell_y.min(), cell_x.min())
+        self.shape_ = (
+            cell_y.max() - self.origin_[0] + 1,
+            cell_x.max() - self.origin_[1] + 1,
+        )
+        # Occupied cells, sorted by key
+        self.keys_, cells = np.unique(
+            self._keys(cell_y - self.origin_[0], cell_x - self.origin_[1]),
+            return_inverse=True,
+        )
+        cells = cells.ravel()
+
+        index = (hashes >> np.uint64(64 - self.precision)).astype(np.int64)
+        rest = (
+            (hashes >> np.uint64(64 - self.precision - RANK_BITS))
+            & np.uint64(2**RANK_BITS - 1)
+        ).astype(float)
+        with np.errstate(divide="ignore"):
+            rank = np.where(rest > 0, RANK_BITS - np.floor(np.log2(rest)), RANK_BITS + 1)
+
+        if valid is None:
+            valid = np.ones(len(hashes), dtype=bool)
+        # Sparse registers: the non-zero registers of each cell, as a CSR matrix
+        # (cell, register index) -> rank
+        keys, ranks = _max_by_key(
+            cells[valid] * 2**self.precision + index[valid], rank[valid].astype(np.int64)
+        )
+        self.register_rank_ = ranks.astype(np.uint8)
+        self.register_index_ = keys % 2**self.precision
+        self.cell_ptr_ = np.searchsorted(
+            keys // 2**self.precision, np.arange(len(self.keys_) + 1)
+        )
+        self.counts_ = np.bincount(cells, minlength=len(self.keys_))
+        return self
+
+    def query(
+        self,
+        latitude: np.ndarray,
+        longitude: np.ndarray,
+        halo_latitude,
+        halo_longitude,
+    ):
+        """
+        Merge the cells intersecting the boxes [latitude +/- halo_latitude] x
+        [longitude +/- halo_longitude] around each query.
+
+        The queries falling on the same box of cells share it: each distinct box is
+        merged once, from the non-zero registers of the occupied cells it covers, and
+        its estimate is looked up by all its queries. Query all the locations at once
+        rather than by chunks.
+
+        Args:
+            latitude (np.ndarray): The latitudes of the queries.
+            longitude (np.ndarray): The longitudes of the queries.
+            halo_latitude (float or np.ndarray): Half-height of the boxes in degrees.
+            halo_longitude (float or np.ndarray): Half-width of the boxes in degrees.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The number of observations in the covered
+            cells and the estimated number of distinct values for each query.
+        """
+        first_y = np.floor((latitude - halo_latitude) / self.cell_size).astype(np.int64)
+        last_y = np.floor((latitude + halo_latitude) / self.cell_size).astype(np.int64)
+        first_x = np.floor((longitude - halo_longitude) / self.cell_size).astype(np.int64)
+        last_x = np.floor((longitude + halo_longitude) / self.cell_size).astype(np.int64)
+
+        # Boxes partly outside of the grid are clipped, the cells outside are empty
+        boxes = np.column_stack(
+            [
+                np.clip(first_y - self.origin_[0], 0, self.shape_[0]),
+                np.clip(last_y - self.origin_[0] + 1, 0, self.shape_[0]),
+                np.clip(first_x - self.origin_[1], 0, self.shape_[1]),
+                np.clip(last_x - self.origin_[1] + 1, 0, self.shape_[1]),
+            ]
+        )
+        boxes, inverse = np.unique(boxes, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+
+        box_ids, cells = self._covered_cells(boxes)
+        counts = np.bincount(
+            box_ids, weights=self.counts_[cells], minlength=len(boxes)
+        ).astype(np.int64)
+
+        # The boxes are merged by batches of about max_entries non-zero registers,
+        # to bound the memory
+        lengths = self.cell_ptr_[cells + 1] - self.cell_ptr_[cells]
+        box_ends = np.cumsum(
+            np.bincount(box_ids, weights=lengths, minlength=len(boxes))
+        )
+        estimates = np.zeros(len(boxes))
+        start = 0
+        while start < len(boxes):
+            offset = box_ends[start - 1] if start else 0
+            stop = max(
+                np.searchsorted(box_ends, offset + self.max_entries, side="right"),
+                start + 1,
+            )
+            first, last = np.searchsorted(box_ids, [start, stop])
+            estimates[start:stop] = self._merge(
+                box_ids[first:last] - start, cells[first:last], stop - start
+            )
+            start = stop
+        return counts[inverse], estimates[inverse]
+
+    def _merge(self, box_ids: np.ndarray, cells: np.ndarray, n_boxes: int) -> np.ndarray:
+        """
+        Merge the sketches of the cells of boxes and estimate their distinct counts.
+
+        Args:
+            box_ids (np.ndarray): The box of each (box, cell) pair, sorted.
+            cells (np.ndarray): The cell of each pair.
+            n_boxes (int): The number of boxes.
+
+        Returns:
+            np.ndarray: The estimated number of distinct values of each box.
+        """
+        lengths = self.cell_ptr_[cells + 1] - self.cell_ptr_[cells]
+        entries = np.repeat(self.cell_ptr_[cells], lengths) + _ranges(lengths)
+        # The merged register of a box is the largest rank of its entries for the
+        # register index, the estimate only needs the non-zero merged registers
+        keys, ranks = _max_by_key(
+            np.repeat(box_ids, lengths) * 2**self.precision
+            + self.register_index_[entries],
+            self.register_rank_[entries].astype(np.int64),
+        )
+        return hll_estimate_sparse(
+            keys // 2**self.precision, ranks, n_boxes, 2**self.precision
+        )
+
+    def _keys(self, cell_y: np.ndarray, cell_x: np.ndarray) -> np.ndarray:
+        """
+        Returns the keys of cells, relative to the origin of the grid.
+        """
+        return cell_y * self.shape_[1] + cell_x
+
+    def _covered_cells(self, boxes: np.ndarray):
+        """
+        Returns the (box, occupied cell) pairs such that the cell is in the box,
+        sorted by box.
+
+        Args:
+            boxes (np.ndarray): The boxes [first_y, last_y) x [first_x, last_x) of cells.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The box and the occupied cell (position in
+            keys_) of each pair.
+        """
+        span_y = boxes[:, 1] - boxes[:, 0]
+        # One candidate per row of each box: the cells of the row are found by
+        # binary search among the sorted keys of the occupied cells
+        rows = np.repeat(np.arange(len(boxes)), span_y)
+        row_y = boxes[rows, 0] + _ranges(span_y)
+        left = np.searchsorted(self.keys_, self._keys(row_y, boxes[rows, 2]))
+        right = np.searchsorted(self.keys_, self._keys(row_y, boxes[rows, 3]))
+        lengths = right - left
+        box_ids = np.repeat(rows, lengths)
+        cells = np.repeat(left, lengths) + _ranges(lengths)
+        return box_ids, cells
+
+
+def _max_by_key(keys: np.ndarray, ranks: np.ndarray):
+    """
+    Returns the distinct keys, sorted, and the largest rank of each one. The ranks
+    are below 64, so keys and ranks are sorted together as single integers.
+    """
+    packed = np.sort(keys << 6 | ranks)
+    keys = packed >> 6
+    last = np.ones(len(packed), dtype=bool)
+    last[:-1] = keys[1:] != keys[:-1]
+    return keys[last], packed[last] & 63
+
+
+def _ranges(lengths: np.ndarray) -> np.ndarray:
+    """
+    Concatenation of np.arange(length) for each length.
+    """
+    ends = np.cumsum(lengths)
+    return np.arange(ends[-1] if len(ends) else 0) - np.repeat(ends - lengths, lengths)
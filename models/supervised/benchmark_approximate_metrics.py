@@ -0,0 +1,65 @@
+"""
+Compare the time of the exact and approximate (sketch based) MetricsCalculator,
+and the mean relative error of the approximate weighted specific richness.
+
+    python -m models.supervised.benchmark_approximate_metrics
+
+Uniform random observations are used, with as many distinct insects and
+collections per neighborhood as in the dense areas of the SPIPOLL data.
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from models.preprocessors import MetricsCalculator
+
+SIZES = [20_000, 80_000, 320_000]
+DISTANCE = 0.5
+
+
+def synthetic_data(n: int, rng: np.random.Generator) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "latitude": rng.uniform(45, 47, n),
+            "longitude": rng.uniform(2, 4, n),
+            "insecte_fr": rng.integers(0, 3000, n).astype(str),
+            "collection_id": rng.integers(0, n // 4, n),
+        }
+    )
+
+
+def measure(data: pd.DataFrame, **kwargs):
+    """
+    Returns the transformed data and the time in seconds of fit_transform.
+    """
+    start = time.perf_counter()
+    transformed = MetricsCalculator(distance=DISTANCE, **kwargs).fit_transform(
+        data.copy()
+    )
+    return transformed, time.perf_counter() - start
+
+
+def main():
+    rng = np.random.default_rng(7)
+    print(f"{'rows':>8} {'exact (s)':>10} {'approx (s)':>11} {'error':>7}")
+    for n in SIZES:
+        data = synthetic_data(n, rng)
+        expected, exact_time = measure(data)
+        transformed, approximate_time = measure(
+            data, approximate=True, sketch_error=0.02, cell_size=0.05
+        )
+        relative_error = (
+            transformed["weighted_specific_richness"]
+            / expected["weighted_specific_richness"]
+            - 1
+        )
+        print(
+            f"{n:>8} {exact_time:>10.2f} {approximate_time:>11.2f}"
+            f" {np.abs(relative_error).mean():>7.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Compare the imputers of the numeric features of CustomPipeline: the accuracy on
+values masked at random and the fit + transform time, for growing numbers of rows.
+
+    python models/supervised/benchmark_imputation.py [path.csv]
+
+Without a path, correlated synthetic features are used. With a path, the numeric
+columns of the file are used, restricted to the rows without missing values.
+"""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.impute import KNNImputer
+from sklearn.preprocessing import StandardScaler
+
+from models.preprocessors import TreeKNNImputer
+
+SIZES = [5_000, 20_000, 80_000, 320_000]
+MISSING_RATE = 0.1
+# KNNImputer is quadratic, it is only run up to this number of rows
+MAX_KNN_ROWS = 20_000
+
+
+def synthetic_features(n: int, rng: np.random.Generator) -> np.ndarray:
+    latitude = rng.uniform(42, 51, n)
+    longitude = rng.uniform(-4, 8, n)
+    julian = rng.uniform(2455000, 2460000, n)
+    temperature = (
+        30 - 0.8 * (latitude - 42) + 5 * np.sin(julian / 58) + rng.normal(0, 1, n)
+    )
+    return np.column_stack([latitude, longitude, julian, temperature])
+
+
+def main():
+    rng = np.random.default_rng(0)
+    if len(sys.argv) > 1:
+        data = pd.read_csv(sys.argv[1]).select_dtypes("number").dropna().to_numpy()
+    else:
+        data = synthetic_features(max(SIZES), rng)
+
+    imputers = {"knn": KNNImputer(n_neighbors=5), "tree": TreeKNNImputer(n_neighbors=5)}
+    print(f"{'rows':>8} {'imputer':>8} {'time (s)':>9} {'RMSE':>7}")
+    for n in SIZES:
+        if n > len(data):
+            break
+        X = StandardScaler().fit_transform(data[rng.permutation(len(data))[:n]])
+        mask = rng.random(X.shape) < MISSING_RATE
+        X_missing = np.where(mask, np.nan, X)
+        for name, imputer in imputers.items():
+            if name == "knn" and n > MAX_KNN_ROWS:
+                continue
+            start = time.perf_counter()
+            imputed = imputer.fit(X_missing).transform(X_missing)
+            elapsed = time.perf_counter() - start
+            rmse = np.sqrt(np.mean((imputed[mask] - X[mask]) ** 2))
+            print(f"{n:>8} {name:>8} {elapsed:>9.2f} {rmse:>7.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Measure the peak memory and the time of preprocess_data, and check the peak
+against the target: at most half the input size plus the output size, i.e. the
+selected rows are copied once and the steps do not copy the whole frame again.
+The script exits with an error when the target is exceeded.
+
+    python models/supervised/benchmark_preprocessing.py [path.csv]
+
+Without a path, a synthetic frame with the columns of the SPIPOLL data is used.
+The peak is the largest memory allocated by the call, measured with tracemalloc.
+"""
+
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from models.supervised.workflow import preprocess_data
+
+N_ROWS = 700_000
+N_EXTRA_COLUMNS = 30
+DISTANCE = 0.05
+# Share of the input size allowed in the peak memory, on top of the output
+TARGET_INPUT_SHARE = 0.5
+
+
+def synthetic_data(n: int, rng: np.random.Generator) -> pd.DataFrame:
+    data = pd.DataFrame(
+        {
+            "collection_id": rng.integers(0, n // 5, n),
+            "collection_heure_debut": (
+                pd.Timestamp("2010-01-01")
+                + pd.to_timedelta(rng.integers(0, 13 * 365 * 86400, n), unit="s")
+            ).strftime("%Y-%m-%d %H:%M:%S"),
+            "latitude": rng.uniform(42, 51, n).round(3),
+            "longitude": rng.uniform(-4, 8, n).round(3),
+            "insecte_fr": rng.integers(0, 500, n).astype(str),
+            "habitat": rng.choice(["prairie,jardin", "jardin", "foret", "urbain"], n),
+        }
+    )
+    extra = {f"feature_{i}": rng.random(n) for i in range(N_EXTRA_COLUMNS)}
+    return pd.concat([data, pd.DataFrame(extra)], axis=1)
+
+
+def measure(data: pd.DataFrame):
+    """
+    Returns the output size in MB, the peak memory in MB and the time in seconds
+    of preprocess_data.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    transformed, _ = preprocess_data(
+        data,
+        distance=DISTANCE,
+        hour_range=list(range(8, 19)),
+        month_range=list(range(4, 10)),
+        col_to_dummy="habitat",
+        insect_col="insecte_fr",
+    )
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return transformed.memory_usage(deep=True).sum() / 2**20, peak, elapsed
+
+
+def main():
+    if len(sys.argv) > 1:
+        data = pd.read_csv(sys.argv[1])
+    else:
+        data = synthetic_data(N_ROWS, np.random.default_rng(0))
+    size = data.memory_usage(deep=True).sum() / 2**20
+
+    output, peak, elapsed = measure(data)
+    target = TARGET_INPUT_SHARE * size + output
+    print(f"Input: {len(data)} rows, {size:.0f} MB")
+    print(f"Output: {output:.0f} MB")
+    print(f"Peak: {peak:.0f} MB (target {target:.0f} MB), time: {elapsed:.2f} s")
+    if peak > target:
+        sys.exit(f"The peak memory exceeds the target by {peak - target:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
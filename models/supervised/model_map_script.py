@@ -1,4 +1,5 @@
 import pandas as pd
+from data_quality.dataset import read_dataset
 from models.preprocessors import TrainTestUnderSampler
 from models.supervised.workflow import (
     preprocess_data,
@@ -14,6 +15,7 @@ use_backup = True
 # NOT USABLE IN THIS STATE
 def main():
     ## PARAMETERS
+    # spipoll.csv, or a Parquet dataset written by run_data_quality.py
     path = "data/raw_data/spipoll.csv"
     path_backup = "spipoll_target_medium.csv"
     hour_range = [i for i in range(0, 24)]
@@ -29,7 +31,7 @@ def main():
         df_transformed = pd.read_csv(path_backup)
 
     else:
-        data = pd.read_csv(path).sample(frac=0.05, random_state=1).copy()
+        data = read_dataset(path).sample(frac=0.05, random_state=1).copy()
         df_transformed, dummies_col = preprocess_data(
             data,
             distance,
@@ -71,6 +73,7 @@ def main():
         nominal_features,
         y_column_name,
         sampler,
+        dummy_labels=dummies_col,
     )
 
     pipe.get_metrics(X_test, y_test)
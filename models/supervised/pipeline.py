@@ -1,16 +1,21 @@
-from typing import List
+from typing import List, Optional
 
+import numpy as np
 import pandas as pd
+from sklearn.base import clone
 from sklearn.compose import ColumnTransformer
-from sklearn.ensemble import RandomForestRegressor
+from sklearn.ensemble import HistGradientBoostingRegressor, RandomForestRegressor
 from sklearn.experimental import enable_iterative_imputer
 from sklearn.feature_selection import SelectFromModel
 from sklearn.impute import IterativeImputer, KNNImputer, SimpleImputer
 from sklearn.linear_model import Lasso, LinearRegression, Ridge
+from sklearn.model_selection import cross_validate
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import OneHotEncoder, OrdinalEncoder, StandardScaler
 from sklearn.metrics import r2_score, mean_squared_error, mean_absolute_error
 
+from models.preprocessors import MultiLabelEncoder, TreeKNNImputer
+
 
 class CustomPipeline:
     def __init__(
@@ -21,6 +26,10 @@ class CustomPipeline:
         nominal_features: List[str],
         estimator=RandomForestRegressor(random_state=1),
         feature_selection : bool = True,
+        multilabel_features: Optional[List[str]] = None,
+        memory=None,
+        imputer: str = "knn",
+        dummy_labels: Optional[List[str]] = None,
     ):
         """
         Initialize the class with the given estimator and feature lists.
@@ -32,6 +41,19 @@ class CustomPipeline:
             nominal_features (List[str]): List of nominal feature names.
             feature_selection (bool, optional): Whether to use feature selection. Defaults to True.
             estimator: The machine learning estimator to be used.
+            multilabel_features (List[str], optional): Comma-separated multi-valued
+                feature names (e.g. habitat), encoded as sparse dummies. Defaults to None.
+            memory (str or joblib.Memory, optional): Directory where the fitted
+                preprocessor and feature selector are cached, keyed by their parameters
+                and a hash of their input data. Refitting with another estimator (e.g. in
+                a grid search on self.pipeline) then skips the imputation and encoding.
+                Defaults to None (no caching).
+            imputer (str, optional): The imputation of the numeric features, "knn" for
+                KNNImputer or "tree" for TreeKNNImputer, which scales to the full
+                dataset. Defaults to "knn".
+            dummy_labels (List[str], optional): The labels of the column split in
+                dummies by preprocess_data (its dummies_col), saved with the model so
+                that predict.py fills the dummies absent from a chunk. Defaults to None.
         """
         self.estimator = estimator
         self.numeric_features = numeric_features
@@ -39,11 +61,21 @@ class CustomPipeline:
         self.ordinal_features = ordinal_features
         self.nominal_features = nominal_features
         self.feature_selection = feature_selection
+        self.multilabel_features = multilabel_features
+        self.memory = memory
+        self.imputer = imputer
+        self.dummy_labels = dummy_labels
         self.pipeline = self._create_pipeline()
         
     def _create_pipeline(self) -> "Pipeline":
+        if self.imputer == "knn":
+            imputer = KNNImputer(n_neighbors=5)
+        elif self.imputer == "tree":
+            imputer = TreeKNNImputer(n_neighbors=5)
+        else:
+            raise ValueError(f"Unknown imputer {self.imputer}, use 'knn' or 'tree'")
         numeric_pipeline = Pipeline(
-            steps=[("scaler", StandardScaler()), ("imputer", KNNImputer(n_neighbors=5))]
+            steps=[("scaler", StandardScaler()), ("imputer", imputer)]
         )
 
         ordinal_pipeline = Pipeline(
@@ -67,14 +99,26 @@ class CustomPipeline:
             remainder="drop",
         )
 
+        transformers = [
+            ("numerical", numeric_pipeline, self.numeric_features),
+            ("categorical", categorical_pipeline, self.categorical_features),
+        ]
+        if self.multilabel_features:
+            transformers.append(
+                ("multilabel", MultiLabelEncoder(), self.multilabel_features)
+            )
+        # Keep the output sparse when there are one-hot or multi-label dummies, they
+        # are never densified
+        sparse_output = bool(self.nominal_features or self.multilabel_features)
         preprocessor = ColumnTransformer(
-            transformers=[
-                ("numerical", numeric_pipeline, self.numeric_features),
-                ("categorical", categorical_pipeline, self.categorical_features),
-            ],
+            transformers=transformers,
             remainder="drop",
+            sparse_threshold=1.0 if sparse_output else 0.3,
         )
         if self.feature_selection:
+            # On the sparse output, Ridge fits the dummies as is with its iterative
+            # solver. With memory, the fitted selector (and its mask) is cached for the
+            # same preprocessed data, so refits skip the selection.
             feature_selector = SelectFromModel(estimator=Ridge())
         else:
             feature_selector = "passthrough"
@@ -85,7 +129,8 @@ class CustomPipeline:
                 ("preprocessor", preprocessor),
                 ("feature_selector", feature_selector),
                 ("estimator", estimator),
-            ]
+            ],
+            memory=self.memory,
         )
         return pipe
 
@@ -112,3 +157,133 @@ class CustomPipeline:
         print(f"MAE: {mae}")
 
         return r2, mse, mae
+
+    def cross_validate(
+        self,
+        X: pd.DataFrame,
+        y: pd.Series,
+        cv=5,
+        groups=None,
+        n_jobs: Optional[int] = None,
+    ) -> dict:
+        """
+        Cross-validate the pipeline, fitting the folds in parallel.
+
+        Args:
+            X (pd.DataFrame): The input features.
+            y (pd.Series): The target values.
+            cv (optional): The number of folds or a cross-validator, e.g. a
+                SpatialBlockSplitter. Defaults to 5.
+            groups (array-like, optional): The group of each row, given to the
+                cross-validator split, e.g. spatial_blocks. Defaults to None.
+            n_jobs (int, optional): The number of folds fitted in parallel. Defaults to None.
+
+        Returns:
+            dict: The scikit-learn cross_validate results, with the R2, MSE and MAE of
+            each fold in test_r2, test_mse and test_mae.
+        """
+        results = cross_validate(
+            self.pipeline,
+            X,
+            y,
+            cv=cv,
+            groups=groups,
+            n_jobs=n_jobs,
+            scoring={
+                "r2": "r2",
+                "mse": "neg_mean_squared_error",
+                "mae": "neg_mean_absolute_error",
+            },
+        )
+        # The errors are negated by the scorers, greater is better
+        results["test_mse"] = -results["test_mse"]
+        results["test_mae"] = -results["test_mae"]
+
+        for name in ["r2", "mse", "mae"]:
+            scores = results[f"test_{name}"]
+            print(f"{name.upper()}: {scores.mean()} (+/- {scores.std()})")
+
+        return results
+
+
+class HistGradientBoostingPipeline(CustomPipeline):
+    """
+    Engine preset of CustomPipeline feeding the ordinal-coded categorical features
+    straight to a histogram-based gradient boosting regressor, which splits them
+    natively. The one-hot encoding, the imputation (missing values are handled by
+    the trees) and the feature selection are skipped, so the model trains on the
+    full dataset in a fraction of the RandomForest time.
+    """
+
+    def __init__(
+        self,
+        numeric_features: List[str],
+        categorical_features: List[str],
+        ordinal_features: List[str],
+        nominal_features: List[str],
+        estimator=HistGradientBoostingRegressor(random_state=1),
+        multilabel_features: Optional[List[str]] = None,
+        memory=None,
+        dummy_labels: Optional[List[str]] = None,
+    ):
+        """
+        Initialize the class with the given estimator and feature lists.
+
+        Args:
+            numeric_features (List[str]): List of numeric feature names.
+            categorical_features (List[str]): List of categorical feature names.
+            ordinal_features (List[str]): List of ordinal feature names.
+            nominal_features (List[str]): List of nominal feature names.
+            estimator: The HistGradientBoostingRegressor to be used, its
+                categorical_features are set by the pipeline.
+            multilabel_features (List[str], optional): Comma-separated multi-valued
+                feature names, encoded as binary features. Defaults to None.
+            memory (str or joblib.Memory, optional): Cache directory of the fitted
+                preprocessor, see CustomPipeline. Defaults to None.
+            dummy_labels (List[str], optional): The labels of the column split in
+                dummies, see CustomPipeline. Defaults to None.
+        """
+        super().__init__(
+            numeric_features,
+            categorical_features,
+            ordinal_features,
+            nominal_features,
+            estimator=estimator,
+            feature_selection=False,
+            multilabel_features=multilabel_features,
+            memory=memory,
+            dummy_labels=dummy_labels,
+        )
+
+    def _create_pipeline(self) -> "Pipeline":
+        categorical_features = self.ordinal_features + self.nominal_features
+        # Unknown and missing categories are NaN, which the trees handle natively.
+        # The codes must be lower than max_bins, the rarest categories are grouped.
+        encoder = OrdinalEncoder(
+            handle_unknown="use_encoded_value",
+            unknown_value=np.nan,
+            encoded_missing_value=np.nan,
+            max_categories=self.estimator.max_bins,
+        )
+        transformers = [
+            ("numerical", "passthrough", self.numeric_features),
+            ("categorical", encoder, categorical_features),
+        ]
+        if self.multilabel_features:
+            transformers.append(
+                ("multilabel", MultiLabelEncoder(), self.multilabel_features)
+            )
+        preprocessor = ColumnTransformer(
+            transformers=transformers, remainder="drop", sparse_threshold=0.0
+        )
+
+        n_numeric = len(self.numeric_features)
+        estimator = clone(self.estimator).set_params(
+            categorical_features=list(
+                range(n_numeric, n_numeric + len(categorical_features))
+            )
+        )
+        return Pipeline(
+            steps=[("preprocessor", preprocessor), ("estimator", estimator)],
+            memory=self.memory,
+        )
@@ -0,0 +1,282 @@
+"""
+predict.py
+
+Batch prediction with the models dumped as .joblib files in models/supervised.
+
+The model is loaded with memory-mapped arrays, the observations are streamed by
+chunks from a CSV or Parquet file, or from the Parquet dataset written by
+run_data_quality.py, go through the same preprocessing as in preprocess_data
+(temporal features and dummies), and the predictions are written incrementally.
+The cold start time, the throughput and the peak memory are reported.
+
+    python -m models.supervised.predict model.joblib data/temporary_data/spipoll \
+        predictions.csv
+"""
+
+import argparse
+import os
+import time
+from typing import Iterator, List, Optional
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from data_quality.dataset import iter_dataset
+from data_quality.profiling import peak_memory_mb
+from models.preprocessors import DateToJulian, HourToCos, as_datetime, split_in_dummies
+
+
+def load_model(path: str, mmap_mode: Optional[str] = "r"):
+    """
+    Load a dumped model, memory-mapping its numpy arrays (e.g. the trees of a
+    RandomForest) instead of reading them in memory. The arrays of models dumped
+    with compression cannot be memory-mapped and are read as usual.
+
+    Args:
+        path (str): The .joblib file.
+        mmap_mode (str, optional): The numpy memory-map mode. Defaults to "r".
+
+    Returns:
+        Tuple: The model, usually a CustomPipeline, and the training labels of the
+        column split in dummies saved with it (its dummy_labels), None if unknown.
+    """
+    model = joblib.load(path, mmap_mode=mmap_mode)
+    return model, getattr(model, "dummy_labels", None)
+
+
+def required_features(model) -> List[str]:
+    """
+    Returns the input columns used by a model.
+
+    Args:
+        model: A CustomPipeline or a scikit-learn estimator fitted on a dataframe.
+
+    Returns:
+        List[str]: The column names.
+    """
+    if hasattr(model, "numeric_features"):
+        return (
+            model.numeric_features
+            + model.categorical_features
+            + (getattr(model, "multilabel_features", None) or [])
+        )
+    return list(model.feature_names_in_)
+
+
+def prepare_features(
+    chunk: pd.DataFrame,
+    features: List[str],
+    time_col: str = "collection_heure_debut",
+    dummy_col: Optional[str] = "habitat",
+    sep: str = ",",
+    dummy_labels: Optional[List[str]] = None,
+) -> "pd.DataFrame":
+    """
+    Apply the preprocessing of preprocess_data to a chunk of observations: the cosine
+    of the hour, the julian day and the dummies of dummy_col. The dummies of the
+    training labels of dummy_col absent from the chunk are zeros.
+
+    Args:
+        chunk (pd.DataFrame): The observations.
+        features (List[str]): The columns used by the model, see required_features.
+        time_col (str, optional): The time column. Defaults to "collection_heure_debut".
+        dummy_col (str, optional): The column split in dummies, None if the model does
+            not use dummies. Defaults to "habitat".
+        sep (str, optional): The separator of the dummies. Defaults to ",".
+        dummy_labels (List[str], optional): The labels of dummy_col seen during
+            training (the dummies_col returned by preprocess_data). Defaults to None
+            (no label may be absent from the chunk).
+
+    Returns:
+        pd.DataFrame: The features of the model.
+
+    Raises:
+        KeyError: If features other than the dummies of dummy_labels are missing.
+    """
+    if time_col in chunk.columns:
+        chunk[time_col] = as_datetime(chunk[time_col])
+        if time_col + "_cos" in features:
+            chunk = HourToCos(hour_col=time_col).fit_transform(chunk)
+        if time_col + "_julian" in features:
+            chunk = DateToJulian(date_col=time_col).fit_transform(chunk)
+    if dummy_col is not None and dummy_col in chunk.columns:
+        chunk, _ = split_in_dummies(chunk, dummy_col, sep)
+        # The labels seen during training but absent from the chunk
+        absent = [
+            col
+            for col in dummy_labels or []
+            if col in features and col not in chunk.columns
+        ]
+        chunk = chunk.assign(**{col: 0 for col in absent})
+    missing = [col for col in features if col not in chunk.columns]
+    if missing:
+        raise KeyError(f"Missing features: {missing}")
+    return chunk[features]
+
+
+def read_chunks(
+    path: str, chunksize: int, **read_csv_kwargs
+) -> Iterator[pd.DataFrame]:
+    """
+    Stream a CSV or Parquet file, or a dataset written by write_dataset, by chunks
+    of rows.
+
+    Args:
+        path (str): The file, Parquet if it ends with .parquet, or the dataset
+            directory, see iter_dataset.
+        chunksize (int): The number of rows of the chunks.
+        **read_csv_kwargs: Extra arguments of pandas.read_csv.
+
+    Yields:
+        pd.DataFrame: The chunks.
+    """
+    if os.path.isdir(path) or not os.path.exists(path):
+        # A dataset directory, or its CSV fallback
+        yield from iter_dataset(path, chunksize)
+    elif path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as error:
+            raise ImportError("Reading Parquet files requires pyarrow") from error
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, chunksize=chunksize, **read_csv_kwargs)
+
+
+def write_chunk(chunk: pd.DataFrame, path: str, first: bool, writer=None):
+    """
+    Append a chunk of predictions to a CSV or Parquet file.
+
+    Args:
+        chunk (pd.DataFrame): The predictions.
+        path (str): The file, Parquet if it ends with .parquet.
+        first (bool): Whether it is the first chunk, which creates the file.
+        writer (optional): The Parquet writer returned by the previous call.
+
+    Returns:
+        The Parquet writer, to be closed after the last chunk, or None for CSV.
+    """
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as error:
+            raise ImportError("Writing Parquet files requires pyarrow") from error
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if first:
+            writer = pq.ParquetWriter(path, table.schema)
+        writer.write_table(table)
+        return writer
+    chunk.to_csv(path, mode="w" if first else "a", header=first, index=False)
+    return None
+
+
+def predict_file(
+    model_path: str,
+    input_path: str,
+    output_path: str,
+    chunksize: int = 100_000,
+    id_cols: Optional[List[str]] = None,
+    time_col: str = "collection_heure_debut",
+    dummy_col: Optional[str] = "habitat",
+    sep: str = ",",
+    dummy_labels: Optional[List[str]] = None,
+    **read_csv_kwargs,
+) -> dict:
+    """
+    Predict the observations of a file by chunks and write the predictions
+    incrementally.
+
+    Args:
+        model_path (str): The dumped model, see load_model.
+        input_path (str): The CSV or Parquet observations, see read_chunks.
+        output_path (str): The CSV or Parquet predictions, with the id_cols and a
+            prediction column.
+        chunksize (int, optional): The number of rows predicted at once.
+            Defaults to 100000.
+        id_cols (List[str], optional): The input columns copied to the output, e.g.
+            collection_id. Defaults to None.
+        time_col (str, optional): The time column, see prepare_features.
+        dummy_col (str, optional): The column split in dummies, see prepare_features.
+        sep (str, optional): The separator of the dummies. Defaults to ",".
+        dummy_labels (List[str], optional): The training labels of dummy_col, see
+            prepare_features. Defaults to None (the labels saved with the model).
+        **read_csv_kwargs: Extra arguments of pandas.read_csv.
+
+    Returns:
+        dict: The cold start time (model loading, in seconds), the number of rows,
+        the prediction time, the throughput in rows/s and the peak memory in MB.
+    """
+    start = time.perf_counter()
+    model, model_dummy_labels = load_model(model_path)
+    features = required_features(model)
+    if dummy_labels is None:
+        dummy_labels = model_dummy_labels
+    cold_start = time.perf_counter() - start
+
+    id_cols = id_cols or []
+    n_rows, writer = 0, None
+    start = time.perf_counter()
+    for chunk in read_chunks(input_path, chunksize, **read_csv_kwargs):
+        predictions = chunk[id_cols].copy()
+        predictions["prediction"] = model.predict(
+            prepare_features(chunk, features, time_col, dummy_col, sep, dummy_labels)
+        )
+        writer = write_chunk(predictions, output_path, n_rows == 0, writer)
+        n_rows += len(chunk)
+    if writer is not None:
+        writer.close()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "cold_start_s": cold_start,
+        "rows": n_rows,
+        "predict_s": elapsed,
+        "rows_per_s": n_rows / elapsed if elapsed > 0 else np.nan,
+        "peak_memory_mb": peak_memory_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Batch prediction with a .joblib model"
+    )
+    parser.add_argument("model", help="The dumped model (.joblib)")
+    parser.add_argument(
+        "input", help="The observations (.csv, .parquet or a dataset directory)"
+    )
+    parser.add_argument("output", help="The predictions (.csv or .parquet)")
+    parser.add_argument("--chunksize", type=int, default=100_000)
+    parser.add_argument("--id-cols", nargs="*", default=["collection_id"])
+    parser.add_argument("--time-col", default="collection_heure_debut")
+    parser.add_argument("--dummy-col", default="habitat")
+    parser.add_argument(
+        "--dummy-labels",
+        nargs="*",
+        default=None,
+        help="The labels of the dummy column seen during training, "
+        "defaults to the labels saved with the model",
+    )
+    args = parser.parse_args()
+
+    report = predict_file(
+        args.model,
+        args.input,
+        args.output,
+        chunksize=args.chunksize,
+        id_cols=args.id_cols,
+        time_col=args.time_col,
+        dummy_col=args.dummy_col or None,
+        dummy_labels=args.dummy_labels,
+    )
+    print(f"Cold start: {report['cold_start_s']:.2f} s")
+    print(f"Predicted {report['rows']} rows in {report['predict_s']:.2f} s")
+    print(f"Throughput: {report['rows_per_s']:.0f} rows/s")
+    if report["peak_memory_mb"] is not None:
+        print(f"Peak memory: {report['peak_memory_mb']:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
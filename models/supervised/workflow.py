@@ -1,26 +1,28 @@
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 
 
-from typing import List, Tuple
+from typing import List, Optional, Tuple, Union
 
 from models.preprocessors import DateToJulian, HourToCos
-from models.preprocessors import MetricsCalculatorNaive as MetricsCalculator
+from models.preprocessors import MetricsCalculator
 from models.preprocessors import (
-    get_df_by_hours,
-    get_df_by_months,
+    as_datetime,
     split_in_dummies,
+    temporal_mask,
 )
 from models.supervised.pipeline import CustomPipeline
 
 
 def preprocess_data(
     data: pd.DataFrame,
-    distance: float,
+    distance: Union[float, List[float]],
     hour_range: List[int],
     month_range: List[int],
     col_to_dummy: str,
     insect_col: str,
+    n_jobs: Optional[int] = None,
 ) -> Tuple[pd.DataFrame, List[str]]:
     """
     Preprocess the input data by selecting by hour and month, transforming temporal features
@@ -30,29 +32,42 @@ def preprocess_data(
 
     Args:
         data (pd.DataFrame): The input data to be preprocessed.
-        distance (float): The distance value for metrics calculation.
+        distance (float or List[float]): The distance value(s) for metrics calculation.
         hour_range (List[int]): The range of hours to select in the data.
         month_range (List[int]): The range of months to select in the data.
         col_to_dummy (str): The name of the column to split into dummies.
         insect_col (str): The name of the column representing insects.
+        n_jobs (int, optional): The number of processes used for metrics calculation.
 
     Returns:
         Tuple[pd.DataFrame, List[str]]: The preprocessed data and the list of dummy column names.
     """
     print("\nPreprocessing data:\n--------------------\n")
-    # Select data by hour and month
-    data = get_df_by_hours(data, "collection_heure_debut", hour_range)
-    data = get_df_by_months(data, "collection_heure_debut", month_range)
+    # Parse the dates once, they are shared by the filter and transformers below
+    dates = as_datetime(data["collection_heure_debut"])
+    mask = temporal_mask(dates, hours=hour_range, months=month_range)
+
+    # Selecting the rows with one mask is the only copy of the frame (see
+    # benchmark_preprocessing.py)
+    rows = np.flatnonzero(mask)
+    data = data.take(rows)
+    times = data["collection_heure_debut"]
+    data["collection_heure_debut"] = dates.array[rows]
 
     # Temporal features transformation to numeric
     data = HourToCos(hour_col="collection_heure_debut").fit_transform(data)
     data = DateToJulian(date_col="collection_heure_debut").fit_transform(data)
+    # The time column is returned as given
+    data["collection_heure_debut"] = times
 
     data, dummies_col = split_in_dummies(data, col_to_dummy)
 
     # Compute metrics target
     calculator = MetricsCalculator(
-        distance=distance, clear_intermediate_steps=False, insect_col=insect_col
+        distance=distance,
+        clear_intermediate_steps=False,
+        insect_col=insect_col,
+        n_jobs=n_jobs,
     )
     calculator.fit(data)
     data = calculator.transform(data)
@@ -81,6 +96,8 @@ def train_pipe(
     nominal_features,
     y_column_name,
     sampler,
+    multilabel_features=None,
+    dummy_labels=None,
 ):
     """
     Train the pipeline with the given transformed dataframe and features, 
@@ -94,16 +111,29 @@ def train_pipe(
         nominal_features: List of nominal features
         y_column_name: Name of the target column
         sampler: Sampler for handling imbalanced data
+        multilabel_features: List of comma-separated multi-valued features, encoded
+            as sparse dummies instead of split_in_dummies columns
+        dummy_labels: The dummies_col returned by preprocess_data, saved with the
+            pipeline for the batch predictions
 
     Returns:
         Trained pipeline, test features, and test labels
     """
     print("\nTraining pipeline:\n--------------------\n")
+    multilabel_features = multilabel_features or []
     X_train, X_test, y_train, y_test = get_training_data(
-        df_transformed, numeric_features + categorical_features, sampler, y_column_name
+        df_transformed,
+        numeric_features + categorical_features + multilabel_features,
+        sampler,
+        y_column_name,
     )
     pipe = CustomPipeline(
-        numeric_features, categorical_features, ordinal_features, nominal_features
+        numeric_features,
+        categorical_features,
+        ordinal_features,
+        nominal_features,
+        multilabel_features=multilabel_features,
+        dummy_labels=dummy_labels,
     )
 
     pipe.fit(X_train, y_train)
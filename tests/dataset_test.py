@@ -0,0 +1,65 @@
+import pandas as pd
+import pytest
+
+from data_quality.dataset import add_partition_col, read_dataset, write_dataset
+
+
+def create_spipoll_data():
+    return pd.DataFrame(
+        {
+            "collection_id": [1, 2, 3, 4],
+            "collection_date": ["2019-06-01", "2020-07-02", "2020-08-03", "2021-05-04"],
+            "insecte_ordre": ["Diptera", "Hymenoptera", "Diptera", "Coleoptera"],
+            "latitude": [45.0, 46.0, 47.0, 48.0],
+        }
+    )
+
+
+def test_read_dataset_csv(tmp_path):
+    path = str(tmp_path / "spipoll.csv")
+    write_dataset(add_partition_col(create_spipoll_data()), path, format="csv")
+    df = read_dataset(path, columns=["collection_id"], years=[2020])
+    assert df.columns.tolist() == ["collection_id"]
+    assert df["collection_id"].tolist() == [2, 3]
+
+
+def test_read_dataset_csv_without_partition_col(tmp_path):
+    # A CSV file written before the datasets, found from the dataset path
+    create_spipoll_data().to_csv(tmp_path / "spipoll.csv", index=False)
+    df = read_dataset(str(tmp_path / "spipoll"), columns=["collection_id"], years=[2020])
+    assert df["collection_id"].tolist() == [2, 3]
+
+
+def test_read_dataset_parquet_partitioned_by_year(tmp_path):
+    pytest.importorskip("pyarrow")
+    path = str(tmp_path / "spipoll")
+    write_dataset(add_partition_col(create_spipoll_data()), path)
+    assert sorted(p.name for p in (tmp_path / "spipoll").iterdir()) == [
+        "collection_year=2019", "collection_year=2020", "collection_year=2021"
+    ]
+
+    df = read_dataset(
+        path,
+        columns=["collection_id", "insecte_ordre"],
+        years=[2020, 2021],
+        filters=[("latitude", ">", 46.5)],
+    )
+    assert df["collection_id"].tolist() == [3, 4]
+    assert isinstance(df["insecte_ordre"].dtype, pd.CategoricalDtype)
+
+
+def test_read_dataset_parquet_round_trip(tmp_path):
+    pytest.importorskip("pyarrow")
+    path = str(tmp_path / "spipoll")
+    data = create_spipoll_data()
+    data.loc[1, "collection_date"] = None
+    write_dataset(add_partition_col(data), path)
+
+    df = read_dataset(path).sort_values("collection_id", ignore_index=True)
+    assert df["collection_year"].dtype == "Int32"
+    assert df["collection_year"].tolist() == [2019, pd.NA, 2020, 2021]
+    assert df["insecte_ordre"].astype(str).tolist() == data["insecte_ordre"].tolist()
+
+    df = read_dataset(path, columns=["collection_id", "collection_year"], years=[2020])
+    assert df["collection_id"].tolist() == [3]
+    assert df["collection_year"].tolist() == [2020]
@@ -0,0 +1,72 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_quality.position_filters.filters import (classify_collections,
+                                                   geo_filter)
+
+
+def create_collections():
+    return pd.DataFrame(
+        {
+            "collection_id": [1, 1, 2, 3, 4, 5],
+            "latitude": [48.85, 48.85, 16.25, 45.76, 50.85, np.nan],
+            "longitude": [2.35, 2.35, -61.58, 4.84, 4.35, np.nan],
+            "code_postal": ["75005", "75005", "97110", "97200", "1000", "69001"],
+        }
+    )
+
+
+def test_classify_collections():
+    df_poste = pd.DataFrame({"Code_postal": ["75005", "69001", "97110"]})
+    collections = classify_collections(create_collections(), df_poste)
+    assert collections["collection_id"].tolist() == [1, 2, 3, 4, 5]
+    assert collections["France metropolitaine"].tolist() == [True, False, False, False, True]
+    # Coordinates decide when known, the postal code otherwise
+    assert collections["metropole"].tolist() == [True, False, True, True, True]
+
+
+def test_geo_filter_moves_rows_by_coordinates():
+    collections = create_collections().drop_duplicates("collection_id").dropna()
+    metropole, hors_metropole = geo_filter(collections.iloc[:2], collections.iloc[2:])
+    assert sorted(metropole["collection_id"]) == [1, 3, 4]
+    assert sorted(hors_metropole["collection_id"]) == [2]
+
+
+def test_france_boundary_matches_exact_point_in_polygon(tmp_path):
+    shapely = pytest.importorskip("shapely")
+    from data_quality.position_filters.boundary import FranceBoundary
+
+    # A rough hexagon around Metropolitan France and a square for Corsica
+    polygon = shapely.Polygon(
+        [(-4.8, 48.4), (2.5, 51.1), (8.2, 49.0), (7.4, 43.7), (3.1, 42.4), (-1.8, 43.4)]
+    )
+    corsica = shapely.box(8.5, 41.3, 9.6, 43.1)
+    path = tmp_path / "metropole.geojson"
+    path.write_text(
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    {"type": "Feature", "geometry": shapely.geometry.mapping(geometry)}
+                    for geometry in (polygon, corsica)
+                ],
+            }
+        )
+    )
+    boundary = FranceBoundary.from_file(str(path), cell_size=0.2)
+
+    rng = np.random.default_rng(0)
+    latitude = rng.uniform(40, 53, 20000)
+    longitude = rng.uniform(-7, 11, 20000)
+    latitude[:2] = np.nan
+    expected = shapely.contains_xy(polygon.union(corsica), longitude, latitude)
+    np.testing.assert_array_equal(boundary.contains(latitude, longitude), expected)
+
+    # Brussels is in the bounding box, not in the polygon
+    collections = classify_collections(
+        create_collections(), pd.DataFrame({"Code_postal": ["75005"]}), boundary=boundary
+    )
+    assert collections["metropole"].tolist() == [True, False, True, False, False]
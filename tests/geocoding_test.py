@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+
+from data_quality.position_filters.filters import classify_collections
+from data_quality.position_filters.geocoding import (postal_code_centroids,
+                                                     postal_code_index,
+                                                     reverse_geocode)
+
+
+def create_poste():
+    return pd.DataFrame(
+        {
+            "#Code_commune_INSEE": ["35238", "68066", "2A004", "97209", "35051"],
+            "Nom_de_la_commune": ["RENNES", "COLMAR", "AJACCIO", "FORT DE FRANCE", "CESSON SEVIGNE"],
+            "Code_postal": ["35000", "68000", "20000", "97200", "35510"],
+        }
+    )
+
+
+def test_postal_code_index():
+    index = postal_code_index(create_poste())
+    assert index.loc["35000", "nom_commune"] == "RENNES"
+    assert index.loc["20000", "departement"] == "2A"
+    assert index.loc["97200", "departement"] == "972"
+    assert index["n_communes"].eq(1).all()
+
+
+def test_postal_code_index_ambiguous_communes():
+    poste = pd.DataFrame(
+        {
+            "#Code_commune_INSEE": ["01004", "01007", "98611", "98612"],
+            "Nom_de_la_commune": ["AMBERIEU EN BUGEY", "AMBRONAY", "ALO", "SIGAVE"],
+            "Code_postal": ["01500", "01500", "98610", "98620"],
+        }
+    )
+    index = postal_code_index(poste)
+    # The commune of a postal code serving several communes is unknown
+    assert index.loc["01500", "n_communes"] == 2
+    assert index.loc["01500", ["code_commune", "nom_commune"]].isna().all()
+    assert index.loc["01500", "departement"] == "01"
+    assert index.loc["98610", "departement"] == "986"
+
+    collections = pd.DataFrame(
+        {
+            "latitude": [45.96, np.nan],
+            "longitude": [5.36, np.nan],
+            "code_postal": ["01500", None],
+        }
+    )
+    geocoded = reverse_geocode(collections, poste)
+    assert geocoded.loc[0, "n_communes"] == 2
+    assert pd.isna(geocoded.loc[1, "n_communes"])
+    assert pd.isna(geocoded.loc[0, "nom_commune"])
+    assert geocoded.loc[0, "departement"] == "01"
+
+
+def test_reverse_geocode_falls_back_to_nearest_centroid():
+    collections = pd.DataFrame(
+        {
+            "collection_id": range(7),
+            "latitude": [48.11, 48.12, 48.08, 48.08, 48.10, np.nan, 48.09],
+            "longitude": [-1.68, -1.67, 7.36, 7.35, 7.37, np.nan, 7.36],
+            # Missing, unknown and inconsistent (Rennes code in Colmar) codes
+            "code_postal": ["35000", "35000", "68000", "68000", None, None, "35000"],
+        }
+    )
+    geocoded = reverse_geocode(collections, create_poste(), max_distance_km=30)
+    located = geocoded.drop(index=5)
+    assert located["nom_commune"].tolist() == ["RENNES", "RENNES"] + ["COLMAR"] * 4
+    assert located["departement"].tolist() == ["35", "35"] + ["68"] * 4
+    assert located["geocodage"].tolist() == ["code_postal"] * 4 + ["centroide"] * 2
+    # No postal code and no coordinates
+    assert geocoded.loc[5, ["departement", "geocodage"]].isna().all()
+
+
+def test_postal_code_centroids_ignore_codes_entered_at_random():
+    collections = pd.DataFrame(
+        {
+            # Bordeaux, Lille, Nice and Colmar with the postal code of Colmar
+            "latitude": [48.11, 48.12, 48.10, 44.84, 50.63, 43.70, 48.08],
+            "longitude": [-1.68, -1.67, -1.69, -0.58, 3.06, 7.27, 7.36],
+            "code_postal": ["35000"] * 3 + ["68000"] * 4,
+        }
+    )
+    centroids = postal_code_centroids(collections, postal_code_index(create_poste()))
+    assert centroids.index.tolist() == ["35000"]
+    assert centroids.loc["35000", "count"] == 3
+    assert centroids.loc["35000", "latitude"] == 48.11
+
+
+def test_postal_codes_are_normalised_once_for_all_steps():
+    # The postal codes read as integers lose their leading zero
+    poste = pd.DataFrame(
+        {
+            "#Code_commune_INSEE": [1053],
+            "Nom_de_la_commune": ["BOURG EN BRESSE"],
+            "Code_postal": [1000],
+        }
+    )
+    collections = pd.DataFrame(
+        {
+            "collection_id": [1, 2],
+            "latitude": [46.20, 46.21],
+            "longitude": [5.22, 5.23],
+            "code_postal": ["01000", "1000"],
+        }
+    )
+    classified = classify_collections(collections, poste)
+    assert classified["France metropolitaine"].tolist() == [True, True]
+    geocoded = reverse_geocode(collections, poste)
+    assert geocoded["code_commune"].tolist() == ["01053", "01053"]
+    assert geocoded["departement"].tolist() == ["01", "01"]
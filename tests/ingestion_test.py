@@ -0,0 +1,63 @@
+import pandas as pd
+
+from data_quality.ingestion import read_export, read_spipoll_exports
+
+
+def test_read_spipoll_exports(tmp_path):
+    exports = [
+        pd.DataFrame(
+            {
+                "collection_id": [1, 2],
+                "user_email": ["a@b.fr", "c@d.fr"],
+                "coordonnees_GPS": ["45.5, 6.25", "48.8, 2.35"],
+                "code_postal": ["01000", "75005"],
+                "insecte_ordre": ["Diptera", "Hymenoptera"],
+            }
+        ),
+        pd.DataFrame(
+            {
+                "collection_id": [3],
+                "user_email": ["e@f.fr"],
+                "coordonnees_GPS": ["43.1, -1.5"],
+                "code_postal": ["64100"],
+                "insecte_ordre": ["Coleoptera"],
+            }
+        ),
+    ]
+    paths = []
+    for i, export in enumerate(exports):
+        paths.append(str(tmp_path / f"export_{i}.txt"))
+        export.to_csv(paths[-1], sep="\t", index=False)
+
+    df = read_spipoll_exports(paths, ["user_email"], chunksize=1)
+    assert list(df.columns) == [
+        "collection_id", "code_postal", "insecte_ordre", "latitude", "longitude"
+    ]
+    assert df["collection_id"].tolist() == [1, 2, 3]
+    assert df["code_postal"].tolist() == ["01000", "75005", "64100"]
+    assert isinstance(df["insecte_ordre"].dtype, pd.CategoricalDtype)
+    assert df["insecte_ordre"].tolist() == ["Diptera", "Hymenoptera", "Coleoptera"]
+    assert df["latitude"].tolist() == [45.5, 48.8, 43.1]
+    assert df["longitude"].tolist() == [6.25, 2.35, -1.5]
+
+
+def test_read_export_malformed_coordinates(tmp_path):
+    path = tmp_path / "export.txt"
+    pd.DataFrame(
+        {
+            "collection_id": [1, 2, 3, 4],
+            "coordonnees_GPS": [None, "45.5", "n/a", "43.1,-1.5"],
+        }
+    ).to_csv(path, sep="\t", index=False)
+
+    # The first chunks have no well formed coordinates
+    chunks = read_export(str(path), [], chunksize=2)
+    df = pd.concat(chunks, ignore_index=True)
+    assert df["latitude"].dtype == "float64"
+    assert df["latitude"].isna().tolist() == [True, True, True, False]
+    assert df["latitude"].iloc[3] == 43.1
+    assert df["longitude"].iloc[3] == -1.5
+
+    # Only missing coordinates
+    chunks = read_export(str(path), [], chunksize=1)
+    assert chunks[0][["latitude", "longitude"]].isna().all(axis=None)
@@ -0,0 +1,39 @@
+import numpy as np
+from sklearn.neighbors import KDTree
+
+from models.neighbor_graph import (NeighborGraph, concatenate_graphs,
+                                   graph_key, query_neighbor_graph)
+
+
+def test_query_neighbor_graph():
+    points = np.array([[0.0, 0.0], [0.0, 1.0], [0.0, 3.0]])
+    tree = KDTree(points)
+    graph = query_neighbor_graph(tree, points, 1.5, return_distance=True)
+    assert graph.indptr.dtype == np.int32
+    assert graph.indices.dtype == np.int32
+    assert sorted(graph.neighbors(0)) == [0, 1]
+    assert sorted(graph.neighbors(2)) == [2]
+    assert graph.to_csr_matrix()[0, 1] == 1.0
+
+
+def test_save_and_load(tmp_path):
+    points = np.array([[0.0, 0.0], [0.0, 1.0], [0.0, 3.0]])
+    tree = KDTree(points)
+    graph = concatenate_graphs(
+        [
+            query_neighbor_graph(tree, points[:1], 2.5, return_distance=True),
+            query_neighbor_graph(tree, points[1:], 2.5, return_distance=True),
+        ]
+    )
+    graph.save(str(tmp_path))
+    loaded = NeighborGraph.load(str(tmp_path))
+    assert isinstance(loaded.indices, np.memmap)
+    assert loaded.indptr.tolist() == graph.indptr.tolist()
+    assert loaded.indices.tolist() == graph.indices.tolist()
+    assert loaded.slice(1, 3).indptr.tolist() == [0, 3, 5]
+
+
+def test_graph_key():
+    points = np.array([[0.0, 0.0], [0.0, 1.0]])
+    assert graph_key(points, radius=1.0) == graph_key(points.copy(), radius=1.0)
+    assert graph_key(points, radius=1.0) != graph_key(points, radius=2.0)
@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse
+from sklearn.feature_selection import SelectFromModel
+from sklearn.linear_model import Ridge
+
+from models.preprocessors import SpatialBlockSplitter, spatial_blocks
+from models.supervised.pipeline import CustomPipeline, HistGradientBoostingPipeline
+
+
+class CountingRidge(Ridge):
+    # Counts the fits of the feature selector, which are skipped when cached
+    n_fits = 0
+
+    def fit(self, X, y, sample_weight=None):
+        CountingRidge.n_fits += 1
+        return super().fit(X, y, sample_weight=sample_weight)
+
+
+def create_training_data(n=200):
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(
+        {
+            "hour_cos": rng.uniform(-1, 1, n),
+            "vent": rng.choice(["faible", "fort"], n),
+            "plante_famille": rng.choice(["Asteraceae", "Rosaceae", "Apiaceae"], n),
+            "habitat": rng.choice(["prairie,jardin", "jardin", "foret,prairie"], n),
+        }
+    )
+    y = pd.Series(X["habitat"].str.contains("prairie") * 2.0 + X["hour_cos"])
+    return X, y
+
+
+def test_custom_pipeline_multilabel_features_stay_sparse():
+    X, y = create_training_data()
+    pipe = CustomPipeline(
+        ["hour_cos"],
+        ["vent", "plante_famille"],
+        ["vent"],
+        ["plante_famille"],
+        estimator=Ridge(),
+        feature_selection=False,
+        multilabel_features=["habitat"],
+    )
+    pipe.fit(X, y)
+    assert issparse(pipe.pipeline["preprocessor"].transform(X))
+    assert pipe.score(X, y) > 0.9
+
+
+def test_custom_pipeline_cross_validate_with_spatial_blocks():
+    X, y = create_training_data(400)
+    rng = np.random.default_rng(1)
+    X["latitude"] = rng.uniform(43, 49, len(X))
+    X["longitude"] = rng.uniform(-1, 7, len(X))
+    splitter = SpatialBlockSplitter(n_splits=4, block_size=1.0)
+
+    folds = list(splitter.split(X, y))
+    assert len(folds) == 4
+    blocks = spatial_blocks(X["latitude"], X["longitude"], 1.0)
+    test_blocks = [set(blocks[test]) for _, test in folds]
+    for i, fold_blocks in enumerate(test_blocks):
+        assert all(fold_blocks.isdisjoint(other) for other in test_blocks[i + 1 :])
+    tested = np.sort(np.concatenate([test for _, test in folds]))
+    assert np.array_equal(tested, np.arange(len(X)))
+
+    pipe = CustomPipeline(
+        ["hour_cos"],
+        ["vent", "plante_famille"],
+        ["vent"],
+        ["plante_famille"],
+        estimator=Ridge(),
+        feature_selection=False,
+        multilabel_features=["habitat"],
+    )
+    results = pipe.cross_validate(X, y, cv=splitter, n_jobs=2)
+    assert len(results["test_r2"]) == 4
+    assert np.all(results["test_mse"] >= 0)
+
+
+def test_spatial_block_splitter_undersamples_training_folds_only():
+    X, y = create_training_data(400)
+    y = pd.Series(np.tile([0.0, 1.0], 200))
+    groups = np.arange(len(X)) // 40
+    splitter = SpatialBlockSplitter(
+        n_splits=5,
+        min_thresholds=[-0.5],
+        max_thresholds=[0.5],
+        sample_percentages=[0.0],
+    )
+    for train, test in splitter.split(X, y, groups=groups):
+        assert np.all(y.iloc[train] == 1)
+        assert np.count_nonzero(y.iloc[test] == 0) > 0
+
+
+def test_custom_pipeline_caches_fitted_preprocessor(tmp_path):
+    X, y = create_training_data()
+    pipe = CustomPipeline(
+        ["hour_cos"],
+        ["vent", "plante_famille"],
+        ["vent"],
+        ["plante_famille"],
+        estimator=Ridge(),
+        memory=str(tmp_path),
+    )
+    pipe.fit(X, y)
+    cached = sorted(path.name for path in tmp_path.rglob("*"))
+    assert cached
+
+    # Only the estimator changes, the preprocessor and selector are loaded from the cache
+    pipe.pipeline.set_params(estimator__alpha=10.0)
+    pipe.fit(X, y)
+    assert sorted(path.name for path in tmp_path.rglob("*")) == cached
+
+
+def test_custom_pipeline_tree_imputer():
+    X, y = create_training_data()
+    X.loc[::7, "hour_cos"] = np.nan
+    pipe = CustomPipeline(
+        ["hour_cos"],
+        ["vent", "plante_famille"],
+        ["vent"],
+        ["plante_famille"],
+        estimator=Ridge(),
+        imputer="tree",
+    )
+    pipe.fit(X, y)
+    assert np.isfinite(pipe.predict(X)).all()
+
+
+def test_hist_gradient_boosting_pipeline():
+    X, y = create_training_data()
+    X.loc[::9, "plante_famille"] = np.nan
+    pipe = HistGradientBoostingPipeline(
+        ["hour_cos"],
+        ["vent", "plante_famille"],
+        ["vent"],
+        ["plante_famille"],
+        multilabel_features=["habitat"],
+    )
+    pipe.fit(X, y)
+    assert pipe.pipeline["estimator"].is_categorical_.tolist() == [
+        False, True, True, False, False, False
+    ]
+    unseen = X.assign(plante_famille="Fabaceae")
+    assert np.isfinite(pipe.predict(unseen)).all()
+    r2, _, _ = pipe.get_metrics(X, y)
+    assert r2 > 0.9
+
+
+def test_custom_pipeline_selects_features_on_sparse_input(tmp_path):
+    X, y = create_training_data(300)
+    rng = np.random.default_rng(2)
+    X["plante_espece"] = rng.choice([f"espece_{i}" for i in range(60)], len(X))
+    y = pd.Series((X["plante_famille"] == "Rosaceae") * 2.0 + X["hour_cos"])
+    pipe = CustomPipeline(
+        ["hour_cos"],
+        ["plante_famille", "plante_espece"],
+        [],
+        ["plante_famille", "plante_espece"],
+        estimator=Ridge(),
+        memory=str(tmp_path),
+    )
+    # Without multi-label features, the one-hot output stays sparse too
+    pipe.pipeline.set_params(feature_selector__estimator=CountingRidge())
+    CountingRidge.n_fits = 0
+    pipe.fit(X, y)
+    Xt = pipe.pipeline["preprocessor"].transform(X)
+    assert issparse(Xt)
+    selector = pipe.pipeline["feature_selector"]
+    assert selector.estimator_.solver_ == "sparse_cg"
+    assert CountingRidge.n_fits == 1
+
+    # The mask is the one of the baseline selector fitted on the dense output
+    baseline = SelectFromModel(Ridge()).fit(Xt.toarray(), y)
+    assert np.array_equal(selector.get_support(), baseline.get_support())
+
+    # The refit with another estimator reuses the cached selector
+    pipe.pipeline.set_params(estimator__alpha=10.0)
+    pipe.fit(X, y)
+    assert CountingRidge.n_fits == 1
+    assert np.array_equal(
+        pipe.pipeline["feature_selector"].get_support(), baseline.get_support()
+    )
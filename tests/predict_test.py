@@ -0,0 +1,118 @@
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.linear_model import Ridge
+
+from data_quality.dataset import add_partition_col, write_dataset
+from models.supervised.pipeline import CustomPipeline
+from models.supervised.predict import predict_file, prepare_features
+
+
+def create_observations(n=120):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        {
+            "collection_id": np.arange(n),
+            "collection_heure_debut": pd.Series(
+                pd.Timestamp("2021-03-01")
+                + pd.to_timedelta(rng.integers(0, 10**7, n), unit="s")
+            ).dt.strftime("%Y-%m-%d %H:%M:%S"),
+            "plante_famille": rng.choice(["Asteraceae", "Rosaceae"], n),
+            "habitat": rng.choice(["prairie,jardin", "jardin", "foret"], n),
+        }
+    )
+
+
+def test_predict_file_matches_predict(tmp_path):
+    observations = create_observations()
+    features = [
+        "collection_heure_debut_cos",
+        "collection_heure_debut_julian",
+        "plante_famille",
+        "foret",
+        "jardin",
+        "prairie",
+    ]
+    X = prepare_features(observations.copy(), features)
+    y = X["collection_heure_debut_cos"] + X["prairie"]
+    pipe = CustomPipeline(
+        features[:2],
+        features[2:],
+        [],
+        features[2:],
+        estimator=Ridge(),
+    )
+    pipe.fit(X, y)
+    joblib.dump(pipe, tmp_path / "model.joblib")
+    observations.to_csv(tmp_path / "observations.csv", index=False)
+
+    report = predict_file(
+        str(tmp_path / "model.joblib"),
+        str(tmp_path / "observations.csv"),
+        str(tmp_path / "predictions.csv"),
+        chunksize=50,
+        id_cols=["collection_id"],
+    )
+    predictions = pd.read_csv(tmp_path / "predictions.csv")
+    assert report["rows"] == len(observations)
+    assert report["rows_per_s"] > 0
+    assert predictions["collection_id"].tolist() == observations["collection_id"].tolist()
+    assert np.allclose(predictions["prediction"], pipe.predict(X))
+
+
+def test_predict_file_reads_a_dataset_with_the_saved_dummy_labels(tmp_path):
+    pytest.importorskip("pyarrow")
+    observations = create_observations()
+    features = ["collection_heure_debut_cos", "plante_famille", "foret", "prairie"]
+    X = prepare_features(observations.copy(), features)
+    pipe = CustomPipeline(
+        features[:1],
+        features[1:],
+        [],
+        features[1:],
+        estimator=Ridge(),
+        dummy_labels=["foret", "jardin", "prairie"],
+    )
+    pipe.fit(X, X["collection_heure_debut_cos"] + X["prairie"])
+    joblib.dump(pipe, tmp_path / "model.joblib")
+    # No chunk has the foret label, which is filled from the saved labels
+    observations["habitat"] = "prairie,jardin"
+    observations["collection_date"] = observations["collection_heure_debut"].str[:10]
+    write_dataset(add_partition_col(observations.copy()), str(tmp_path / "spipoll"))
+
+    report = predict_file(
+        str(tmp_path / "model.joblib"),
+        str(tmp_path / "spipoll"),
+        str(tmp_path / "predictions.csv"),
+        chunksize=50,
+        id_cols=["collection_id"],
+    )
+    predictions = pd.read_csv(tmp_path / "predictions.csv")
+    assert report["rows"] == len(observations)
+    expected = pipe.predict(
+        prepare_features(observations.copy(), features, dummy_labels=pipe.dummy_labels)
+    )
+    predictions = predictions.sort_values("collection_id")
+    assert predictions["collection_id"].tolist() == observations["collection_id"].tolist()
+    assert np.allclose(predictions["prediction"], expected)
+
+
+def test_prepare_features_only_fills_absent_dummies():
+    features = ["collection_heure_debut_cos", "plante_famille", "foret", "prairie"]
+    observations = create_observations().assign(habitat="prairie")
+    X = prepare_features(
+        observations.copy(), features, dummy_labels=["foret", "jardin", "prairie"]
+    )
+    assert X["foret"].eq(0).all()
+    assert X["prairie"].eq(1).all()
+
+    with pytest.raises(KeyError, match="plante_famille"):
+        prepare_features(
+            observations.drop(columns="plante_famille"),
+            features,
+            dummy_labels=["foret", "jardin", "prairie"],
+        )
+    # Without the training labels, an absent label is a missing feature
+    with pytest.raises(KeyError, match="foret"):
+        prepare_features(observations.copy(), features)
@@ -1,9 +1,14 @@
+import numpy as np
 import pandas as pd
 import pytest
 
-from models.preprocessors import (DateToJulian, HourToCos,
-                                  MetricsCalculatorNaive, get_df_by_hours,
-                                  get_df_by_months)
+from models.preprocessors import (DateToJulian, HourToCos, MetricsCalculator,
+                                  MetricsCalculatorNaive, MultiLabelEncoder,
+                                  TrainTestUnderSampler, TreeKNNImputer,
+                                  as_datetime, count_distinct, get_df_by_hours,
+                                  get_df_by_months, size_chunks,
+                                  split_in_dummies, temporal_mask,
+                                  undersample_indices)
 
 
 @pytest.fixture
@@ -18,6 +23,32 @@ def create_test_data():
     return pd.DataFrame(data)
 
 
+def create_random_data(
+    seed, n=300, on_grid=False, missing_insects=False, with_times=False
+):
+    # Random observations on a 5 x 5 degrees square, on a grid of 0.25 degree
+    # steps so that several rows share their location with on_grid
+    rng = np.random.default_rng(seed)
+    if on_grid:
+        coordinates = rng.integers(0, 20, (n, 2)) / 4
+    else:
+        coordinates = rng.uniform(0, 5, (n, 2))
+    insects = ["A", "B", "C", "D"] + ([None] if missing_insects else [])
+    data = pd.DataFrame(
+        {
+            "latitude": coordinates[:, 0],
+            "longitude": coordinates[:, 1],
+            "insecte_fr": rng.choice(insects, n),
+            "collection_id": rng.integers(0, n // 6, n),
+        }
+    )
+    if with_times:
+        data["collection_heure_debut"] = pd.Timestamp("2020-01-01") + pd.to_timedelta(
+            rng.integers(0, 3 * 365 * 24, n), unit="h"
+        )
+    return data
+
+
 def test_fit():
     # Test the fit method of MetricsCalculatorNaive
     calculator = MetricsCalculatorNaive(distance=1)
@@ -89,3 +120,397 @@ def test_get_df_by_months():
     df = pd.DataFrame({"time": ["2023-07-04 08:00:00", "2023-10-12 12:00:00"]})
     selected_df = get_df_by_months(df, "time", [10])
     assert len(selected_df) == 1
+
+
+def test_metrics_calculator_matches_naive():
+    data = create_random_data(0, on_grid=True, missing_insects=True)
+    expected = MetricsCalculatorNaive(
+        distance=0.5, clear_intermediate_steps=False
+    ).fit_transform(data.copy())
+    transformed_data = MetricsCalculator(
+        distance=0.5, clear_intermediate_steps=False
+    ).fit_transform(data.copy())
+    pd.testing.assert_frame_equal(transformed_data, expected, check_dtype=False)
+
+
+def test_metrics_calculator_parallel_is_deterministic():
+    data = create_random_data(1, n=500)
+    expected = MetricsCalculator(distance=0.5).fit_transform(data.copy())
+    transformed_data = MetricsCalculator(
+        distance=0.5, n_jobs=2, chunk_size=7
+    ).fit_transform(data.copy())
+    pd.testing.assert_frame_equal(transformed_data, expected)
+
+
+@pytest.mark.parametrize("time_window", [None, 30])
+def test_metrics_calculator_max_neighbors(tmp_path, time_window):
+    # Chunks split by the size of their neighborhoods give the same metrics
+    data = create_random_data(8, n=400, on_grid=True, with_times=True)
+    kwargs = {"distance": [0.25, 0.5], "time_window": time_window}
+    expected = MetricsCalculator(**kwargs).fit_transform(data.copy())
+    for graph_cache in [None, str(tmp_path)]:
+        transformed_data = MetricsCalculator(
+            max_neighbors=5, graph_cache=graph_cache, **kwargs
+        ).fit_transform(data.copy())
+        pd.testing.assert_frame_equal(transformed_data, expected)
+
+
+def test_size_chunks():
+    bounds = size_chunks(np.array([3, 1, 1, 5, 2, 2, 2]), max_count=2, max_size=4)
+    assert bounds.tolist() == [0, 2, 3, 4, 6, 7]
+    assert size_chunks(np.zeros(0, int), max_count=2, max_size=4).tolist() == [0]
+
+
+def test_metrics_calculator_several_distances():
+    data = create_random_data(2)
+    transformed_data = MetricsCalculator(
+        distance=[0.1, 0.5], clear_intermediate_steps=False
+    ).fit_transform(data.copy())
+    for distance in [0.1, 0.5]:
+        expected = MetricsCalculator(
+            distance=distance, clear_intermediate_steps=False
+        ).fit_transform(data.copy())
+        for col in ["specific_richness", "density", "weighted_specific_richness"]:
+            assert (
+                transformed_data[f"{col}_d{distance}"].tolist() == expected[col].tolist()
+            )
+
+
+def test_metrics_calculator_haversine():
+    # Paris, 20 km further east, and Lille (about 200 km north)
+    data = pd.DataFrame(
+        {
+            "latitude": [48.8566, 48.8566, 50.6292],
+            "longitude": [2.3522, 2.6255, 3.0573],
+            "insecte_fr": ["A", "B", "A"],
+            "collection_id": [1, 2, 3],
+        }
+    )
+    calculator = MetricsCalculator(
+        distance=[25, 250], metric="haversine", clear_intermediate_steps=False
+    )
+    transformed_data = calculator.fit_transform(data)
+    assert transformed_data["density_d25"].tolist() == [2, 2, 1]
+    assert transformed_data["density_d250"].tolist() == [3, 3, 3]
+    assert transformed_data["specific_richness_d25"].tolist() == [2, 2, 1]
+
+
+def test_metrics_calculator_time_window():
+    n = 400
+    data = create_random_data(3, n=n, with_times=True)
+    days = data["collection_heure_debut"].to_numpy().astype("datetime64[s]")
+    years = data["collection_heure_debut"].dt.year.to_numpy()
+    for time_window in [15, "year"]:
+        transformed_data = MetricsCalculator(
+            distance=0.5, time_window=time_window, clear_intermediate_steps=False
+        ).fit_transform(data.copy())
+        for i in range(0, n, 37):
+            close = (np.abs(data["latitude"] - data["latitude"][i]) < 0.5) & (
+                np.abs(data["longitude"] - data["longitude"][i]) < 0.5
+            )
+            if time_window == "year":
+                close &= years == years[i]
+            else:
+                close &= np.abs(days - days[i]) <= np.timedelta64(15, "D")
+            assert transformed_data["density"][i] == close.sum()
+            assert (
+                transformed_data["specific_richness"][i]
+                == data.loc[close, "insecte_fr"].nunique()
+            )
+
+
+def test_metrics_calculator_fit_transform(create_test_data):
+    calculator = MetricsCalculator(distance=1.5, clear_intermediate_steps=False)
+    transformed_data = calculator.fit_transform(create_test_data)
+    assert transformed_data.iloc[-1]["specific_richness"] == 1
+    assert transformed_data.iloc[0]["density"] == 2
+    assert transformed_data.iloc[2]["density"] == 3
+    assert transformed_data.iloc[2]["collection_id_density"] == 2
+    assert transformed_data.iloc[2]["weighted_specific_richness"] == 3 / 2
+
+
+def test_count_distinct():
+    owners = np.array([0, 0, 0, 2, 2, 3])
+    codes = np.array([1, 1, 4, -1, 0, 2])
+    counts = count_distinct(owners, codes, 4, max_cells=5)
+    assert counts.tolist() == [2, 0, 1, 1]
+
+
+def test_metrics_calculator_graph_cache(tmp_path):
+    data = create_random_data(4, on_grid=True)
+    expected = MetricsCalculator(distance=[0.25, 0.5]).fit_transform(data.copy())
+    for _ in range(2):
+        transformed_data = MetricsCalculator(
+            distance=[0.25, 0.5], graph_cache=str(tmp_path), chunk_size=50
+        ).fit_transform(data.copy())
+        pd.testing.assert_frame_equal(transformed_data, expected)
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+@pytest.mark.parametrize("time_window", [None, 30])
+def test_metrics_calculator_update(time_window):
+    data = create_random_data(
+        5, n=400, on_grid=True, missing_insects=True, with_times=True
+    )
+    base, new = data.iloc[:300], data.iloc[300:]
+    kwargs = {
+        "distance": [0.3, 0.6],
+        "time_window": time_window,
+        "clear_intermediate_steps": False,
+    }
+    expected = MetricsCalculator(**kwargs).fit_transform(data.copy())
+
+    calculator = MetricsCalculator(keep_state=True, **kwargs)
+    transformed_base = calculator.fit_transform(base.copy())
+    transformed_data = calculator.update(transformed_base, new.copy())
+    pd.testing.assert_frame_equal(transformed_data, expected, check_dtype=False)
+
+    # The state is updated, so that the next export can be added too
+    transformed_data = calculator.update(
+        calculator.fit_transform(base.iloc[:200].copy()), base.iloc[200:].copy()
+    )
+    # An empty batch leaves the data and the state unchanged
+    unchanged = calculator.update(transformed_data, new.iloc[:0].copy())
+    pd.testing.assert_frame_equal(unchanged, transformed_data)
+    transformed_data = calculator.update(unchanged, new.copy())
+    pd.testing.assert_frame_equal(transformed_data, expected, check_dtype=False)
+
+
+def test_metrics_calculator_update_far_from_existing_locations():
+    data = pd.DataFrame(
+        {
+            "latitude": [45.0, 45.1, 48.0],
+            "longitude": [2.0, 2.1, 6.0],
+            "insecte_fr": ["A", "B", "A"],
+            "collection_id": [1, 2, 3],
+        }
+    )
+    expected = MetricsCalculator(distance=0.5).fit_transform(data.copy())
+
+    # The batch touches no existing neighborhood
+    calculator = MetricsCalculator(keep_state=True, distance=0.5)
+    transformed_base = calculator.fit_transform(data.iloc[:2].copy())
+    transformed_data = calculator.update(transformed_base, data.iloc[2:].copy())
+    pd.testing.assert_frame_equal(transformed_data, expected, check_dtype=False)
+
+
+def test_metrics_calculator_update_new_and_existing_neighborhoods():
+    data = create_random_data(9, n=300, on_grid=True, missing_insects=True)
+    # New rows close to the existing locations, and a new far away location
+    far = pd.DataFrame(
+        {
+            "latitude": [20.0],
+            "longitude": [20.0],
+            "insecte_fr": ["A"],
+            "collection_id": [0],
+        },
+        index=[300],
+    )
+    data = pd.concat([data, far])
+    base, new = data.iloc[:250], data.iloc[250:]
+    kwargs = {"distance": [0.3, 0.6], "clear_intermediate_steps": False}
+    expected = MetricsCalculator(**kwargs).fit_transform(data.copy())
+
+    calculator = MetricsCalculator(keep_state=True, **kwargs)
+    transformed_base = calculator.fit_transform(base.copy())
+    transformed_data = calculator.update(transformed_base, new.copy())
+    pd.testing.assert_frame_equal(transformed_data, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("time_window", ["month", 0, -3, True])
+def test_metrics_calculator_invalid_time_window(create_test_data, time_window):
+    data = create_test_data.assign(
+        collection_heure_debut=pd.Timestamp("2020-01-01")
+    )
+    with pytest.raises(ValueError, match="time_window"):
+        MetricsCalculator(distance=1, time_window=time_window).fit_transform(data.copy())
+
+    calculator = MetricsCalculator(distance=1, keep_state=True)
+    transformed_data = calculator.fit_transform(data.iloc[:3].copy())
+    calculator.set_params(time_window=time_window)
+    with pytest.raises(ValueError, match="time_window"):
+        calculator.update(transformed_data, data.iloc[3:].copy())
+
+
+@pytest.mark.parametrize("metric, distance", [("box", 0.5), ("haversine", 40)])
+def test_metrics_calculator_transform_tiled(tmp_path, metric, distance):
+    data = create_random_data(6, n=500, on_grid=True, missing_insects=True)
+    data = data.assign(latitude=data["latitude"] + 45, plante_fr="X")
+    data.to_csv(tmp_path / "data.csv", index=False)
+    calculator = MetricsCalculator(distance=distance, metric=metric)
+    expected = calculator.fit_transform(pd.read_csv(tmp_path / "data.csv"))
+    calculator.transform_tiled(
+        str(tmp_path / "data.csv"),
+        str(tmp_path / "metrics.csv"),
+        tile_size=1.0,
+        chunksize=120,
+    )
+    transformed_data = pd.read_csv(tmp_path / "metrics.csv")
+    pd.testing.assert_frame_equal(transformed_data, expected)
+
+
+def test_metrics_calculator_approximate():
+    # The timing against the exact calculator is in
+    # models/supervised/benchmark_approximate_metrics.py
+    rng = np.random.default_rng(7)
+    n = 4000
+    data = pd.DataFrame(
+        {
+            "latitude": rng.uniform(45, 47, n),
+            "longitude": rng.uniform(2, 4, n),
+            "insecte_fr": rng.integers(0, 600, n).astype(str),
+            "collection_id": rng.integers(0, 1000, n),
+        }
+    )
+    expected = MetricsCalculator(distance=0.5).fit_transform(data.copy())
+    transformed_data = MetricsCalculator(
+        distance=0.5, approximate=True, sketch_error=0.02, cell_size=0.05
+    ).fit_transform(data.copy())
+    # The covering cells are slightly larger than the neighborhoods
+    relative_error = (
+        transformed_data["weighted_specific_richness"]
+        / expected["weighted_specific_richness"]
+        - 1
+    )
+    assert np.abs(relative_error).mean() < 0.05
+
+
+def test_metrics_calculator_leaves_the_input_unchanged(create_test_data):
+    data = create_test_data.copy()
+    transformed_data = MetricsCalculator(distance=1).fit_transform(data)
+    assert "density" not in transformed_data.columns
+    # The intermediate columns are dropped from a new frame
+    assert "density" in data.columns
+
+
+def test_metrics_calculator_approximate_far_apart_points():
+    # A dense grid spanning Metropolitan France and La Reunion would not fit in memory
+    data = pd.DataFrame(
+        {
+            "latitude": [46.0, 46.001, -21.1],
+            "longitude": [2.0, 2.001, 55.5],
+            "insecte_fr": ["Abeille", "Bourdon", "Abeille"],
+            "collection_id": [1, 2, 3],
+        }
+    )
+    transformed_data = MetricsCalculator(
+        distance=0.01,
+        approximate=True,
+        cell_size=0.001,
+        clear_intermediate_steps=False,
+    ).fit_transform(data)
+    assert transformed_data["density"].tolist() == [2, 2, 1]
+    assert transformed_data["specific_richness"].round().tolist() == [2, 2, 1]
+
+
+def test_temporal_transformers_share_parsed_dates():
+    times = ["2023-07-04 08:13:00", "1960-02-29 23:59:59", "2023-10-12 12:00:00"]
+    parsed = pd.DataFrame({"time": as_datetime(pd.Series(times))})
+    assert as_datetime(parsed["time"]).dtype == parsed["time"].dtype
+
+    expected = pd.to_datetime(pd.Series(times))
+    transformed = DateToJulian("time").fit_transform(HourToCos("time").fit_transform(parsed))
+    assert transformed["time_julian"].tolist() == pytest.approx(
+        expected.apply(lambda x: x.to_julian_date()).tolist()
+    )
+    hours = expected.dt.hour + expected.dt.minute / 60
+    assert transformed["time_cos"].tolist() == pytest.approx(
+        np.cos(hours * 2 * np.pi / 24).tolist()
+    )
+    assert len(get_df_by_hours(parsed, "time", [23])) == 1
+    assert len(get_df_by_months(parsed, "time", [2, 10])) == 2
+
+
+def test_temporal_mask_and_split_in_dummies():
+    df = pd.DataFrame(
+        {
+            "time": ["2023-07-04 08:00:00", "2023-10-12 12:00:00", None],
+            "plants": ["a,b", "b", "c"],
+        }
+    )
+    dates = as_datetime(df["time"])
+    assert temporal_mask(dates, hours=[8, 12], months=[10]).tolist() == [False, True, False]
+    assert temporal_mask(dates).tolist() == [True, True, False]
+
+    selected = df.take(np.flatnonzero(temporal_mask(dates, hours=[8, 12])))
+    transformed, dummies = split_in_dummies(selected, "plants")
+    assert dummies == ["a", "b"]
+    assert transformed[dummies].to_numpy().tolist() == [[1, 1], [0, 1]]
+    assert list(df.columns) == ["time", "plants"]
+
+
+def test_multi_label_encoder():
+    X = pd.DataFrame({"habitat": ["a,b", "b", None, "a,a,c"], "other": ["x", "y", "x", "x"]})
+    encoder = MultiLabelEncoder().fit(X)
+    encoded = encoder.transform(X)
+    assert encoded.format == "csr"
+    assert encoder.get_feature_names_out().tolist() == [
+        "habitat_a", "habitat_b", "habitat_c", "other_x", "other_y"
+    ]
+    expected = pd.concat(
+        [X["habitat"].str.get_dummies(","), X["other"].str.get_dummies(",")], axis=1
+    )
+    assert encoded.toarray().tolist() == expected.to_numpy().tolist()
+
+    unseen = pd.DataFrame({"habitat": ["z,a"], "other": ["x"]})
+    assert encoder.transform(unseen).toarray().tolist() == [[1, 0, 0, 1, 0]]
+    with pytest.raises(ValueError):
+        MultiLabelEncoder(handle_unknown="error").fit(X).transform(unseen)
+
+
+def test_undersample_indices():
+    y = np.array([0.0, 0.0, 0.0, 0.0, 1.0, 1.0, 2.0, np.nan, 0.0, 1.0])
+    keep = undersample_indices(y, [-0.5, 0.5], [0.5, 1.5], [0.4, 0.0], random_state=0)
+    assert np.all(np.diff(keep) > 0)
+    assert np.count_nonzero(y[keep] == 0) == 2
+    assert np.count_nonzero(y[keep] == 1) == 0
+    assert {6, 7} <= set(keep)
+
+
+def test_train_test_under_sampler_on_non_unique_index():
+    X = pd.DataFrame({"x": np.arange(100)}, index=np.repeat([0, 1], 50))
+    y = pd.Series(np.tile([0.0, 1.0], 50), index=X.index, name="richness")
+    sampler = TrainTestUnderSampler("richness", [-0.5], [0.5], [0.5], random_state=0)
+    X_train, X_test, y_train, y_test = sampler.preprocess(X, y)
+    assert len(X_test) == 20
+    assert np.count_nonzero(y_train == 1) == 50 - np.count_nonzero(y_test == 1)
+    assert np.count_nonzero(y_train == 0) == (50 - np.count_nonzero(y_test == 0)) // 2
+    assert np.array_equal(X_train["x"].to_numpy() % 2, y_train.to_numpy())
+
+
+def test_tree_knn_imputer_matches_knn_imputer_with_complete_donors():
+    from sklearn.impute import KNNImputer
+
+    rng = np.random.default_rng(0)
+    donors = rng.normal(size=(200, 3))
+    queries = rng.normal(size=(20, 3))
+    queries[:10, 0] = np.nan
+    queries[10:15, [1, 2]] = np.nan
+    queries[15, :] = np.nan
+
+    imputed = TreeKNNImputer(n_neighbors=3, chunk_size=4).fit(donors).transform(queries)
+    expected = KNNImputer(n_neighbors=3).fit(donors).transform(queries)
+    assert not np.isnan(imputed).any()
+    assert imputed[:15] == pytest.approx(expected[:15])
+    assert imputed[15] == pytest.approx(donors.mean(axis=0))
+
+
+def test_tree_knn_imputer_matches_knn_imputer_with_scattered_nans():
+    from sklearn.impute import KNNImputer
+
+    rng = np.random.default_rng(1)
+    X = rng.normal(size=(300, 5))
+    X[rng.random(X.shape) < 0.2] = np.nan
+    # A feature never observed is dropped, as with KNNImputer
+    X[:, 3] = np.nan
+    queries = rng.normal(size=(40, 5))
+    queries[rng.random(queries.shape) < 0.3] = np.nan
+    queries[0, [0, 1, 2, 4]] = np.nan
+
+    imputer = TreeKNNImputer(n_neighbors=4, chunk_size=7).fit(X)
+    expected = KNNImputer(n_neighbors=4).fit(X)
+    for data in [X, queries]:
+        imputed = imputer.transform(data)
+        assert imputed.shape == (len(data), 4)
+        assert not np.isnan(imputed).any()
+        assert imputed == pytest.approx(expected.transform(data))
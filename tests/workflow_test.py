@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from models.supervised.workflow import preprocess_data
+
+
+def test_preprocess_data_keeps_the_input_and_the_time_column():
+    rng = np.random.default_rng(0)
+    n = 300
+    data = pd.DataFrame(
+        {
+            "collection_id": rng.integers(0, 50, n),
+            "collection_heure_debut": (
+                pd.Timestamp("2021-01-01")
+                + pd.to_timedelta(rng.integers(0, 365 * 86400, n), unit="s")
+            ).strftime("%Y-%m-%d %H:%M:%S"),
+            "latitude": rng.uniform(45, 46, n),
+            "longitude": rng.uniform(2, 3, n),
+            "insecte_fr": rng.choice(["A", "B", "C"], n),
+            "habitat": rng.choice(["prairie,jardin", "jardin", "foret"], n),
+        }
+    )
+    original = data.copy()
+    transformed, dummies = preprocess_data(
+        data,
+        distance=0.2,
+        hour_range=list(range(8, 19)),
+        month_range=list(range(4, 10)),
+        col_to_dummy="habitat",
+        insect_col="insecte_fr",
+    )
+
+    assert dummies == ["foret", "jardin", "prairie"]
+    pd.testing.assert_frame_equal(data, original)
+    # The time column is returned as given, the features are parsed from it
+    pd.testing.assert_series_equal(
+        transformed["collection_heure_debut"],
+        original.loc[transformed.index, "collection_heure_debut"],
+    )
+    dates = pd.to_datetime(transformed["collection_heure_debut"])
+    assert dates.dt.hour.between(8, 18).all()
+    assert dates.dt.month.between(4, 9).all()
+    assert np.allclose(
+        transformed["collection_heure_debut_cos"],
+        np.cos((dates.dt.hour + dates.dt.minute / 60) * 2 * np.pi / 24),
+    )